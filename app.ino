@@ -4,7 +4,7 @@
   - Keypad 4x4
   - LCD I2C 20x4
   - Lector RFID MFRC522
-  - Conexión a backend FastAPI (endpoints: /buscar_usuario_por_ci, /registrar_tarjeta, /transaccion, /consultar_saldo)
+  - Conexión a backend FastAPI (endpoints: /buscar_usuario_por_ci, /registrar_tarjeta, /transaccion, /transacciones/lote, /consultar_saldo)
 
   Comentarios muy resumidos antes de cada función/variable.
 */
@@ -16,6 +16,7 @@
 #include <LiquidCrystal_I2C.h>
 #include <SPI.h>
 #include <MFRC522.h>
+#include <mbedtls/md.h>
 
 // ---------- CONFIG ----------
 // WiFi
@@ -25,6 +26,11 @@
 // Backend
 #define API_HOST "http://192.168.0.4:8000" // esto tenemos que cambiarlo con algunoa conexion o hacerlo estatico xd
 #define ID_TARJETERO 1
+// Secreto para firmar cobros guardados sin conexion (tarjeteros.clave_firma)
+#define CLAVE_FIRMA "dev-clave-tarjetero-1"
+#define MAX_COBROS_PENDIENTES 50
+#define INTERVALO_SUBIDA_MS 30000
+#define INTENTOS_COBRO 3
 
 #define RST_PIN 16
 #define SS_PIN 17
@@ -67,6 +73,19 @@ String ciTemp = "";
 String nombreUsuario = "";
 bool wifiConectado = false;
 
+// Cobros tomados sin WiFi; se suben juntos a /transacciones/lote
+struct CobroPendiente {
+  String clave;
+  String uid;
+  String pin;
+  float monto;
+  unsigned long tomado;
+};
+CobroPendiente pendientes[MAX_COBROS_PENDIENTES];
+int numPendientes = 0;
+unsigned long contadorCobros = 0;
+unsigned long ultimoIntentoSubida = 0;
+
 // ---------- PROTOTIPOS ----------
 void conectarWiFi();
 void cargarDatosIniciales();
@@ -89,6 +108,9 @@ void esperarTarjetaParaRegistro();
 void leerTarjetaParaRegistro();
 void procesarIngresoPinRegistro(char tecla);
 void registrarUsuarioEnServidor();
+void guardarCobroPendiente();
+String firmarCobro(const CobroPendiente &c);
+void subirCobrosPendientes();
 void cancelarOperacion();
 void mostrarMensaje(String mensaje, int duracion);
 
@@ -169,6 +191,13 @@ void loop() {
       break;
   }
 
+  // Subir cobros pendientes cuando vuelve la conexion
+  if (numPendientes > 0 && estadoActual == MENU_PRINCIPAL && millis() - ultimoIntentoSubida > INTERVALO_SUBIDA_MS) {
+    ultimoIntentoSubida = millis();
+    wifiConectado = WiFi.status() == WL_CONNECTED;
+    if (wifiConectado) subirCobrosPendientes();
+  }
+
   delay(40);
 }
 
@@ -391,18 +420,31 @@ void procesarIngresoPinPago(char tecla) {
 }
 
 void procesarPago() {
+  wifiConectado = WiFi.status() == WL_CONNECTED;
   if (!wifiConectado) {
-    mostrarMensaje("Sin conexion WiFi", 1500);
+    if (numPendientes < MAX_COBROS_PENDIENTES) {
+      guardarCobroPendiente();
+      lcd.clear();
+      lcd.print("SIN CONEXION");
+      lcd.setCursor(0,1);
+      lcd.print("Cobro guardado");
+      lcd.setCursor(0,2);
+      lcd.print("Monto: $" + String(montoTemp,2));
+      lcd.setCursor(0,3);
+      lcd.print("Pendientes: " + String(numPendientes));
+      delay(2000);
+    } else {
+      mostrarMensaje("Sin conexion WiFi", 1500);
+    }
     mostrarMenuPrincipal();
     return;
   }
 
   lcd.clear();
   lcd.print("PROCESANDO PAGO...");
-  HTTPClient http;
-  String url = String(API_HOST) + "/transaccion";
-  http.begin(url);
-  http.addHeader("Content-Type", "application/json");
+  // Una clave por pasada de tarjeta: los reintentos de abajo la reenvian y el
+  // servidor no cobra dos veces la misma clave
+  String clave = String(ID_TARJETERO) + "-" + String(esp_random(), HEX) + "-" + String(contadorCobros++);
 
   DynamicJsonDocument doc(512);
   doc["id_tarjetero"] = ID_TARJETERO;
@@ -412,7 +454,25 @@ void procesarPago() {
 
   String out;
   serializeJson(doc, out);
-  int httpCode = http.POST(out);
+
+  HTTPClient http;
+  String url = String(API_HOST) + "/transaccion";
+  int httpCode = -1;
+  // Sin respuesta (httpCode < 0) el cobro pudo haberse aplicado: se repite con
+  // la misma clave. 409: el intento anterior sigue en curso en el servidor
+  for (int intento = 0; intento < INTENTOS_COBRO; intento++) {
+    if (intento > 0) {
+      http.end();
+      lcd.setCursor(0,1);
+      lcd.print("Reintentando... " + String(intento));
+      delay(500 * intento);
+    }
+    http.begin(url);
+    http.addHeader("Content-Type", "application/json");
+    http.addHeader("Idempotency-Key", clave);
+    httpCode = http.POST(out);
+    if (httpCode >= 0 && httpCode != 409) break;
+  }
 
   if (httpCode == 200) {
     String res = http.getString();
@@ -463,6 +523,14 @@ void procesarPago() {
     mostrarMensaje("PIN INCORRECTO", 2000);
   } else if (httpCode == 404) {
     mostrarMensaje("TARJETA NO REGISTRADA", 2000);
+  } else if (httpCode == 202) {
+    // Fallo el commit en el servidor: el cobro pudo o no haberse aplicado
+    Serial.print("Cobro incierto, clave "); Serial.println(clave);
+    mostrarMensaje("VERIFICAR COBRO", 2000);
+  } else if (httpCode < 0) {
+    // El servidor no respondio: el cobro pudo o no haberse aplicado
+    Serial.print("Cobro sin respuesta, clave "); Serial.println(clave);
+    mostrarMensaje("SIN RESPUESTA", 2000);
   } else {
     String resp = http.getString();
     Serial.print("HTTP error transaccion: "); Serial.println(httpCode);
@@ -475,6 +543,95 @@ void procesarPago() {
   mostrarMenuPrincipal();
 }
 
+// ---------- COBROS SIN CONEXION ----------
+
+// Guarda el cobro actual con una clave unica (el servidor ignora claves repetidas)
+void guardarCobroPendiente() {
+  CobroPendiente &c = pendientes[numPendientes++];
+  c.clave = String(esp_random(), HEX) + "-" + String(contadorCobros++);
+  c.uid = uidTemp;
+  c.pin = pinTemp;
+  c.monto = montoTemp;
+  c.tomado = millis();
+}
+
+// HMAC-SHA256 de "id|clave|uid|pin|monto" en hexadecimal (ver firma_cobro en app.py)
+String firmarCobro(const CobroPendiente &c) {
+  String mensaje = String(ID_TARJETERO) + "|" + c.clave + "|" + c.uid + "|" + c.pin + "|" + String(c.monto, 2);
+  byte hmac[32];
+  mbedtls_md_context_t ctx;
+  mbedtls_md_init(&ctx);
+  mbedtls_md_setup(&ctx, mbedtls_md_info_from_type(MBEDTLS_MD_SHA256), 1);
+  mbedtls_md_hmac_starts(&ctx, (const unsigned char*)CLAVE_FIRMA, strlen(CLAVE_FIRMA));
+  mbedtls_md_hmac_update(&ctx, (const unsigned char*)mensaje.c_str(), mensaje.length());
+  mbedtls_md_hmac_finish(&ctx, hmac);
+  mbedtls_md_free(&ctx);
+  String hex = "";
+  for (int i = 0; i < 32; i++) {
+    if (hmac[i] < 0x10) hex += "0";
+    hex += String(hmac[i], HEX);
+  }
+  return hex;
+}
+
+// Sube todos los cobros pendientes en un solo POST
+void subirCobrosPendientes() {
+  HTTPClient http;
+  String url = String(API_HOST) + "/transacciones/lote";
+  http.begin(url);
+  http.addHeader("Content-Type", "application/json");
+
+  DynamicJsonDocument doc(16384);
+  doc["id_tarjetero"] = ID_TARJETERO;
+  JsonArray lista = doc.createNestedArray("transacciones");
+  for (int i = 0; i < numPendientes; i++) {
+    JsonObject item = lista.createNestedObject();
+    item["clave"] = pendientes[i].clave;
+    item["uid_tarjeta"] = pendientes[i].uid;
+    item["pin"] = pendientes[i].pin;
+    item["monto"] = pendientes[i].monto;
+    item["antiguedad"] = (millis() - pendientes[i].tomado) / 1000;
+    item["firma"] = firmarCobro(pendientes[i]);
+  }
+
+  String out;
+  serializeJson(doc, out);
+  int httpCode = http.POST(out);
+
+  if (httpCode == 200) {
+    String res = http.getString();
+    DynamicJsonDocument resDoc(16384);
+    DeserializationError err = deserializeJson(resDoc, res);
+    if (!err) {
+      // Cada clave tiene resultado definitivo: se puede vaciar el buffer
+      JsonArray resultados = resDoc["resultados"].as<JsonArray>();
+      for (int i = 0; i < (int)resultados.size() && i < numPendientes; i++) {
+        String estado = resultados[i]["estado"] | "";
+        if (estado == "aprobada") {
+          saldoCaja += pendientes[i].monto;
+        } else if (estado == "rechazada") {
+          String error = resultados[i]["error"] | "";
+          Serial.print("Cobro rechazado "); Serial.print(pendientes[i].clave);
+          Serial.print(": "); Serial.println(error);
+        }
+      }
+      int aprobadas = resDoc["aprobadas"] | 0;
+      int rechazadas = resDoc["rechazadas"] | 0;
+      numPendientes = 0;
+      lcd.clear();
+      lcd.print("Cobros subidos");
+      lcd.setCursor(0,1); lcd.print("Aprobados: " + String(aprobadas));
+      lcd.setCursor(0,2); lcd.print("Rechazados: " + String(rechazadas));
+      delay(1500);
+      mostrarMenuPrincipal();
+    }
+  } else {
+    // Se reintenta en INTERVALO_SUBIDA_MS con las mismas claves
+    Serial.print("Error subiendo lote: "); Serial.println(httpCode);
+  }
+  http.end();
+}
+
 // ---------- ULTIMAS TRANSACCIONES (OPCION B) ----------
 void mostrarUltimasTransacciones() {
   if (!wifiConectado) {
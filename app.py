@@ -1,13 +1,34 @@
-from flask import Flask, request, jsonify, render_template, session, redirect, url_for, Response, stream_with_context
+from flask import Flask, request, jsonify, render_template, session, redirect, url_for, Response, stream_with_context, make_response
 from flask_cors import CORS
-import mysql.connector
-from mysql.connector import Error
+from mysql.connector import Error, IntegrityError
 from datetime import datetime, timedelta
 from functools import wraps
-import bcrypt
 import secrets
 import requests
 import json
+import os
+import base64
+import random
+import hmac
+import hashlib
+import queue
+
+from pool_conexiones import PoolConexiones
+from sesiones import SesionesMemoria, SesionesMySQL, iniciar_limpieza
+from hash_passwords import PoolHash, HashSaturado
+from cache_tarjetas import CacheTarjetas, TarjetaCache, NO_REGISTRADA
+from cache_recursos import CacheRecursos, CacheRecursosMySQL
+from eventos import HubEventos
+from contexto_ia import CacheContextos, construir_contexto
+from cliente_ollama import ClienteOllama, IASaturada, ErrorOllama
+from cache_respuestas_ia import CacheRespuestas
+from idempotencia import IdempotenciaMemoria, IdempotenciaMySQL, ClaveEnCurso, ClaveReutilizada, hash_clave
+from archivo_historial import ArchivadorHistorial, iniciar_archivado
+from extractos import ExportadorExtractos, ExtractoSaturado, FORMATOS, COLUMNAS
+from instrumentacion import Medidor
+from commit_agrupado import EscritorAgrupado, GrupoSaturado, CommitIncierto
+from reintentos import ReintentadorBloqueos, BloqueoAgotado
+from motor_saldos import MotorSaldos, SaldoInsuficiente, CuentaNoEncontrada, MotorAveriado, USUARIO, TARJETERO
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
@@ -15,8 +36,17 @@ CORS(app, resources={r"/*": {"origins": "*"}})
 # Configuración simple para desarrollo
 app.config['SECRET_KEY'] = 'dev-secret-key-bancamovil-2024'
 
-# Sesiones de usuario activas (en memoria para desarrollo)
-active_sessions = {}
+# Con `python app.py`, los procesos de bcrypt (spawn, ver hash_passwords.py)
+# vuelven a importar este archivo como __mp_main__: ahí no se arrancan hilos
+PROCESO_HASH = __name__ == '__mp_main__'
+
+# Sesiones: 'memoria' (un solo worker) o 'mysql' (compartidas entre workers)
+SESIONES_CONFIG = {
+    'backend': os.environ.get('SESIONES_BACKEND', 'memoria'),
+    'ttl': int(os.environ.get('SESION_TTL', 28800)),
+    'max_sesiones': int(os.environ.get('SESIONES_MAX', 100000)),
+    'intervalo_limpieza': int(os.environ.get('SESIONES_INTERVALO_LIMPIEZA', 300))
+}
 
 def generar_token():
     return secrets.token_urlsafe(32)
@@ -29,7 +59,7 @@ def auth_required(f):
             return jsonify({'error': 'Token no proporcionado'}), 401
         
         token = auth_header.replace('Bearer ', '')
-        user_id = active_sessions.get(token)
+        user_id = sesiones.obtener(token)
         
         if not user_id:
             return jsonify({'error': 'Token inválido o expirado'}), 401
@@ -39,6 +69,18 @@ def auth_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# Ids de usuarios con acceso a las rutas de administración (ej. ADMIN_USUARIOS=1,2)
+ADMIN_USUARIOS = {int(i) for i in os.environ.get('ADMIN_USUARIOS', '').split(',') if i.strip()}
+
+def admin_required(f):
+    # Va debajo de @auth_required
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if request.user_id not in ADMIN_USUARIOS:
+            return jsonify({'error': 'Acceso solo para administradores'}), 403
+        return f(*args, **kwargs)
+    return decorated_function
+
 DB_CONFIG = {
     'host': 'localhost',
     'user': 'root',
@@ -46,8 +88,341 @@ DB_CONFIG = {
     'database': 'sistema_cobros_simple'
 }
 
+# Pool de conexiones compartido por todas las rutas
+DB_POOL_CONFIG = {
+    'tamano': int(os.environ.get('DB_POOL_TAMANO', 10)),
+    'timeout': float(os.environ.get('DB_POOL_TIMEOUT', 5)),
+    'max_edad': int(os.environ.get('DB_POOL_MAX_EDAD', 1800)),
+    'ping_tras_inactividad': float(os.environ.get('DB_POOL_PING_INACTIVIDAD', 5))
+}
+
+# Latencia por ruta y por sentencia SQL, expuesta en /metrics (formato Prometheus)
+INSTRUMENTACION_CONFIG = {
+    'activa': os.environ.get('INSTRUMENTACION_ACTIVA', '1') == '1',
+    'lenta_ms': float(os.environ.get('CONSULTA_LENTA_MS', 200))
+}
+
+medidor = Medidor(lenta_ms=INSTRUMENTACION_CONFIG['lenta_ms']) if INSTRUMENTACION_CONFIG['activa'] else None
+
+db_pool = PoolConexiones(DB_CONFIG, medidor=medidor, **DB_POOL_CONFIG)
+
+@app.before_request
+def iniciar_medicion():
+    if medidor:
+        medidor.iniciar_peticion()
+        medidor.fijar_ruta(f'{request.method} {request.path}')
+
+@app.after_request
+def terminar_medicion(response):
+    if not medidor:
+        return response
+    # Etiqueta por plantilla de ruta (/api/tarjetero/<int:id>), no por URL
+    ruta = request.url_rule.rule if request.url_rule else 'sin_ruta'
+    tiempos = medidor.terminar_peticion(ruta, request.method, response.status_code)
+    if tiempos:
+        # En respuestas en streaming mide hasta que empieza el cuerpo
+        total, db = tiempos
+        response.headers['Server-Timing'] = f'db;dur={db * 1000:.1f}, total;dur={total * 1000:.1f}'
+    return response
+
+# Franjas en las que se reparte el saldo de cada tarjetero (ver tarjeteros_saldo en db.sql)
+TARJETERO_FRANJAS = int(os.environ.get('TARJETERO_FRANJAS', 8))
+
+# Lotes de cobros acumulados por los tarjeteros sin conexión
+LOTE_CONFIG = {
+    'max_items': int(os.environ.get('LOTE_MAX_ITEMS', 500)),
+    'antiguedad_max': int(os.environ.get('LOTE_ANTIGUEDAD_MAX', 7 * 24 * 3600))
+}
+
 def get_db_connection():
-    return mysql.connector.connect(**DB_CONFIG)
+    # conn.close() devuelve la conexión al pool
+    return db_pool.obtener()
+
+# Motor de saldos en memoria con log local (ver motor_saldos.py): los saldos de
+# usuarios y tarjeteros se validan y mueven en este proceso y MySQL se pone al
+# día en segundo plano. Solo con un proceso de la app (el log se bloquea); el
+# motor arranca en el primer uso. Cada movimiento guarda su secuencia en la fila
+# de historial que lo registra (secuencia_motor) y se confirma con el commit.
+MOTOR_SALDOS_CONFIG = {
+    'activo': os.environ.get('MOTOR_SALDOS', '0') == '1',
+    'ruta': os.environ.get('MOTOR_SALDOS_LOG', 'saldos.wal'),
+    'fsync': os.environ.get('MOTOR_SALDOS_FSYNC', '1') == '1',
+    'intervalo_replicacion': float(os.environ.get('MOTOR_SALDOS_INTERVALO_REPLICACION', 0.2)),
+    'max_log_mb': int(os.environ.get('MOTOR_SALDOS_MAX_LOG_MB', 64))
+}
+
+motor_saldos = None
+if MOTOR_SALDOS_CONFIG['activo']:
+    motor_saldos = MotorSaldos(get_db_connection, ruta=MOTOR_SALDOS_CONFIG['ruta'], fsync=MOTOR_SALDOS_CONFIG['fsync'],
+                               intervalo_replicacion=MOTOR_SALDOS_CONFIG['intervalo_replicacion'],
+                               max_log_mb=MOTOR_SALDOS_CONFIG['max_log_mb'])
+
+def saldo_vigente(tipo, id_cuenta, saldo_mysql):
+    # Con el motor activo usuarios.saldo puede ir atrasado: manda el de memoria
+    if motor_saldos:
+        saldo = motor_saldos.saldo_en_memoria(tipo, id_cuenta)
+        if saldo is not None:
+            return saldo
+    return float(saldo_mysql)
+
+def confirmar_movimientos(conn, movidos):
+    # Commit de la transacción que registra los movimientos del motor (si los
+    # hay). Si el commit falla puede haber llegado igual: el motor lo comprueba
+    # en MySQL. Un movimiento vencido hace fallar preparar() con
+    # MovimientoVencido (un MotorAveriado) y la transacción se deshace.
+    if movidos:
+        motor_saldos.preparar(movidos)
+    try:
+        intentar_commit(conn)
+    except Error:
+        for movimiento in movidos:
+            motor_saldos.resolver(movimiento)
+        movidos.clear()
+        raise
+    for movimiento in movidos:
+        motor_saldos.confirmar(movimiento)
+
+def revertir_movimientos(movidos):
+    # La transacción se deshizo antes del commit: se devuelve el dinero
+    for movimiento in movidos:
+        motor_saldos.revertir(movimiento)
+    movidos.clear()
+
+# Capa fría del historial: transacciones y transferencias más viejas que `dias`
+# pasan a las tablas *_archivo. El horizonte nunca es menor que la antigüedad
+# aceptada en los lotes, para que las claves de cobro repetidas se sigan viendo.
+ARCHIVO_CONFIG = {
+    'activo': os.environ.get('ARCHIVO_ACTIVO', '1') == '1',
+    'dias': max(int(os.environ.get('ARCHIVO_DIAS', 180)), LOTE_CONFIG['antiguedad_max'] // 86400 + 1),
+    'lote': int(os.environ.get('ARCHIVO_LOTE', 1000)),
+    'intervalo': int(os.environ.get('ARCHIVO_INTERVALO', 3600))
+}
+
+archivador = ArchivadorHistorial(get_db_connection, dias=ARCHIVO_CONFIG['dias'], lote=ARCHIVO_CONFIG['lote'])
+if ARCHIVO_CONFIG['activo'] and not PROCESO_HASH:
+    iniciar_archivado(archivador, ARCHIVO_CONFIG['intervalo'])
+
+if SESIONES_CONFIG['backend'] == 'mysql':
+    sesiones = SesionesMySQL(get_db_connection, ttl=SESIONES_CONFIG['ttl'])
+else:
+    sesiones = SesionesMemoria(ttl=SESIONES_CONFIG['ttl'], max_sesiones=SESIONES_CONFIG['max_sesiones'])
+if not PROCESO_HASH:
+    iniciar_limpieza(sesiones, SESIONES_CONFIG['intervalo_limpieza'])
+
+# Claves Idempotency-Key de las rutas que mueven dinero: 'memoria' o 'mysql'
+IDEMPOTENCIA_CONFIG = {
+    'backend': os.environ.get('IDEMPOTENCIA_BACKEND', 'memoria'),
+    'ttl': int(os.environ.get('IDEMPOTENCIA_TTL', 86400)),
+    'max_claves': int(os.environ.get('IDEMPOTENCIA_MAX_CLAVES', 100000)),
+    'espera': float(os.environ.get('IDEMPOTENCIA_ESPERA', 10)),
+    'ttl_en_curso': int(os.environ.get('IDEMPOTENCIA_TTL_EN_CURSO', 60)),
+    'intervalo_limpieza': int(os.environ.get('IDEMPOTENCIA_INTERVALO_LIMPIEZA', 300))
+}
+
+if IDEMPOTENCIA_CONFIG['backend'] == 'mysql':
+    idempotencia = IdempotenciaMySQL(get_db_connection, ttl=IDEMPOTENCIA_CONFIG['ttl'],
+                                     espera=IDEMPOTENCIA_CONFIG['espera'],
+                                     ttl_en_curso=IDEMPOTENCIA_CONFIG['ttl_en_curso'])
+else:
+    idempotencia = IdempotenciaMemoria(ttl=IDEMPOTENCIA_CONFIG['ttl'], max_claves=IDEMPOTENCIA_CONFIG['max_claves'],
+                                       espera=IDEMPOTENCIA_CONFIG['espera'],
+                                       ttl_en_curso=IDEMPOTENCIA_CONFIG['ttl_en_curso'])
+if not PROCESO_HASH:
+    iniciar_limpieza(idempotencia, IDEMPOTENCIA_CONFIG['intervalo_limpieza'], nombre='claves de idempotencia')
+
+def idempotente(f):
+    # Con cabecera Idempotency-Key, una repetición de la misma petición devuelve
+    # la respuesta guardada en lugar de volver a mover dinero. Va debajo de
+    # @auth_required: las claves se separan por ruta y usuario (o tarjetero).
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        clave = request.headers.get('Idempotency-Key')
+        if not clave:
+            return f(*args, **kwargs)
+        if len(clave) > 255:
+            return jsonify({'error': 'Idempotency-Key demasiado larga'}), 400
+        
+        dueno = getattr(request, 'user_id', None)
+        if dueno is None:
+            dueno = f"tarjetero:{(request.get_json(silent=True) or {}).get('id_tarjetero')}"
+        ambito = f'{request.path}|{dueno}'
+        huella = hashlib.sha256(request.get_data()).hexdigest()
+        # Los cobros la guardan en transacciones.clave (ver cobro_agrupado)
+        request.clave_idempotencia = hash_clave(ambito, clave)
+        
+        try:
+            guardada = idempotencia.reservar(ambito, clave, huella)
+        except ClaveReutilizada:
+            return jsonify({'error': 'Idempotency-Key ya usada con otra petición'}), 422
+        except ClaveEnCurso as e:
+            respuesta = jsonify({'error': 'Petición en curso, reintenta en unos segundos'})
+            respuesta.headers['Retry-After'] = str(e.retry_after)
+            return respuesta, 409
+        
+        if guardada:
+            respuesta = Response(guardada.cuerpo, status=guardada.codigo, mimetype='application/json')
+            respuesta.headers['Idempotent-Replayed'] = 'true'
+            return respuesta
+        
+        try:
+            respuesta = make_response(f(*args, **kwargs))
+        except Exception as e:
+            if not getattr(request, 'commit_intentado', False):
+                idempotencia.liberar(ambito, clave)
+                raise
+            print(f"Error después del commit en {request.path}: {e}")
+            respuesta = make_response(respuesta_incierta())
+        
+        # Un 5xx antes del commit no movió dinero: se libera la clave para poder
+        # reintentar. Después de intentar el commit el resultado es incierto y
+        # la clave queda con esa respuesta: un reintento no vuelve a aplicarlo.
+        if respuesta.status_code >= 500 and getattr(request, 'commit_intentado', False):
+            respuesta = make_response(respuesta_incierta())
+        if respuesta.status_code >= 500:
+            idempotencia.liberar(ambito, clave)
+        else:
+            idempotencia.guardar(ambito, clave, huella, respuesta.status_code, respuesta.get_data())
+        return respuesta
+    return decorated_function
+
+def respuesta_incierta():
+    # Falló el commit (o algo después) y no se sabe si la operación quedó
+    # registrada: no es un error reintentable, hay que mirar el historial
+    return jsonify({
+        'error': 'No se pudo confirmar la operación',
+        'estado': 'incierto',
+        'detail': 'Revisa el historial antes de repetirla'
+    }), 202
+
+def intentar_commit(conn):
+    # Desde aquí un 5xx ya no garantiza que nada se guardó (ver @idempotente)
+    request.commit_intentado = True
+    conn.commit()
+
+# bcrypt se ejecuta en un pool de procesos para no bloquear los hilos de Flask
+HASH_CONFIG = {
+    'procesos': int(os.environ.get('HASH_PROCESOS', 2)),
+    'max_cola': int(os.environ.get('HASH_MAX_COLA', 16)),
+    'costo': int(os.environ.get('BCRYPT_COSTO', 12)),
+    'timeout': float(os.environ.get('HASH_TIMEOUT', 10)),
+    'retry_after': int(os.environ.get('HASH_RETRY_AFTER', 1))
+}
+
+hasher = PoolHash(**HASH_CONFIG)
+
+def respuesta_saturado(e):
+    respuesta = jsonify({'error': 'Servidor ocupado, intenta nuevamente en unos segundos'})
+    respuesta.headers['Retry-After'] = str(e.retry_after)
+    return respuesta, 503
+
+# Transacciones abortadas por deadlock (1213) o lock wait timeout (1205) se
+# repiten con espera exponencial con jitter; agotados los intentos, 503
+REINTENTOS_CONFIG = {
+    'intentos': int(os.environ.get('REINTENTOS_BLOQUEO', 4)),
+    'espera_base_ms': float(os.environ.get('REINTENTOS_ESPERA_BASE_MS', 5)),
+    'espera_max_ms': float(os.environ.get('REINTENTOS_ESPERA_MAX_MS', 200)),
+    'retry_after': int(os.environ.get('REINTENTOS_RETRY_AFTER', 1))
+}
+
+reintentador = ReintentadorBloqueos(**REINTENTOS_CONFIG)
+
+# Caché de tarjetas por UID usada por los tarjeteros
+CACHE_TARJETAS_CONFIG = {
+    'max_entradas': int(os.environ.get('CACHE_TARJETAS_MAX', 10000)),
+    'ttl': int(os.environ.get('CACHE_TARJETAS_TTL', 300)),
+    'ttl_negativo': int(os.environ.get('CACHE_TARJETAS_TTL_NEGATIVO', 5))
+}
+
+cache_tarjetas = CacheTarjetas(**CACHE_TARJETAS_CONFIG)
+
+# Respuestas de /api/perfil y /tarjetero/<id> ya serializadas, con ETag; las
+# escrituras que mueven dinero invalidan la versión del usuario o tarjetero.
+# Versiones en 'memoria' (un solo worker) o en 'mysql' (compartidas entre
+# workers); por defecto el mismo backend que las sesiones.
+CACHE_RECURSOS_CONFIG = {
+    'backend': os.environ.get('CACHE_RECURSOS_BACKEND', SESIONES_CONFIG['backend']),
+    'max_bytes': int(float(os.environ.get('CACHE_RECURSOS_MAX_MB', 8)) * 1024 * 1024),
+    'ttl': int(os.environ.get('CACHE_RECURSOS_TTL', 300))
+}
+
+if CACHE_RECURSOS_CONFIG['backend'] == 'mysql':
+    cache_recursos = CacheRecursosMySQL(get_db_connection, max_bytes=CACHE_RECURSOS_CONFIG['max_bytes'],
+                                        ttl=CACHE_RECURSOS_CONFIG['ttl'])
+else:
+    cache_recursos = CacheRecursos(max_bytes=CACHE_RECURSOS_CONFIG['max_bytes'], ttl=CACHE_RECURSOS_CONFIG['ttl'])
+
+def respuesta_recurso(cuerpo, etag, privada=False):
+    # Con If-None-Match igual al ETag, make_conditional responde 304 sin cuerpo
+    respuesta = Response(cuerpo, mimetype='application/json')
+    respuesta.set_etag(etag)
+    respuesta.headers['Cache-Control'] = 'private, no-cache' if privada else 'no-cache'
+    respuesta.make_conditional(request)
+    if respuesta.status_code == 304:
+        cache_recursos.no_modificado()
+    return respuesta
+
+def recurso_cacheado(recurso, privada=False):
+    # Respuesta desde la caché sin tocar MySQL, o None
+    entrada = cache_recursos.obtener(recurso)
+    if entrada is None:
+        return None
+    return respuesta_recurso(*entrada, privada=privada)
+
+def recurso_nuevo(recurso, version, datos, privada=False):
+    # `version` se toma con cache_recursos.version() antes de consultar MySQL
+    cuerpo = jsonify(datos).get_data()
+    return respuesta_recurso(cuerpo, cache_recursos.guardar(recurso, version, cuerpo), privada)
+
+# Canal de eventos SSE por usuario (saldo y movimientos nuevos)
+EVENTOS_CONFIG = {
+    'max_cola': int(os.environ.get('EVENTOS_MAX_COLA', 100)),
+    'heartbeat': int(os.environ.get('EVENTOS_HEARTBEAT', 15))
+}
+
+hub_eventos = HubEventos(max_cola=EVENTOS_CONFIG['max_cola'])
+
+# Contexto del asistente IA precalculado por usuario
+CONTEXTO_CONFIG = {
+    'max_entradas': int(os.environ.get('CONTEXTO_CACHE_MAX', 1000)),
+    'ttl': int(os.environ.get('CONTEXTO_CACHE_TTL', 600)),
+    'max_movimientos': int(os.environ.get('CONTEXTO_MAX_MOVIMIENTOS', 50)),
+    'presupuesto_tokens': int(os.environ.get('CONTEXTO_PRESUPUESTO_TOKENS', 600))
+}
+
+cache_contextos = CacheContextos(max_entradas=CONTEXTO_CONFIG['max_entradas'], ttl=CONTEXTO_CONFIG['ttl'])
+
+# Backend del asistente: sesión HTTP reutilizable y admisión acotada
+OLLAMA_CONFIG = {
+    'url': os.environ.get('OLLAMA_URL', 'http://localhost:11434'),
+    'modelo': os.environ.get('OLLAMA_MODELO', 'gemma2'),
+    'max_en_vuelo': int(os.environ.get('OLLAMA_MAX_EN_VUELO', 2)),
+    'max_cola': int(os.environ.get('OLLAMA_MAX_COLA', 20)),
+    'espera_max': float(os.environ.get('OLLAMA_ESPERA_MAX', 120)),
+    'timeout_conexion': float(os.environ.get('OLLAMA_TIMEOUT_CONEXION', 5)),
+    'timeout_lectura': float(os.environ.get('OLLAMA_TIMEOUT_LECTURA', 60)),
+    'retry_after': int(os.environ.get('OLLAMA_RETRY_AFTER', 5))
+}
+
+cliente_ollama = ClienteOllama(**OLLAMA_CONFIG)
+
+# Respuestas del asistente ya generadas para el mismo contexto y pregunta
+CACHE_RESPUESTAS_CONFIG = {
+    'max_entradas': int(os.environ.get('CACHE_RESPUESTAS_IA_MAX', 500)),
+    'ttl': int(os.environ.get('CACHE_RESPUESTAS_IA_TTL', 1800))
+}
+
+cache_respuestas = CacheRespuestas(**CACHE_RESPUESTAS_CONFIG)
+
+def publicar_movimiento(user_id, nuevo_saldo, movimiento):
+    # Llamar solo después de conn.commit(): avisa al dashboard y descarta
+    # el contexto IA y el perfil cacheados del usuario
+    cache_contextos.invalidar(user_id)
+    cache_recursos.invalidar(('perfil', user_id))
+    hub_eventos.publicar(user_id, {
+        'tipo': 'movimiento',
+        'saldo': float(nuevo_saldo),
+        'movimiento': movimiento
+    })
 
 def validar_pin(pin):
     if not (pin.isdigit() and len(pin) == 4):
@@ -84,7 +459,7 @@ def buscar_usuario_por_ci():
         return jsonify({
             'id': user['id'],
             'nombre': user['nombre'],
-            'saldo': float(user['saldo']),
+            'saldo': saldo_vigente(USUARIO, user['id'], user['saldo']),
             'activo': bool(user['activo'])
         }), 200
         
@@ -132,7 +507,9 @@ def registrar_tarjeta():
         else:
             return jsonify({'error': 'Proveer id_usuario o ci'}), 400
         
-        # Validar que UID no esté registrada
+        # Validar que UID no esté registrada (la caché negativa no se usa aquí)
+        if isinstance(cache_tarjetas.obtener(uid), TarjetaCache):
+            return jsonify({'error': 'La tarjeta ya está registrada'}), 400
         cursor.execute("SELECT id FROM tarjetas WHERE uid = %s", (uid,))
         if cursor.fetchone():
             return jsonify({'error': 'La tarjeta ya está registrada'}), 400
@@ -144,6 +521,8 @@ def registrar_tarjeta():
         """, (uid, pin, usuario_id, datetime.now()))
         
         conn.commit()
+        cache_tarjetas.invalidar(uid)
+        cache_recursos.invalidar(('perfil', int(usuario_id)))
         
         return jsonify({
             'mensaje': 'Tarjeta registrada exitosamente',
@@ -158,6 +537,7 @@ def registrar_tarjeta():
         conn.close()
 
 @app.route('/transaccion', methods=['POST'])
+@idempotente
 def realizar_transaccion():
     data = request.get_json()
     id_tarjetero = data.get('id_tarjetero')
@@ -176,46 +556,32 @@ def realizar_transaccion():
     
     monto = float(monto)
     
+    # Tarjetas conocidas (o UIDs inválidos recientes) se rechazan sin tocar MySQL
+    tarjeta = cache_tarjetas.obtener(uid_tarjeta)
+    if tarjeta is not None:
+        rechazo = validar_tarjeta(tarjeta, pin)
+        if rechazo:
+            return rechazo
+    
+    if motor_saldos:
+        return cobro_en_motor(id_tarjetero, uid_tarjeta, pin, monto, tarjeta)
+    if escritor_cobros:
+        return cobro_agrupado(id_tarjetero, uid_tarjeta, pin, monto, tarjeta)
+    
     conn = get_db_connection()
     cursor = conn.cursor(dictionary=True)
     
     try:
-        conn.start_transaction()
-        
-        # Verificar tarjeta y PIN
-        cursor.execute("""
-            SELECT t.id, t.uid, t.pin, t.id_usuario, t.activa
-            FROM tarjetas t
-            WHERE t.uid = %s
-            FOR UPDATE
-        """, (uid_tarjeta,))
-        tarjeta = cursor.fetchone()
-        
-        if not tarjeta:
-            conn.rollback()
-            return jsonify({
-                'error': 'Tarjeta no encontrada',
-                'estado': 'rechazado',
-                'detail': 'Tarjeta no registrada'
-            }), 404
-        if not tarjeta.get('activa', True):
-            conn.rollback()
-            return jsonify({
-                'error': 'Tarjeta inactiva',
-                'estado': 'rechazado',
-                'detail': 'Tarjeta bloqueada'
-            }), 400
-        if tarjeta['pin'] != pin:
-            conn.rollback()
-            return jsonify({
-                'error': 'PIN incorrecto',
-                'estado': 'rechazado',
-                'detail': 'PIN invalido'
-            }), 401
+        if tarjeta is None:
+            tarjeta = cargar_tarjeta(cursor, uid_tarjeta)
+            rechazo = validar_tarjeta(tarjeta, pin)
+            if rechazo:
+                conn.rollback()
+                return rechazo
         
-        id_usuario = tarjeta['id_usuario']
+        id_usuario = tarjeta.id_usuario
         
-        # Bloquear fila usuario
+        # Bloquear fila usuario (la transacción se abre implícitamente)
         cursor.execute("SELECT id, saldo, activo FROM usuarios WHERE id = %s FOR UPDATE", (id_usuario,))
         usuario = cursor.fetchone()
         
@@ -238,92 +604,753 @@ def realizar_transaccion():
         saldo_usuario = float(usuario['saldo'])
         if saldo_usuario < monto:
             conn.rollback()
-            faltante = monto - saldo_usuario
-            return jsonify({
-                'error': 'Saldo insuficiente',
-                'estado': 'rechazado',
-                'detail': f'Saldo insuficiente',
-                'mensaje': f'Saldo: ${saldo_usuario:.2f} Necesita: ${monto:.2f}',
-                'saldo_actual': saldo_usuario,
-                'monto_requerido': monto,
-                'faltante': faltante
-            }), 400
-        
-        # Bloquear fila tarjetero
-        cursor.execute("SELECT id, saldo, activo FROM tarjeteros WHERE id = %s FOR UPDATE", (id_tarjetero,))
-        tarjetero = cursor.fetchone()
+            return respuesta_saldo_insuficiente(saldo_usuario, monto)
         
-        if not tarjetero:
-            conn.rollback()
-            return jsonify({'error': 'Tarjetero no encontrado'}), 400
-        if not tarjetero.get('activo', True):
+        error_tarjetero = debitar_y_acreditar(cursor, id_usuario, id_tarjetero, monto)
+        if error_tarjetero:
             conn.rollback()
-            return jsonify({'error': 'Tarjetero inactivo'}), 400
-        
-        # Actualizar saldos
-        nuevo_saldo_usuario = round(saldo_usuario - monto, 2)
-        nuevo_saldo_tarjetero = round(float(tarjetero['saldo']) + monto, 2)
-        
-        cursor.execute("UPDATE usuarios SET saldo = %s WHERE id = %s", (nuevo_saldo_usuario, id_usuario))
-        cursor.execute("UPDATE tarjeteros SET saldo = %s WHERE id = %s", (nuevo_saldo_tarjetero, id_tarjetero))
+            return jsonify({'error': error_tarjetero}), 400
         
         # Registrar transacción
+        fecha = datetime.now()
         cursor.execute("""
             INSERT INTO transacciones (id_tarjetero, id_usuario, monto, tipo, estado, fecha)
             VALUES (%s, %s, %s, %s, %s, %s)
-        """, (id_tarjetero, id_usuario, monto, 'cobro', 'aprobada', datetime.now()))
+        """, (id_tarjetero, id_usuario, monto, 'cobro', 'aprobada', fecha))
+        id_transaccion = cursor.lastrowid
+        acumular_resumen(cursor, [(fecha, id_usuario, id_tarjetero, 'cobro', monto)])
         
-        conn.commit()
+        intentar_commit(conn)
         
-        # Obtener nombre usuario
-        cursor.execute("SELECT nombre FROM usuarios WHERE id = %s", (id_usuario,))
-        nombre_usuario = cursor.fetchone()['nombre']
+        return respuesta_cobro(id_tarjetero, tarjeta, id_transaccion, monto, fecha, round(saldo_usuario - monto, 2))
+        
+    except Error as e:
+        conn.rollback()
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cursor.close()
+        conn.close()
+
+# error -> (detail, código HTTP) de los cobros rechazados por el usuario
+RECHAZOS_USUARIO = {
+    'Usuario no encontrado': ('Usuario no existe', 404),
+    'Usuario inactivo': ('Usuario suspendido', 400),
+}
+
+def cobro_agrupado(id_tarjetero, uid_tarjeta, pin, monto, tarjeta):
+    # /transaccion con COMMIT_AGRUPADO=1: el cobro se aplica y confirma junto
+    # con los demás cobros en curso (ver aplicar_cobros_agrupados)
+    try:
+        id_tarjetero = int(id_tarjetero)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Tarjetero no encontrado'}), 400
+    
+    if tarjeta is None:
+        conn = get_db_connection()
+        cursor = conn.cursor(dictionary=True)
+        try:
+            tarjeta = cargar_tarjeta(cursor, uid_tarjeta)
+        except Error as e:
+            return jsonify({'error': str(e)}), 500
+        finally:
+            cursor.close()
+            conn.close()
+        rechazo = validar_tarjeta(tarjeta, pin)
+        if rechazo:
+            return rechazo
+    
+    # La clave identifica la fila del cobro si el commit queda en duda. Con
+    # Idempotency-Key es la misma en cada reintento: uk_tarjetero_clave impide
+    # registrar el cobro dos veces.
+    clave = getattr(request, 'clave_idempotencia', None) or secrets.token_hex(16)
+    try:
+        resultado = escritor_cobros.enviar((id_tarjetero, tarjeta.id_usuario, monto, clave)).result()
+    except GrupoSaturado as e:
+        return respuesta_saturado(e)
+    except Error as e:
+        # Commit incierto, o un intento anterior con la misma clave ya quedó
+        # registrado (IntegrityError): manda lo que haya en MySQL
+        try:
+            registrado = buscar_cobro(id_tarjetero, clave)
+        except Error:
+            if isinstance(e, CommitIncierto):
+                request.commit_intentado = True
+            return jsonify({'error': str(e)}), 500
+        if registrado:
+            return respuesta_cobro(id_tarjetero, tarjeta, registrado['id'], float(registrado['monto']),
+                                   registrado['fecha'], float(registrado['saldo']))
+        return jsonify({'error': str(e)}), 500
+    
+    error = resultado.get('error')
+    if error == 'Saldo insuficiente':
+        return respuesta_saldo_insuficiente(resultado['saldo'], monto)
+    if error in RECHAZOS_USUARIO:
+        detail, codigo = RECHAZOS_USUARIO[error]
+        return jsonify({'error': error, 'estado': 'rechazado', 'detail': detail}), codigo
+    if error:
+        return jsonify({'error': error}), 400
+    
+    return respuesta_cobro(id_tarjetero, tarjeta, resultado['id_transaccion'], monto, resultado['fecha'], resultado['nuevo_saldo'])
+
+def buscar_cobro(id_tarjetero, clave):
+    # Cobro ya registrado con esa clave y saldo actual del usuario, o None
+    conn = get_db_connection()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute("""
+            SELECT t.id, t.monto, t.fecha, u.saldo
+            FROM transacciones t
+            JOIN usuarios u ON u.id = t.id_usuario
+            WHERE t.id_tarjetero = %s AND t.clave = %s AND t.estado = 'aprobada'
+        """, (id_tarjetero, clave))
+        return cursor.fetchone()
+    finally:
+        cursor.close()
+        conn.close()
+
+def cobro_en_motor(id_tarjetero, uid_tarjeta, pin, monto, tarjeta):
+    # /transaccion con MOTOR_SALDOS=1: el saldo se valida y mueve en memoria y
+    # en MySQL solo se registra la transacción, sin bloquear usuario ni tarjetero
+    try:
+        id_tarjetero = int(id_tarjetero)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Tarjetero no encontrado'}), 400
+    
+    conn = get_db_connection()
+    cursor = conn.cursor(dictionary=True)
+    movidos = []
+    
+    try:
+        if tarjeta is None:
+            tarjeta = cargar_tarjeta(cursor, uid_tarjeta)
+            rechazo = validar_tarjeta(tarjeta, pin)
+            if rechazo:
+                return rechazo
+        
+        cursor.execute("""
+            SELECT u.activo, tar.activo AS tarjetero_activo
+            FROM usuarios u
+            LEFT JOIN tarjeteros tar ON tar.id = %s
+            WHERE u.id = %s
+        """, (id_tarjetero, tarjeta.id_usuario))
+        estado = cursor.fetchone()
+        error = None
+        if not estado:
+            error = 'Usuario no encontrado'
+        elif not estado['activo']:
+            error = 'Usuario inactivo'
+        if error:
+            detail, codigo = RECHAZOS_USUARIO[error]
+            return jsonify({'error': error, 'estado': 'rechazado', 'detail': detail}), codigo
+        if estado['tarjetero_activo'] is None:
+            return jsonify({'error': 'Tarjetero no encontrado'}), 400
+        if not estado['tarjetero_activo']:
+            return jsonify({'error': 'Tarjetero inactivo'}), 400
+        
+        try:
+            movimiento = motor_saldos.cobrar(tarjeta.id_usuario, id_tarjetero, monto, cursor)
+        except SaldoInsuficiente as e:
+            return respuesta_saldo_insuficiente(e.saldo, monto)
+        movidos.append(movimiento)
+        
+        fecha = datetime.now()
+        cursor.execute("""
+            INSERT INTO transacciones (id_tarjetero, id_usuario, monto, tipo, estado, fecha, secuencia_motor)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """, (id_tarjetero, tarjeta.id_usuario, monto, 'cobro', 'aprobada', fecha, movimiento.secuencia))
+        id_transaccion = cursor.lastrowid
+        acumular_resumen(cursor, [(fecha, tarjeta.id_usuario, id_tarjetero, 'cobro', monto)])
+        confirmar_movimientos(conn, movidos)
+        
+        return respuesta_cobro(id_tarjetero, tarjeta, id_transaccion, monto, fecha, movimiento.saldos[0])
+        
+    except (Error, CuentaNoEncontrada, MotorAveriado) as e:
+        conn.rollback()
+        revertir_movimientos(movidos)
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cursor.close()
+        conn.close()
+
+def respuesta_cobro(id_tarjetero, tarjeta, id_transaccion, monto, fecha, nuevo_saldo):
+    # Cobro aprobado y confirmado: avisa al dashboard y responde al tarjetero
+    cache_recursos.invalidar(('tarjetero', int(id_tarjetero)))
+    publicar_movimiento(tarjeta.id_usuario, nuevo_saldo, {
+        'id': id_transaccion,
+        'monto': monto,
+        'tipo': 'cobro',
+        'estado': 'aprobada',
+        'fecha': fecha.isoformat(),
+        'descripcion': None,
+        'tarjetero': None,
+        'categoria': 'transaccion'
+    })
+    
+    return jsonify({
+        'estado': 'aprobado',
+        'mensaje': 'Transacción exitosa',
+        'nuevo_saldo_usuario': nuevo_saldo,
+        'nombre_usuario': tarjeta.nombre
+    }), 200
+
+def cargar_tarjeta(cursor, uid):
+    cursor.execute("""
+        SELECT t.id_usuario, t.activa, t.pin, u.nombre
+        FROM tarjetas t
+        LEFT JOIN usuarios u ON u.id = t.id_usuario
+        WHERE t.uid = %s
+    """, (uid,))
+    fila = cursor.fetchone()
+    if not fila:
+        cache_tarjetas.guardar_negativo(uid)
+        return NO_REGISTRADA
+    return cache_tarjetas.guardar(uid, fila['id_usuario'], fila['activa'], fila['pin'], fila['nombre'])
+
+# error -> (detail, código HTTP) de /transaccion
+RECHAZOS_TARJETA = {
+    'Tarjeta no encontrada': ('Tarjeta no registrada', 404),
+    'Tarjeta inactiva': ('Tarjeta bloqueada', 400),
+    'PIN incorrecto': ('PIN invalido', 401),
+}
+
+def rechazo_tarjeta(tarjeta, pin):
+    if tarjeta is NO_REGISTRADA:
+        return 'Tarjeta no encontrada'
+    if not tarjeta.activa:
+        return 'Tarjeta inactiva'
+    if not cache_tarjetas.pin_valido(tarjeta, pin):
+        return 'PIN incorrecto'
+    return None
+
+def validar_tarjeta(tarjeta, pin):
+    error = rechazo_tarjeta(tarjeta, pin)
+    if not error:
+        return None
+    detail, codigo = RECHAZOS_TARJETA[error]
+    return jsonify({
+        'error': error,
+        'estado': 'rechazado',
+        'detail': detail
+    }), codigo
+
+def respuesta_saldo_insuficiente(saldo_usuario, monto):
+    faltante = monto - saldo_usuario
+    return jsonify({
+        'error': 'Saldo insuficiente',
+        'estado': 'rechazado',
+        'detail': f'Saldo insuficiente',
+        'mensaje': f'Saldo: ${saldo_usuario:.2f} Necesita: ${monto:.2f}',
+        'saldo_actual': saldo_usuario,
+        'monto_requerido': monto,
+        'faltante': faltante
+    }), 400
+
+def crear_franjas(cursor, id_tarjetero):
+    valores = ', '.join(['(%s, %s)'] * TARJETERO_FRANJAS)
+    params = []
+    for franja in range(TARJETERO_FRANJAS):
+        params.extend((id_tarjetero, franja))
+    cursor.execute(f"INSERT IGNORE INTO tarjeteros_saldo (id_tarjetero, franja) VALUES {valores}", tuple(params))
+
+def debitar_y_acreditar(cursor, id_usuario, id_tarjetero, monto):
+    # Débito al usuario y crédito a una franja al azar del tarjetero en una sola
+    # sentencia. La fila de tarjeteros solo se lee (bloqueo compartido), así los
+    # cobros concurrentes al mismo tarjetero no se serializan. El usuario ya
+    # está bloqueado (FOR UPDATE) y su saldo validado por quien llama: si no se
+    # actualiza ninguna fila, el problema es el tarjetero.
+    franja = random.randrange(TARJETERO_FRANJAS)
+    for _ in range(2):
+        cursor.execute("""
+            UPDATE usuarios u
+            JOIN tarjeteros tar ON tar.id = %s AND tar.activo = TRUE
+            JOIN tarjeteros_saldo f ON f.id_tarjetero = tar.id AND f.franja = %s
+            SET u.saldo = u.saldo - %s,
+                f.saldo = f.saldo + %s
+            WHERE u.id = %s
+        """, (id_tarjetero, franja, monto, monto, id_usuario))
+        
+        if cursor.rowcount:
+            return None
+        
+        # Camino lento: distinguir el motivo del rechazo
+        cursor.execute("SELECT activo FROM tarjeteros WHERE id = %s", (id_tarjetero,))
+        tarjetero = cursor.fetchone()
+        if not tarjetero:
+            return 'Tarjetero no encontrado'
+        if not tarjetero['activo']:
+            return 'Tarjetero inactivo'
+        
+        # Tarjetero nuevo o con menos franjas que las configuradas
+        crear_franjas(cursor, id_tarjetero)
+    return 'Tarjetero sin franjas de saldo'
+
+def acreditar_tarjetero(cursor, id_tarjetero, monto):
+    franja = random.randrange(TARJETERO_FRANJAS)
+    for _ in range(2):
+        cursor.execute("""
+            UPDATE tarjeteros_saldo SET saldo = saldo + %s
+            WHERE id_tarjetero = %s AND franja = %s
+        """, (monto, id_tarjetero, franja))
+        if cursor.rowcount:
+            return
+        crear_franjas(cursor, id_tarjetero)
+    raise Error('Tarjetero sin franjas de saldo')
+
+def acumular_resumen(cursor, movimientos):
+    # Suma los movimientos aprobados a resumen_usuario_diario y
+    # resumen_tarjetero_diario dentro de la transacción abierta en `cursor`.
+    # movimientos: (fecha, id_usuario, id_tarjetero, tipo, monto); id_tarjetero
+    # None para transferencias. Las filas por usuario ya están protegidas por el
+    # bloqueo del usuario; las del tarjetero se reparten en franjas como su saldo.
+    por_usuario = {}
+    por_tarjetero = {}
+    franja = random.randrange(TARJETERO_FRANJAS)
+    for fecha, id_usuario, id_tarjetero, tipo, monto in movimientos:
+        dia = fecha.date()
+        clave = (id_usuario, dia, tipo, id_tarjetero or 0)
+        cantidad, total = por_usuario.get(clave, (0, 0.0))
+        por_usuario[clave] = (cantidad + 1, total + monto)
+        if id_tarjetero:
+            clave = (id_tarjetero, dia, tipo, franja)
+            cantidad, total = por_tarjetero.get(clave, (0, 0.0))
+            por_tarjetero[clave] = (cantidad + 1, total + monto)
+    
+    # Filas en orden de clave: dos lotes concurrentes las bloquean en el mismo orden
+    for tabla, columnas, filas in (
+        ('resumen_usuario_diario', 'id_usuario, dia, tipo, id_tarjetero', por_usuario),
+        ('resumen_tarjetero_diario', 'id_tarjetero, dia, tipo, franja', por_tarjetero),
+    ):
+        if not filas:
+            continue
+        params = []
+        for clave in sorted(filas):
+            cantidad, total = filas[clave]
+            params.extend((*clave, cantidad, round(total, 2)))
+        cursor.execute(f"""
+            INSERT INTO {tabla} ({columnas}, cantidad, total)
+            VALUES {', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(filas))}
+            ON DUPLICATE KEY UPDATE cantidad = cantidad + VALUES(cantidad), total = total + VALUES(total)
+        """, tuple(params))
+
+def aplicar_cobros_agrupados(cursor, cobros):
+    # Cobros de /transaccion de distintos usuarios y tarjeteros dentro de la
+    # transacción abierta en `cursor`; cobros: (id_tarjetero, id_usuario, monto, clave).
+    # Devuelve un resultado por cobro, en orden: {'error': ...} o el cobro aprobado.
+    ids_tarjetero = sorted({c[0] for c in cobros})
+    cursor.execute(f"""
+        SELECT id, activo FROM tarjeteros
+        WHERE id IN ({placeholders(len(ids_tarjetero))})
+        LOCK IN SHARE MODE
+    """, tuple(ids_tarjetero))
+    tarjeteros = {f['id']: f['activo'] for f in cursor.fetchall()}
+    
+    # Bloquear usuarios en orden de id, como aplicar_lote
+    ids_usuario = sorted({c[1] for c in cobros})
+    cursor.execute(f"""
+        SELECT id, saldo, activo FROM usuarios
+        WHERE id IN ({placeholders(len(ids_usuario))})
+        ORDER BY id
+        FOR UPDATE
+    """, tuple(ids_usuario))
+    saldos = {u['id']: (float(u['saldo']), u['activo']) for u in cursor.fetchall()}
+    
+    # Mismo orden de validación que el cobro individual, con el saldo que dejan
+    # los cobros anteriores del grupo
+    resultados = []
+    aprobados = []
+    por_tarjetero = {}
+    for id_tarjetero, id_usuario, monto, clave in cobros:
+        if id_usuario not in saldos:
+            resultados.append({'error': 'Usuario no encontrado'})
+            continue
+        saldo, activo = saldos[id_usuario]
+        if not activo:
+            resultados.append({'error': 'Usuario inactivo'})
+        elif saldo < monto:
+            resultados.append({'error': 'Saldo insuficiente', 'saldo': saldo})
+        elif id_tarjetero not in tarjeteros:
+            resultados.append({'error': 'Tarjetero no encontrado'})
+        elif not tarjeteros[id_tarjetero]:
+            resultados.append({'error': 'Tarjetero inactivo'})
+        else:
+            saldo = round(saldo - monto, 2)
+            saldos[id_usuario] = (saldo, activo)
+            por_tarjetero[id_tarjetero] = por_tarjetero.get(id_tarjetero, 0.0) + monto
+            resultado = {'nuevo_saldo': saldo}
+            resultados.append(resultado)
+            aprobados.append((resultado, id_tarjetero, id_usuario, monto, clave))
+    
+    if not aprobados:
+        return resultados
+    
+    actualizar_saldos(cursor, {a[2]: saldos[a[2]][0] for a in aprobados})
+    for id_tarjetero in sorted(por_tarjetero):
+        acreditar_tarjetero(cursor, id_tarjetero, round(por_tarjetero[id_tarjetero], 2))
+    
+    # Un INSERT por cobro: los ids de un INSERT múltiple no son necesariamente
+    # contiguos. Son idas y vueltas dentro de la transacción, sin fsync.
+    fecha = datetime.now()
+    for resultado, id_tarjetero, id_usuario, monto, clave in aprobados:
+        cursor.execute("""
+            INSERT INTO transacciones (id_tarjetero, id_usuario, monto, tipo, estado, fecha, clave)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """, (id_tarjetero, id_usuario, monto, 'cobro', 'aprobada', fecha, clave))
+        resultado['id_transaccion'] = cursor.lastrowid
+        resultado['fecha'] = fecha
+    acumular_resumen(cursor, [(fecha, id_usuario, id_tarjetero, 'cobro', monto)
+                              for _, id_tarjetero, id_usuario, monto, _ in aprobados])
+    return resultados
+
+# Group commit de /transaccion (ver commit_agrupado.py). Desactivado por
+# defecto: cada cobro espera el commit de su grupo en lugar del propio. Sin
+# efecto con MOTOR_SALDOS=1 (los cobros pasan por el motor).
+COMMIT_AGRUPADO_CONFIG = {
+    'activo': os.environ.get('COMMIT_AGRUPADO', '0') == '1',
+    'hilos': int(os.environ.get('COMMIT_AGRUPADO_HILOS', 2)),
+    'max_grupo': int(os.environ.get('COMMIT_AGRUPADO_MAX_GRUPO', 64)),
+    'espera_ms': float(os.environ.get('COMMIT_AGRUPADO_ESPERA_MS', 0)),
+    'max_cola': int(os.environ.get('COMMIT_AGRUPADO_MAX_COLA', 1000)),
+    'retry_after': int(os.environ.get('COMMIT_AGRUPADO_RETRY_AFTER', 1))
+}
+
+escritor_cobros = None
+if COMMIT_AGRUPADO_CONFIG['activo']:
+    escritor_cobros = EscritorAgrupado(get_db_connection, aplicar_cobros_agrupados,
+                                       hilos=COMMIT_AGRUPADO_CONFIG['hilos'],
+                                       max_grupo=COMMIT_AGRUPADO_CONFIG['max_grupo'],
+                                       espera_ms=COMMIT_AGRUPADO_CONFIG['espera_ms'],
+                                       max_cola=COMMIT_AGRUPADO_CONFIG['max_cola'],
+                                       retry_after=COMMIT_AGRUPADO_CONFIG['retry_after'])
+
+def firma_cobro(clave_firma, id_tarjetero, item):
+    # Mismo formato que firmarCobro() en app.ino
+    mensaje = f"{id_tarjetero}|{item['clave']}|{item['uid_tarjeta']}|{item['pin']}|{float(item['monto']):.2f}"
+    return hmac.new(clave_firma.encode('utf-8'), mensaje.encode('utf-8'), hashlib.sha256).hexdigest()
+
+def validar_item_lote(item):
+    if not isinstance(item, dict):
+        return 'Item inválido'
+    clave = item.get('clave')
+    if not isinstance(clave, str) or not 0 < len(clave) <= 64:
+        return 'Clave inválida'
+    if not isinstance(item.get('uid_tarjeta'), str) or not isinstance(item.get('pin'), str):
+        return 'Faltan uid_tarjeta o pin'
+    valido, error = validar_pin(item['pin'])
+    if not valido:
+        return error
+    valido, error = validar_monto(item.get('monto'))
+    if not valido:
+        return error
+    antiguedad = item.get('antiguedad', 0)
+    if not isinstance(antiguedad, int) or antiguedad < 0:
+        return 'Antigüedad inválida'
+    return None
+
+def placeholders(n):
+    return ', '.join(['%s'] * n)
+
+def actualizar_saldos(cursor, saldos):
+    # saldos: id_usuario -> saldo final, en un solo UPDATE
+    afectados = sorted(saldos)
+    casos = ' '.join(['WHEN %s THEN %s'] * len(afectados))
+    params = []
+    for id_usuario in afectados:
+        params.extend((id_usuario, saldos[id_usuario]))
+    cursor.execute(f"""
+        UPDATE usuarios SET saldo = CASE id {casos} END
+        WHERE id IN ({placeholders(len(afectados))})
+    """, (*params, *afectados))
+
+def aplicar_lote(cursor, id_tarjetero, items, movidos=None):
+    # Aplica el lote dentro de la transacción abierta en `cursor`. Devuelve
+    # (resultados por item en el orden recibido, movimientos a publicar tras el
+    # commit, error del lote). Lanza IntegrityError si otra subida insertó las
+    # mismas claves. Con el motor de saldos los cobros se mueven en memoria y se
+    # agregan a `movidos`: quien llama los revierte si la transacción falla.
+    resultados = [{'clave': item.get('clave') if isinstance(item, dict) else None} for item in items]
+    
+    cursor.execute("SELECT activo, clave_firma FROM tarjeteros WHERE id = %s LOCK IN SHARE MODE", (id_tarjetero,))
+    tarjetero = cursor.fetchone()
+    if not tarjetero:
+        return None, None, 'Tarjetero no encontrado'
+    if not tarjetero['activo']:
+        return None, None, 'Tarjetero inactivo'
+    if not tarjetero['clave_firma']:
+        return None, None, 'Tarjetero sin clave de firma'
+    
+    # Validación, firma y claves repetidas dentro del mismo lote
+    pendientes = []
+    vistas = set()
+    for i, item in enumerate(items):
+        error = validar_item_lote(item)
+        if not error and not hmac.compare_digest(str(item.get('firma', '')),
+                                                 firma_cobro(tarjetero['clave_firma'], id_tarjetero, item)):
+            error = 'Firma inválida'
+        if not error and item['clave'] in vistas:
+            error = 'Clave repetida en el lote'
+        if error:
+            resultados[i].update(estado='rechazada', error=error)
+            continue
+        vistas.add(item['clave'])
+        pendientes.append(i)
+    
+    # Claves ya aplicadas en subidas anteriores
+    if pendientes:
+        claves = [items[i]['clave'] for i in pendientes]
+        cursor.execute(f"""
+            SELECT clave, id, estado FROM transacciones
+            WHERE id_tarjetero = %s AND clave IN ({placeholders(len(claves))})
+        """, (id_tarjetero, *claves))
+        previas = {f['clave']: f for f in cursor.fetchall()}
+        nuevos = []
+        for i in pendientes:
+            previa = previas.get(items[i]['clave'])
+            if previa:
+                resultados[i].update(estado='duplicada', id_transaccion=previa['id'], estado_original=previa['estado'])
+            else:
+                nuevos.append(i)
+        pendientes = nuevos
+    
+    # Tarjetas: caché primero, el resto en una sola consulta
+    tarjetas = {}
+    faltantes = set()
+    for i in pendientes:
+        uid = items[i]['uid_tarjeta']
+        tarjeta = cache_tarjetas.obtener(uid)
+        if tarjeta is None:
+            faltantes.add(uid)
+        else:
+            tarjetas[uid] = tarjeta
+    if faltantes:
+        cursor.execute(f"""
+            SELECT t.uid, t.id_usuario, t.activa, t.pin, u.nombre
+            FROM tarjetas t
+            LEFT JOIN usuarios u ON u.id = t.id_usuario
+            WHERE t.uid IN ({placeholders(len(faltantes))})
+        """, tuple(faltantes))
+        # La comparación de uid en MySQL no distingue mayúsculas
+        encontradas = {f['uid'].upper(): f for f in cursor.fetchall()}
+        for uid in faltantes:
+            fila = encontradas.get(uid.upper())
+            if fila:
+                tarjetas[uid] = cache_tarjetas.guardar(uid, fila['id_usuario'], fila['activa'], fila['pin'], fila['nombre'])
+            else:
+                cache_tarjetas.guardar_negativo(uid)
+                tarjetas[uid] = NO_REGISTRADA
+    
+    cobros = []
+    for i in pendientes:
+        error = rechazo_tarjeta(tarjetas[items[i]['uid_tarjeta']], items[i]['pin'])
+        if error:
+            resultados[i].update(estado='rechazada', error=error)
+        else:
+            cobros.append(i)
+    
+    # Bloquear usuarios en orden de id para no cruzarse con otros lotes (con el
+    # motor de saldos no hace falta: el saldo no se toca en MySQL)
+    saldos = {}
+    ids_usuario = sorted({tarjetas[items[i]['uid_tarjeta']].id_usuario for i in cobros})
+    if ids_usuario:
+        cursor.execute(f"""
+            SELECT id, saldo, activo FROM usuarios
+            WHERE id IN ({placeholders(len(ids_usuario))})
+            ORDER BY id
+            {'' if motor_saldos else 'FOR UPDATE'}
+        """, tuple(ids_usuario))
+        saldos = {u['id']: (float(u['saldo']), u['activo']) for u in cursor.fetchall()}
+    
+    ahora = datetime.now()
+    filas = []
+    movimientos = []
+    total = 0.0
+    for i in cobros:
+        item = items[i]
+        id_usuario = tarjetas[item['uid_tarjeta']].id_usuario
+        monto = float(item['monto'])
+        # Segundos entre la lectura de la tarjeta y la subida del lote
+        fecha = ahora - timedelta(seconds=min(item.get('antiguedad', 0), LOTE_CONFIG['antiguedad_max']))
+        
+        if id_usuario not in saldos:
+            resultados[i].update(estado='rechazada', error='Usuario no encontrado')
+            continue
+        saldo, activo = saldos[id_usuario]
+        error = None
+        if not activo:
+            error = 'Usuario inactivo'
+        elif motor_saldos:
+            try:
+                movimiento = motor_saldos.cobrar(id_usuario, id_tarjetero, monto, cursor, durable=False)
+                movidos.append(movimiento)
+                saldo = movimiento.saldos[0]
+            except SaldoInsuficiente:
+                error = 'Saldo insuficiente'
+        elif saldo < monto:
+            error = 'Saldo insuficiente'
+        else:
+            saldo = round(saldo - monto, 2)
+        
+        if error:
+            # Se registra rechazada para que reenviar la clave dé el mismo resultado
+            resultados[i].update(estado='rechazada', error=error)
+            filas.append((i, (id_tarjetero, id_usuario, monto, 'cobro', 'rechazada', fecha, error, item['clave'], None)))
+            continue
+        
+        saldos[id_usuario] = (saldo, activo)
+        total += monto
+        resultados[i].update(estado='aprobada', nuevo_saldo_usuario=saldo)
+        secuencia = movidos[-1].secuencia if motor_saldos else None
+        filas.append((i, (id_tarjetero, id_usuario, monto, 'cobro', 'aprobada', fecha, None, item['clave'], secuencia)))
+        movimientos.append((i, id_usuario, saldo, monto, fecha))
+    
+    if movimientos:
+        if motor_saldos:
+            # Una sola escritura del log para todo el lote
+            motor_saldos.esperar_durable(movidos[-1].secuencia)
+        else:
+            actualizar_saldos(cursor, {m[1]: saldos[m[1]][0] for m in movimientos})
+            acreditar_tarjetero(cursor, id_tarjetero, round(total, 2))
+        acumular_resumen(cursor, [(fecha, id_usuario, id_tarjetero, 'cobro', monto)
+                                  for _, id_usuario, _, monto, fecha in movimientos])
+    
+    if filas:
+        cursor.execute(f"""
+            INSERT INTO transacciones (id_tarjetero, id_usuario, monto, tipo, estado, fecha, descripcion, clave, secuencia_motor)
+            VALUES {', '.join(['(%s, %s, %s, %s, %s, %s, %s, %s, %s)'] * len(filas))}
+        """, tuple(v for _, fila in filas for v in fila))
+        
+        # Los ids autoincrementales de un INSERT múltiple no son necesariamente contiguos
+        claves = [items[i]['clave'] for i, _ in filas]
+        cursor.execute(f"""
+            SELECT clave, id FROM transacciones
+            WHERE id_tarjetero = %s AND clave IN ({placeholders(len(claves))})
+        """, (id_tarjetero, *claves))
+        ids = {f['clave']: f['id'] for f in cursor.fetchall()}
+        for i, _ in filas:
+            resultados[i]['id_transaccion'] = ids.get(items[i]['clave'])
+    
+    publicar = [(id_usuario, saldo, {
+        'id': resultados[i]['id_transaccion'],
+        'monto': monto,
+        'tipo': 'cobro',
+        'estado': 'aprobada',
+        'fecha': fecha.isoformat(),
+        'descripcion': None,
+        'tarjetero': None,
+        'categoria': 'transaccion'
+    }) for i, id_usuario, saldo, monto, fecha in movimientos]
+    return resultados, publicar, None
+
+# Errores que rechazan el lote completo -> código HTTP
+ERRORES_LOTE = {
+    'Tarjetero no encontrado': 404,
+    'Tarjetero inactivo': 400,
+    'Tarjetero sin clave de firma': 403,
+}
+
+@app.route('/transacciones/lote', methods=['POST'])
+def transacciones_lote():
+    data = request.get_json()
+    id_tarjetero = data.get('id_tarjetero')
+    items = data.get('transacciones')
+    
+    if not id_tarjetero:
+        return jsonify({'error': 'Falta id_tarjetero'}), 400
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'transacciones debe ser una lista no vacía'}), 400
+    if len(items) > LOTE_CONFIG['max_items']:
+        return jsonify({'error': f"Máximo {LOTE_CONFIG['max_items']} transacciones por lote"}), 400
+    
+    conn = get_db_connection()
+    cursor = conn.cursor(dictionary=True)
+    
+    try:
+        # Un reintento: si otra subida del mismo lote ganó la carrera, la segunda
+        # pasada ve esas claves como duplicadas
+        for intento in range(2):
+            movidos = []
+            try:
+                resultados, publicar, error = aplicar_lote(cursor, id_tarjetero, items, movidos)
+                if error:
+                    conn.rollback()
+                    return jsonify({'error': error}), ERRORES_LOTE[error]
+                confirmar_movimientos(conn, movidos)
+                break
+            except (Error, CuentaNoEncontrada, MotorAveriado) as e:
+                conn.rollback()
+                revertir_movimientos(movidos)
+                if intento or not isinstance(e, IntegrityError):
+                    raise
+        
+        if publicar:
+            cache_recursos.invalidar(('tarjetero', int(id_tarjetero)))
+        for id_usuario, saldo, movimiento in publicar:
+            publicar_movimiento(id_usuario, saldo, movimiento)
         
         return jsonify({
-            'estado': 'aprobado',
-            'mensaje': 'Transacción exitosa',
-            'nuevo_saldo_usuario': nuevo_saldo_usuario,
-            'nombre_usuario': nombre_usuario
+            'resultados': resultados,
+            'aprobadas': sum(1 for r in resultados if r.get('estado') == 'aprobada'),
+            'rechazadas': sum(1 for r in resultados if r.get('estado') == 'rechazada'),
+            'duplicadas': sum(1 for r in resultados if r.get('estado') == 'duplicada')
         }), 200
         
-    except Error as e:
+    except (Error, CuentaNoEncontrada, MotorAveriado) as e:
         conn.rollback()
         return jsonify({'error': str(e)}), 500
     finally:
         cursor.close()
         conn.close()
 
+def ultimas_transacciones_tarjetero(cursor, id_tarjetero, limite=5):
+    # Cubierta por idx_tarjetero_fecha (id_tarjetero, fecha, id_usuario, monto)
+    cursor.execute("""
+        SELECT t.monto, t.fecha, u.nombre as usuario
+        FROM transacciones t
+        JOIN usuarios u ON t.id_usuario = u.id
+        WHERE t.id_tarjetero = %s
+        ORDER BY t.fecha DESC
+        LIMIT %s
+    """, (id_tarjetero, limite))
+    return cursor.fetchall()
+
 @app.route('/tarjetero/<int:id_tarjetero>', methods=['GET'])
 def obtener_info_tarjetero(id_tarjetero):
+    recurso = ('tarjetero', id_tarjetero)
+    cacheada = recurso_cacheado(recurso)
+    if cacheada:
+        return cacheada
+    version = cache_recursos.version(recurso)
+    
     conn = get_db_connection()
     cursor = conn.cursor(dictionary=True)
     
     try:
-        cursor.execute("SELECT * FROM tarjeteros WHERE id = %s", (id_tarjetero,))
+        # Saldo total = consolidado + suma de franjas
+        cursor.execute("""
+            SELECT tar.id, tar.nombre, tar.ubicacion, tar.fecha_creacion, tar.activo,
+                   tar.saldo + COALESCE(SUM(f.saldo), 0) AS saldo
+            FROM tarjeteros tar
+            LEFT JOIN tarjeteros_saldo f ON f.id_tarjetero = tar.id
+            WHERE tar.id = %s
+            GROUP BY tar.id
+        """, (id_tarjetero,))
         tarjetero = cursor.fetchone()
         
         if not tarjetero:
             return jsonify({'error': 'Tarjetero no encontrado'}), 404
         
-        cursor.execute("""
-            SELECT t.monto, t.fecha, u.nombre as usuario
-            FROM transacciones t
-            JOIN usuarios u ON t.id_usuario = u.id
-            WHERE t.id_tarjetero = %s
-            ORDER BY t.fecha DESC
-            LIMIT 5
-        """, (id_tarjetero,))
-        transacciones = cursor.fetchall()
+        tarjetero['saldo'] = saldo_vigente(TARJETERO, tarjetero['id'], tarjetero['saldo'])
+        
+        transacciones = ultimas_transacciones_tarjetero(cursor, id_tarjetero)
         
         # Convertir fechas a string para serialización JSON
         for trans in transacciones:
             if trans['fecha']:
                 trans['fecha'] = trans['fecha'].isoformat()
         
-        return jsonify({
+        return recurso_nuevo(recurso, version, {
             'tarjetero': tarjetero,
             'ultimas_transacciones': transacciones
-        }), 200
+        })
         
     finally:
         cursor.close()
@@ -337,24 +1364,29 @@ def consultar_saldo():
     if not uid_tarjeta:
         return jsonify({'error': 'Falta uid_tarjeta'}), 400
     
+    tarjeta = cache_tarjetas.obtener(uid_tarjeta)
+    if tarjeta is NO_REGISTRADA:
+        return jsonify({'error': 'Tarjeta no encontrada'}), 404
+    
     conn = get_db_connection()
     cursor = conn.cursor(dictionary=True)
     
     try:
-        cursor.execute("""
-            SELECT u.saldo, u.nombre
-            FROM tarjetas t
-            JOIN usuarios u ON t.id_usuario = u.id
-            WHERE t.uid = %s
-        """, (uid_tarjeta,))
+        if tarjeta is None:
+            tarjeta = cargar_tarjeta(cursor, uid_tarjeta)
+            if tarjeta is NO_REGISTRADA:
+                return jsonify({'error': 'Tarjeta no encontrada'}), 404
+        
+        # El nombre sale de la caché; solo el saldo se lee en cada consulta
+        cursor.execute("SELECT saldo FROM usuarios WHERE id = %s", (tarjeta.id_usuario,))
         resultado = cursor.fetchone()
         
         if not resultado:
             return jsonify({'error': 'Tarjeta no encontrada'}), 404
         
         return jsonify({
-            'saldo': float(resultado['saldo']),
-            'nombre': resultado['nombre']
+            'saldo': saldo_vigente(USUARIO, tarjeta.id_usuario, resultado['saldo']),
+            'nombre': tarjeta.nombre
         }), 200
         
     except Exception as e:
@@ -377,6 +1409,35 @@ def admin_panel():
     return render_template('admin.html')
 
 # ============= AUTENTICACIÓN =============
+def buscar_usuario_login(cursor, username):
+    # Una rama por tipo de identificador, cada una con su índice (idx_ci,
+    # idx_email, idx_nombre); un OR entre las tres columnas recorre la tabla.
+    # Si el valor coincide con varios, gana CI, luego email, luego nombre.
+    cursor.execute("""
+        (SELECT id, ci, nombre, email, password_hash, saldo, activo, 0 AS prioridad
+         FROM usuarios WHERE ci = %s)
+        UNION ALL
+        (SELECT id, ci, nombre, email, password_hash, saldo, activo, 1 AS prioridad
+         FROM usuarios WHERE email = %s)
+        UNION ALL
+        (SELECT id, ci, nombre, email, password_hash, saldo, activo, 2 AS prioridad
+         FROM usuarios WHERE nombre = %s)
+        ORDER BY prioridad
+        LIMIT 1
+    """, (username, username, username))
+    return cursor.fetchone()
+
+def guardar_password_hash(user_id, password_hash):
+    # Conexión propia y corta: el hash ya se calculó sin retener una del pool
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("UPDATE usuarios SET password_hash = %s WHERE id = %s", (password_hash, user_id))
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+
 @app.route('/api/login', methods=['POST'])
 def login():
     data = request.get_json()
@@ -386,18 +1447,21 @@ def login():
     if not username or not password:
         return jsonify({'error': 'Usuario y contraseña requeridos'}), 400
     
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    
     try:
-        # Buscar usuario por CI, email o nombre
-        cursor.execute("""
-            SELECT id, ci, nombre, email, password_hash, saldo, activo
-            FROM usuarios 
-            WHERE (ci = %s OR email = %s OR nombre = %s)
-        """, (username, username, username))
-        
-        user = cursor.fetchone()
+        # La conexión se devuelve antes de bcrypt: una ráfaga de logins no
+        # debe dejar sin conexiones a los cobros mientras espera el hashing
+        conn = get_db_connection()
+        cursor = conn.cursor(dictionary=True)
+        try:
+            user = buscar_usuario_login(cursor, username)
+            pin_tarjeta = None
+            if user and not user.get('password_hash'):
+                cursor.execute("SELECT pin FROM tarjetas WHERE id_usuario = %s LIMIT 1", (user['id'],))
+                tarjeta = cursor.fetchone()
+                pin_tarjeta = tarjeta['pin'] if tarjeta else None
+        finally:
+            cursor.close()
+            conn.close()
         
         if not user:
             print(f" Usuario no encontrado: {username}")
@@ -412,19 +1476,19 @@ def login():
         
         if user.get('password_hash'):
             try:
-                password_valida = bcrypt.checkpw(password.encode('utf-8'), user['password_hash'].encode('utf-8'))
+                password_valida = hasher.verificar(password, user['password_hash'])
                 if not password_valida:
                     print(f" Contraseña incorrecta para: {user['nombre']} (CI: {user['ci']})")
                 else:
                     print(f"Login exitoso: {user['nombre']} (CI: {user['ci']})")
+            except HashSaturado as e:
+                return respuesta_saturado(e)
             except Exception as e:
                 print(f" Error verificando hash: {e}")
                 return jsonify({'error': 'Error al verificar contraseña'}), 500
         else:
             # Si no tiene password_hash, usar el PIN de la tarjeta
-            cursor.execute("SELECT pin FROM tarjetas WHERE id_usuario = %s LIMIT 1", (user['id'],))
-            tarjeta = cursor.fetchone()
-            if tarjeta and tarjeta['pin'] == password:
+            if pin_tarjeta is not None and pin_tarjeta == password:
                 password_valida = True
                 print(f"✅ Login con PIN de tarjeta: {user['nombre']}")
             else:
@@ -433,9 +1497,16 @@ def login():
         if not password_valida:
             return jsonify({'error': 'Contraseña incorrecta. Intenta nuevamente.'}), 401
         
+        # Rehash si el costo guardado no coincide con BCRYPT_COSTO
+        if user.get('password_hash') and hasher.necesita_rehash(user['password_hash']):
+            try:
+                guardar_password_hash(user['id'], hasher.generar_hash(password))
+            except HashSaturado:
+                pass  # se reintenta en el próximo login
+        
         # Crear token simple
         access_token = generar_token()
-        active_sessions[access_token] = user['id']
+        sesiones.crear(access_token, user['id'])
         
         print(f"Token generado para {user['nombre']}")
         
@@ -446,16 +1517,13 @@ def login():
                 'nombre': user['nombre'],
                 'email': user['email'],
                 'ci': user['ci'],
-                'saldo': float(user['saldo'])
+                'saldo': saldo_vigente(USUARIO, user['id'], user['saldo'])
             }
         }), 200
         
     except Exception as e:
         print(f"Error en login: {e}")
         return jsonify({'error': f'Error del servidor: {str(e)}'}), 500
-    finally:
-        cursor.close()
-        conn.close()
 
 @app.route('/api/cambiar_password', methods=['POST'])
 @auth_required
@@ -468,44 +1536,48 @@ def cambiar_password():
     if not password_actual or not password_nueva:
         return jsonify({'error': 'Contraseñas requeridas'}), 400
     
-    if len(password_nueva) < 6:
-        return jsonify({'error': 'Contraseña debe tener al menos 6 caracteres'}), 400
-    
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
+    if len(password_nueva) < 6:
+        return jsonify({'error': 'Contraseña debe tener al menos 6 caracteres'}), 400
     
     try:
-        cursor.execute("SELECT password_hash FROM usuarios WHERE id = %s", (user_id,))
-        user = cursor.fetchone()
+        # Igual que en login: sin conexión prestada mientras corre bcrypt
+        conn = get_db_connection()
+        cursor = conn.cursor(dictionary=True)
+        try:
+            cursor.execute("SELECT password_hash FROM usuarios WHERE id = %s", (user_id,))
+            user = cursor.fetchone()
+        finally:
+            cursor.close()
+            conn.close()
         
         if not user:
             return jsonify({'error': 'Usuario no encontrado'}), 404
         
         # Verificar contraseña actual
         if user.get('password_hash'):
-            if not bcrypt.checkpw(password_actual.encode('utf-8'), user['password_hash'].encode('utf-8')):
+            if not hasher.verificar(password_actual, user['password_hash']):
                 return jsonify({'error': 'Contraseña actual incorrecta'}), 401
         
         # Hash nueva contraseña
-        password_hash = bcrypt.hashpw(password_nueva.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-        
-        cursor.execute("UPDATE usuarios SET password_hash = %s WHERE id = %s", (password_hash, user_id))
-        conn.commit()
+        guardar_password_hash(user_id, hasher.generar_hash(password_nueva))
         
         return jsonify({'mensaje': 'Contraseña actualizada exitosamente'}), 200
         
+    except HashSaturado as e:
+        return respuesta_saturado(e)
     except Exception as e:
-        conn.rollback()
         return jsonify({'error': str(e)}), 500
-    finally:
-        cursor.close()
-        conn.close()
 
 # ============= PERFIL DE USUARIO =============
 @app.route('/api/perfil', methods=['GET'])
 @auth_required
 def obtener_perfil():
     user_id = request.user_id
+    recurso = ('perfil', user_id)
+    cacheada = recurso_cacheado(recurso, privada=True)
+    if cacheada:
+        return cacheada
+    version = cache_recursos.version(recurso)
     
     conn = get_db_connection()
     cursor = conn.cursor(dictionary=True)
@@ -531,14 +1603,14 @@ def obtener_perfil():
         """, (user_id,))
         tarjetas = cursor.fetchall()
         
-        return jsonify({
+        return recurso_nuevo(recurso, version, {
             'usuario': {
                 'id': user['id'],
                 'ci': user['ci'],
                 'nombre': user['nombre'],
                 'email': user['email'],
                 'telefono': user['telefono'],
-                'saldo': float(user['saldo']),
+                'saldo': saldo_vigente(USUARIO, user['id'], user['saldo']),
                 'fecha_registro': user['fecha_registro'].isoformat() if user['fecha_registro'] else None,
                 'activo': bool(user['activo'])
             },
@@ -548,115 +1620,337 @@ def obtener_perfil():
                 'activa': bool(t['activa']),
                 'fecha_registro': t['fecha_registro'].isoformat() if t['fecha_registro'] else None
             } for t in tarjetas]
-        }), 200
+        }, privada=True)
         
     finally:
         cursor.close()
         conn.close()
 
+HISTORIAL_LIMITE_MAX = 200
+
+# Cada rama del historial tiene un orden fijo para desempatar filas con la misma fecha
+# (los ids de transacciones y transferencias pueden coincidir).
+HISTORIAL_RAMAS = [
+    (2, """
+            SELECT t.id, t.monto, t.tipo, t.estado, t.fecha, t.descripcion,
+                   tar.nombre AS tarjetero_nombre, NULL AS contraparte_nombre,
+                   NULL AS contraparte_ci, 2 AS orden
+            FROM {transacciones} t
+            LEFT JOIN tarjeteros tar ON t.id_tarjetero = tar.id
+            WHERE t.id_usuario = %s {filtro}
+            ORDER BY t.fecha DESC, t.id DESC
+            LIMIT %s""", 't'),
+    (1, """
+            SELECT tf.id, tf.monto, 'transferencia_enviada' AS tipo, 'completada' AS estado,
+                   tf.fecha, tf.descripcion, NULL AS tarjetero_nombre,
+                   u.nombre AS contraparte_nombre, u.ci AS contraparte_ci, 1 AS orden
+            FROM {transferencias} tf
+            INNER JOIN usuarios u ON tf.id_destino = u.id
+            WHERE tf.id_origen = %s {filtro}
+            ORDER BY tf.fecha DESC, tf.id DESC
+            LIMIT %s""", 'tf'),
+    (0, """
+            SELECT tf.id, tf.monto, 'transferencia_recibida' AS tipo, 'completada' AS estado,
+                   tf.fecha, tf.descripcion, NULL AS tarjetero_nombre,
+                   u.nombre AS contraparte_nombre, u.ci AS contraparte_ci, 0 AS orden
+            FROM {transferencias} tf
+            INNER JOIN usuarios u ON tf.id_origen = u.id
+            WHERE tf.id_destino = %s {filtro}
+            ORDER BY tf.fecha DESC, tf.id DESC
+            LIMIT %s""", 'tf'),
+]
+
+def codificar_cursor(fila):
+    crudo = json.dumps([fila['fecha'].isoformat(), fila['orden'], fila['id']])
+    return base64.urlsafe_b64encode(crudo.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decodificar_cursor(token):
+    try:
+        relleno = '=' * (-len(token) % 4)
+        fecha, orden, id_fila = json.loads(base64.urlsafe_b64decode(token + relleno))
+        return datetime.fromisoformat(fecha), int(orden), int(id_fila)
+    except (ValueError, TypeError):
+        return None
+
+def filtro_keyset(alias, orden_rama, cursor_pos):
+    # Traduce "(fecha, orden, id) < cursor" a un rango sobre (fecha, id) de cada rama
+    # para que cada SELECT siga usando su índice.
+    if not cursor_pos:
+        return '', ()
+    fecha, orden, id_fila = cursor_pos
+    if orden_rama < orden:
+        return f'AND {alias}.fecha <= %s', (fecha,)
+    if orden_rama > orden:
+        return f'AND {alias}.fecha < %s', (fecha,)
+    return f'AND ({alias}.fecha < %s OR ({alias}.fecha = %s AND {alias}.id < %s))', (fecha, fecha, id_fila)
+
+# Tablas vivas y de archivo (ver archivo_historial.py)
+HISTORIAL_TABLAS_VIVAS = {'transacciones': 'transacciones', 'transferencias': 'transferencias'}
+HISTORIAL_TABLAS_ARCHIVO = {'transacciones': 'transacciones_archivo', 'transferencias': 'transferencias_archivo'}
+
+def consultar_ramas(cursor, tablas, user_id, limite, cursor_pos):
+    # Une las tres fuentes del historial en una sola consulta; cada rama lee
+    # como máximo limite + 1 filas, así el costo depende del tamaño de página.
+    partes = []
+    params = []
+    for orden_rama, sql, alias in HISTORIAL_RAMAS:
+        filtro, filtro_params = filtro_keyset(alias, orden_rama, cursor_pos)
+        partes.append('(' + sql.format(filtro=filtro, **tablas) + ')')
+        params.extend((user_id,) + filtro_params + (limite + 1,))
+    
+    cursor.execute(
+        '\n            UNION ALL\n'.join(partes) +
+        '\n            ORDER BY fecha DESC, orden DESC, id DESC\n            LIMIT %s',
+        tuple(params) + (limite + 1,)
+    )
+    return cursor.fetchall()
+
+def consultar_historial(cursor, user_id, limite, cursor_pos=None):
+    # Primero las tablas vivas; solo si la página pasa su final se completa con
+    # el archivo. Las dos lecturas comparten la instantánea de la transacción,
+    # así una fila que se está archivando no aparece dos veces ni se pierde.
+    filas = consultar_ramas(cursor, HISTORIAL_TABLAS_VIVAS, user_id, limite, cursor_pos)
+    if len(filas) <= limite:
+        filas += consultar_ramas(cursor, HISTORIAL_TABLAS_ARCHIVO, user_id, limite, cursor_pos)
+        filas.sort(key=lambda f: (f['fecha'], f['orden'], f['id']), reverse=True)
+    
+    siguiente = None
+    if len(filas) > limite:
+        filas = filas[:limite]
+        siguiente = codificar_cursor(filas[-1])
+    return filas, siguiente
+
+def formatear_movimiento(fila):
+    movimiento = {
+        'id': fila['id'],
+        'monto': float(fila['monto']),
+        'tipo': fila['tipo'],
+        'estado': fila['estado'],
+        'fecha': fila['fecha'].isoformat() if fila['fecha'] else None,
+        'descripcion': fila['descripcion']
+    }
+    if fila['orden'] == 2:
+        movimiento['tarjetero'] = fila['tarjetero_nombre']
+        movimiento['categoria'] = 'transaccion'
+    elif fila['orden'] == 1:
+        movimiento['destinatario'] = f"{fila['contraparte_nombre']} (CI: {fila['contraparte_ci']})"
+        movimiento['categoria'] = 'transferencia'
+    else:
+        movimiento['remitente'] = f"{fila['contraparte_nombre']} (CI: {fila['contraparte_ci']})"
+        movimiento['categoria'] = 'transferencia'
+    return movimiento
+
 @app.route('/api/historial_transacciones', methods=['GET'])
 @auth_required
 def historial_transacciones():
     user_id = request.user_id
     limite = request.args.get('limite', 50, type=int)
+    limite = max(1, min(limite, HISTORIAL_LIMITE_MAX))
+    
+    cursor_pos = None
+    token_cursor = request.args.get('cursor')
+    if token_cursor:
+        cursor_pos = decodificar_cursor(token_cursor)
+        if not cursor_pos:
+            return jsonify({'error': 'Cursor inválido'}), 400
     
     conn = get_db_connection()
     cursor = conn.cursor(dictionary=True)
     
     try:
-        # Obtener transacciones normales (recargas y pagos RFID)
-        cursor.execute("""
-            SELECT t.id, t.monto, t.tipo, t.estado, t.fecha, t.descripcion,
-                   tar.nombre as tarjetero_nombre
-            FROM transacciones t
-            LEFT JOIN tarjeteros tar ON t.id_tarjetero = tar.id
-            WHERE t.id_usuario = %s
-            ORDER BY t.fecha DESC
-        """, (user_id,))
-        
-        transacciones = cursor.fetchall()
-        
-        # Obtener transferencias enviadas
-        cursor.execute("""
-            SELECT tf.id, tf.monto, tf.fecha, tf.descripcion,
-                   u.nombre as destinatario_nombre, u.ci as destinatario_ci
-            FROM transferencias tf
-            INNER JOIN usuarios u ON tf.id_destino = u.id
-            WHERE tf.id_origen = %s
-            ORDER BY tf.fecha DESC
-        """, (user_id,))
-        
-        transferencias_enviadas = cursor.fetchall()
-        
-        # Obtener transferencias recibidas
-        cursor.execute("""
-            SELECT tf.id, tf.monto, tf.fecha, tf.descripcion,
-                   u.nombre as remitente_nombre, u.ci as remitente_ci
-            FROM transferencias tf
-            INNER JOIN usuarios u ON tf.id_origen = u.id
-            WHERE tf.id_destino = %s
-            ORDER BY tf.fecha DESC
-        """, (user_id,))
-        
-        transferencias_recibidas = cursor.fetchall()
-        
-        # Combinar todas las transacciones
-        historial = []
-        
-        # Agregar transacciones normales
-        for tr in transacciones:
-            historial.append({
-                'id': tr['id'],
-                'monto': float(tr['monto']),
-                'tipo': tr['tipo'],
-                'estado': tr['estado'],
-                'fecha': tr['fecha'].isoformat() if tr['fecha'] else None,
-                'descripcion': tr['descripcion'],
-                'tarjetero': tr['tarjetero_nombre'],
-                'categoria': 'transaccion'
-            })
-        
-        # Agregar transferencias enviadas
-        for tf in transferencias_enviadas:
-            historial.append({
-                'id': tf['id'],
-                'monto': float(tf['monto']),
-                'tipo': 'transferencia_enviada',
-                'estado': 'completada',
-                'fecha': tf['fecha'].isoformat() if tf['fecha'] else None,
-                'descripcion': tf['descripcion'],
-                'destinatario': f"{tf['destinatario_nombre']} (CI: {tf['destinatario_ci']})",
-                'categoria': 'transferencia'
-            })
-        
-        # Agregar transferencias recibidas
-        for tf in transferencias_recibidas:
-            historial.append({
-                'id': tf['id'],
-                'monto': float(tf['monto']),
-                'tipo': 'transferencia_recibida',
-                'estado': 'completada',
-                'fecha': tf['fecha'].isoformat() if tf['fecha'] else None,
-                'descripcion': tf['descripcion'],
-                'remitente': f"{tf['remitente_nombre']} (CI: {tf['remitente_ci']})",
-                'categoria': 'transferencia'
-            })
-        
-        # Ordenar por fecha descendente y limitar
-        historial.sort(key=lambda x: x['fecha'] if x['fecha'] else '', reverse=True)
-        historial = historial[:limite]
+        filas, siguiente = consultar_historial(cursor, user_id, limite, cursor_pos)
         
         return jsonify({
-            'transacciones': historial
+            'transacciones': [formatear_movimiento(f) for f in filas],
+            'next_cursor': siguiente
         }), 200
+    
+    finally:
+        cursor.close()
+        conn.close()
+
+# ============= RESUMEN DIARIO =============
+# Leen las tablas resumen_*_diario (ver acumular_resumen): un año de reporte
+# recorre ~365 filas por tipo, no todas las transacciones.
+RESUMEN_DIAS_DEFECTO = 30
+RESUMEN_DIAS_MAX = 731
+
+def rango_fechas(dias_defecto=RESUMEN_DIAS_DEFECTO, dias_max=RESUMEN_DIAS_MAX):
+    # (desde, hasta, error) a partir de ?desde=AAAA-MM-DD&hasta=AAAA-MM-DD
+    try:
+        hasta = request.args.get('hasta')
+        hasta = datetime.strptime(hasta, '%Y-%m-%d').date() if hasta else datetime.now().date()
+        desde = request.args.get('desde')
+        desde = (datetime.strptime(desde, '%Y-%m-%d').date() if desde
+                 else hasta - timedelta(days=dias_defecto - 1))
+    except ValueError:
+        return None, None, 'Fecha inválida, usar AAAA-MM-DD'
+    if desde > hasta:
+        return None, None, 'desde debe ser anterior a hasta'
+    if (hasta - desde).days >= dias_max:
+        return None, None, f'Máximo {dias_max} días por consulta'
+    return desde, hasta, None
+
+def consultar_resumen_usuario(cursor, user_id, desde, hasta):
+    # Rango sobre la PRIMARY KEY (id_usuario, dia, ...)
+    cursor.execute("""
+        SELECT dia, tipo, SUM(cantidad) AS cantidad, SUM(total) AS total
+        FROM resumen_usuario_diario
+        WHERE id_usuario = %s AND dia BETWEEN %s AND %s
+        GROUP BY dia, tipo
+        ORDER BY dia
+    """, (user_id, desde, hasta))
+    return cursor.fetchall()
+
+def consultar_resumen_tarjetero(cursor, id_tarjetero, desde, hasta):
+    # Rango sobre la PRIMARY KEY (id_tarjetero, dia, ...); suma las franjas
+    cursor.execute("""
+        SELECT dia, tipo, SUM(cantidad) AS cantidad, SUM(total) AS total
+        FROM resumen_tarjetero_diario
+        WHERE id_tarjetero = %s AND dia BETWEEN %s AND %s
+        GROUP BY dia, tipo
+        ORDER BY dia
+    """, (id_tarjetero, desde, hasta))
+    return cursor.fetchall()
+
+def formatear_resumen(filas, desde, hasta):
+    # filas: (dia, tipo, cantidad, total) ordenadas por día
+    dias = {}
+    totales = {}
+    for fila in filas:
+        cantidad, total = int(fila['cantidad']), float(fila['total'])
+        dia = dias.setdefault(fila['dia'].isoformat(), {})
+        dia[fila['tipo']] = {'cantidad': cantidad, 'total': total}
+        acumulado = totales.setdefault(fila['tipo'], {'cantidad': 0, 'total': 0.0})
+        acumulado['cantidad'] += cantidad
+        acumulado['total'] = round(acumulado['total'] + total, 2)
+    return {
+        'desde': desde.isoformat(),
+        'hasta': hasta.isoformat(),
+        'dias': [{'dia': dia, 'tipos': tipos} for dia, tipos in dias.items()],
+        'totales': totales
+    }
+
+@app.route('/api/resumen', methods=['GET'])
+@auth_required
+def resumen_usuario():
+    desde, hasta, error = rango_fechas()
+    if error:
+        return jsonify({'error': error}), 400
+    
+    conn = get_db_connection()
+    cursor = conn.cursor(dictionary=True)
+    
+    try:
+        filas = consultar_resumen_usuario(cursor, request.user_id, desde, hasta)
+        return jsonify(formatear_resumen(filas, desde, hasta)), 200
+    
+    finally:
+        cursor.close()
+        conn.close()
+
+# Ingresos de un comercio: los tarjeteros no tienen dueño entre los usuarios,
+# así que solo los ven los administradores
+@app.route('/api/resumen/tarjetero/<int:id_tarjetero>', methods=['GET'])
+@auth_required
+@admin_required
+def resumen_tarjetero(id_tarjetero):
+    desde, hasta, error = rango_fechas()
+    if error:
+        return jsonify({'error': error}), 400
+    
+    conn = get_db_connection()
+    cursor = conn.cursor(dictionary=True)
+    
+    try:
+        cursor.execute("SELECT id FROM tarjeteros WHERE id = %s", (id_tarjetero,))
+        if not cursor.fetchone():
+            return jsonify({'error': 'Tarjetero no encontrado'}), 404
         
+        resumen = formatear_resumen(consultar_resumen_tarjetero(cursor, id_tarjetero, desde, hasta), desde, hasta)
+        resumen['id_tarjetero'] = id_tarjetero
+        return jsonify(resumen), 200
+    
     finally:
         cursor.close()
         conn.close()
 
+# ============= EXTRACTOS =============
+EXTRACTO_CONFIG = {
+    'max_simultaneos': int(os.environ.get('EXTRACTO_MAX_SIMULTANEOS', 2)),
+    'tanda': int(os.environ.get('EXTRACTO_TANDA', 500)),
+    'usuarios_por_tramo': int(os.environ.get('EXTRACTO_USUARIOS_POR_TRAMO', 500)),
+    'dias_max': int(os.environ.get('EXTRACTO_DIAS_MAX', 3660))
+}
+
+extractos = ExportadorExtractos(DB_CONFIG, max_simultaneos=EXTRACTO_CONFIG['max_simultaneos'],
+                                tanda=EXTRACTO_CONFIG['tanda'],
+                                usuarios_por_tramo=EXTRACTO_CONFIG['usuarios_por_tramo'])
+
+def respuesta_extracto(nombre, desde_usuario=1, hasta_usuario=None, columnas=COLUMNAS):
+    # Respuesta en streaming: las filas salen del cursor sin pasar por una lista
+    formato = request.args.get('formato', 'csv')
+    if formato not in FORMATOS:
+        return jsonify({'error': 'formato debe ser csv o jsonl'}), 400
+    desde, hasta, error = rango_fechas(dias_max=EXTRACTO_CONFIG['dias_max'])
+    if error:
+        return jsonify({'error': error}), 400
+    
+    try:
+        exportacion = extractos.reservar()
+    except ExtractoSaturado as e:
+        return respuesta_saturado(e)
+    
+    respuesta = Response(
+        extractos.generar(exportacion, formato, columnas, desde, hasta, desde_usuario, hasta_usuario),
+        mimetype=FORMATOS[formato][0]
+    )
+    respuesta.headers['Content-Disposition'] = f'attachment; filename="{nombre}_{desde}_{hasta}.{formato}"'
+    # Por si el stream se cierra sin llegar a iterarse
+    respuesta.call_on_close(lambda: extractos.liberar(exportacion))
+    return respuesta
+
+@app.route('/api/extracto', methods=['GET'])
+@auth_required
+def extracto():
+    return respuesta_extracto(f'extracto_{request.user_id}', request.user_id, request.user_id,
+                              [c for c in COLUMNAS if c != 'id_usuario'])
+
+@app.route('/api/admin/extracto', methods=['GET'])
+@auth_required
+@admin_required
+def extracto_admin():
+    # Todos los usuarios ordenados por id_usuario, un tramo de ids por consulta
+    return respuesta_extracto('extracto_todos')
+
+# ============= EVENTOS EN TIEMPO REAL =============
+@app.route('/api/eventos', methods=['GET'])
+@auth_required
+def eventos():
+    user_id = request.user_id
+    
+    def generate():
+        cola = hub_eventos.suscribir(user_id)
+        try:
+            yield f"data: {json.dumps({'tipo': 'conectado'})}\n\n"
+            while True:
+                try:
+                    evento = cola.get(timeout=EVENTOS_CONFIG['heartbeat'])
+                except queue.Empty:
+                    # Comentario SSE para mantener viva la conexión
+                    yield ": ping\n\n"
+                    continue
+                yield f"data: {json.dumps(evento)}\n\n"
+        finally:
+            hub_eventos.desuscribir(user_id, cola)
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 # ============= TRANSFERENCIAS ENTRE USUARIOS =============
 @app.route('/api/transferir', methods=['POST'])
 @auth_required
+@idempotente
 def transferir():
     user_id = request.user_id
     data = request.get_json()
@@ -678,27 +1972,49 @@ def transferir():
     conn = get_db_connection()
     cursor = conn.cursor(dictionary=True)
     
+    try:
+        return reintentador.ejecutar('transferir', lambda: intentar_transferencia(
+            conn, cursor, user_id, ci_destino, monto, descripcion
+        ))
+    except BloqueoAgotado as e:
+        return respuesta_saturado(e)
+    except (Error, CuentaNoEncontrada, MotorAveriado) as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cursor.close()
+        conn.close()
+
+def intentar_transferencia(conn, cursor, user_id, ci_destino, monto, descripcion):
+    # Una pasada completa de /api/transferir en su propia transacción. Ante un
+    # error deja todo deshecho y lo relanza, así transferir() puede repetirla.
+    movidos = []
+    # Con el motor de saldos las filas de usuarios no se bloquean: el saldo se
+    # valida y mueve en memoria
+    bloqueo = '' if motor_saldos else 'FOR UPDATE'
+    
     try:
         conn.start_transaction()
         
-        # Bloquear usuario origen
-        cursor.execute("""
-            SELECT id, ci, nombre, saldo, activo 
-            FROM usuarios WHERE id = %s FOR UPDATE
-        """, (user_id,))
-        origen = cursor.fetchone()
+        # Destino por CI sin bloquear; después los dos usuarios en una sola
+        # sentencia y en orden de id. Dos transferencias cruzadas (A->B y B->A)
+        # bloquean en el mismo orden: la segunda espera en lugar de un deadlock.
+        cursor.execute("SELECT id FROM usuarios WHERE ci = %s", (ci_destino,))
+        fila = cursor.fetchone()
+        id_destino = fila['id'] if fila else None
+        
+        cursor.execute(f"""
+            SELECT id, ci, nombre, saldo, activo
+            FROM usuarios WHERE id IN (%s, %s)
+            ORDER BY id {bloqueo}
+        """, (user_id, id_destino))
+        usuarios = {u['id']: u for u in cursor.fetchall()}
+        origen = usuarios.get(user_id)
+        destino = usuarios.get(id_destino)
         
         if not origen or not origen['activo']:
             conn.rollback()
             return jsonify({'error': 'Usuario origen inactivo'}), 400
         
-        # Bloquear usuario destino
-        cursor.execute("""
-            SELECT id, nombre, saldo, activo 
-            FROM usuarios WHERE ci = %s FOR UPDATE
-        """, (ci_destino,))
-        destino = cursor.fetchone()
-        
         if not destino:
             conn.rollback()
             return jsonify({'error': 'Usuario destino no encontrado'}), 404
@@ -711,43 +2027,78 @@ def transferir():
             conn.rollback()
             return jsonify({'error': 'No puedes transferir a ti mismo'}), 400
         
-        # Verificar saldo
-        saldo_origen = float(origen['saldo'])
-        if saldo_origen < monto:
-            conn.rollback()
-            return jsonify({'error': 'Saldo insuficiente'}), 400
-        
-        # Actualizar saldos
-        nuevo_saldo_origen = round(saldo_origen - monto, 2)
-        nuevo_saldo_destino = round(float(destino['saldo']) + monto, 2)
-        
-        cursor.execute("UPDATE usuarios SET saldo = %s WHERE id = %s", (nuevo_saldo_origen, origen['id']))
-        cursor.execute("UPDATE usuarios SET saldo = %s WHERE id = %s", (nuevo_saldo_destino, destino['id']))
+        if motor_saldos:
+            try:
+                movidos.append(motor_saldos.transferir(origen['id'], destino['id'], monto, cursor))
+            except SaldoInsuficiente:
+                conn.rollback()
+                return jsonify({'error': 'Saldo insuficiente'}), 400
+            nuevo_saldo_origen, nuevo_saldo_destino = movidos[0].saldos
+        else:
+            # Verificar saldo
+            saldo_origen = float(origen['saldo'])
+            if saldo_origen < monto:
+                conn.rollback()
+                return jsonify({'error': 'Saldo insuficiente'}), 400
+            
+            # Actualizar saldos de los dos usuarios en orden de id
+            nuevo_saldo_origen = round(saldo_origen - monto, 2)
+            nuevo_saldo_destino = round(float(destino['saldo']) + monto, 2)
+            actualizar_saldos(cursor, {origen['id']: nuevo_saldo_origen, destino['id']: nuevo_saldo_destino})
         
         # Registrar transferencia (como transacción especial)
+        fecha = datetime.now()
         cursor.execute("""
-            INSERT INTO transferencias (id_origen, id_destino, monto, descripcion, fecha)
-            VALUES (%s, %s, %s, %s, %s)
-        """, (origen['id'], destino['id'], monto, descripcion, datetime.now()))
-        
-        conn.commit()
+            INSERT INTO transferencias (id_origen, id_destino, monto, descripcion, fecha, secuencia_motor)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        """, (origen['id'], destino['id'], monto, descripcion, fecha, movidos[0].secuencia if movidos else None))
+        id_transferencia = cursor.lastrowid
+        acumular_resumen(cursor, [
+            (fecha, origen['id'], None, 'transferencia_enviada', monto),
+            (fecha, destino['id'], None, 'transferencia_recibida', monto),
+        ])
         
-        return jsonify({
-            'mensaje': 'Transferencia exitosa',
-            'nuevo_saldo': nuevo_saldo_origen,
-            'destinatario': destino['nombre'],
-            'monto': monto
-        }), 200
+        confirmar_movimientos(conn, movidos)
         
-    except Error as e:
-        conn.rollback()
-        return jsonify({'error': str(e)}), 500
-    finally:
-        cursor.close()
-        conn.close()
+    except (Error, CuentaNoEncontrada, MotorAveriado):
+        try:
+            conn.rollback()
+        except Error:
+            pass
+        revertir_movimientos(movidos)
+        raise
+    
+    movimiento = {
+        'id': id_transferencia,
+        'monto': monto,
+        'estado': 'completada',
+        'fecha': fecha.isoformat(),
+        'descripcion': descripcion,
+        'categoria': 'transferencia'
+    }
+    publicar_movimiento(origen['id'], nuevo_saldo_origen, dict(
+        movimiento, tipo='transferencia_enviada',
+        destinatario=f"{destino['nombre']} (CI: {ci_destino})"
+    ))
+    publicar_movimiento(destino['id'], nuevo_saldo_destino, dict(
+        movimiento, tipo='transferencia_recibida',
+        remitente=f"{origen['nombre']} (CI: {origen['ci']})"
+    ))
+    
+    return jsonify({
+        'mensaje': 'Transferencia exitosa',
+        'nuevo_saldo': nuevo_saldo_origen,
+        'destinatario': destino['nombre'],
+        'monto': monto
+    }), 200
+
+# Las recargas y canjes se registran a nombre de este tarjetero: salen en
+# las últimas transacciones de /tarjetero/<id>
+TARJETERO_RECARGAS = 1
 
 @app.route('/api/recargar_saldo', methods=['POST'])
 @auth_required
+@idempotente
 def recargar_saldo():
     user_id = request.user_id
     data = request.get_json()
@@ -763,27 +2114,50 @@ def recargar_saldo():
     
     conn = get_db_connection()
     cursor = conn.cursor(dictionary=True)
+    movidos = []
     
     try:
         conn.start_transaction()
         
-        cursor.execute("SELECT saldo FROM usuarios WHERE id = %s FOR UPDATE", (user_id,))
+        # Con el motor de saldos la recarga se acredita en memoria y se confirma con el commit
+        cursor.execute(f"SELECT saldo FROM usuarios WHERE id = %s {'' if motor_saldos else 'FOR UPDATE'}", (user_id,))
         user = cursor.fetchone()
         
         if not user:
             conn.rollback()
             return jsonify({'error': 'Usuario no encontrado'}), 404
         
-        nuevo_saldo = round(float(user['saldo']) + monto, 2)
-        cursor.execute("UPDATE usuarios SET saldo = %s WHERE id = %s", (nuevo_saldo, user_id))
+        if motor_saldos:
+            movidos.append(motor_saldos.acreditar(user_id, monto, cursor))
+            nuevo_saldo = movidos[0].saldos[0]
+        else:
+            nuevo_saldo = round(float(user['saldo']) + monto, 2)
+            cursor.execute("UPDATE usuarios SET saldo = %s WHERE id = %s", (nuevo_saldo, user_id))
         
         # Registrar recarga
+        fecha = datetime.now()
+        descripcion = f'Recarga {metodo_pago}'
         cursor.execute("""
-            INSERT INTO transacciones (id_tarjetero, id_usuario, monto, tipo, estado, fecha, descripcion)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-        """, (1, user_id, monto, 'recarga', 'aprobada', datetime.now(), f'Recarga {metodo_pago}'))
-        
-        conn.commit()
+            INSERT INTO transacciones (id_tarjetero, id_usuario, monto, tipo, estado, fecha, descripcion, secuencia_motor)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """, (TARJETERO_RECARGAS, user_id, monto, 'recarga', 'aprobada', fecha, descripcion,
+              movidos[0].secuencia if movidos else None))
+        id_transaccion = cursor.lastrowid
+        acumular_resumen(cursor, [(fecha, user_id, TARJETERO_RECARGAS, 'recarga', monto)])
+        
+        confirmar_movimientos(conn, movidos)
+        cache_recursos.invalidar(('tarjetero', TARJETERO_RECARGAS))
+        
+        publicar_movimiento(user_id, nuevo_saldo, {
+            'id': id_transaccion,
+            'monto': monto,
+            'tipo': 'recarga',
+            'estado': 'aprobada',
+            'fecha': fecha.isoformat(),
+            'descripcion': descripcion,
+            'tarjetero': None,
+            'categoria': 'transaccion'
+        })
         
         return jsonify({
             'mensaje': 'Recarga exitosa',
@@ -792,6 +2166,7 @@ def recargar_saldo():
         
     except Exception as e:
         conn.rollback()
+        revertir_movimientos(movidos)
         return jsonify({'error': str(e)}), 500
     finally:
         cursor.close()
@@ -799,6 +2174,7 @@ def recargar_saldo():
 
 @app.route('/api/canjear-tarjeta', methods=['POST'])
 @auth_required
+@idempotente
 def canjear_tarjeta_recarga():
     user_id = request.user_id
     data = request.get_json()
@@ -810,64 +2186,175 @@ def canjear_tarjeta_recarga():
     
     conn = get_db_connection()
     cursor = conn.cursor(dictionary=True)
+    movidos = []
     
     try:
         conn.start_transaction()
         
-        # Buscar tarjeta
-        cursor.execute("""
-            SELECT id, codigo, monto, usado 
-            FROM tarjetas_recarga 
-            WHERE codigo = %s FOR UPDATE
-        """, (codigo,))
-        tarjeta = cursor.fetchone()
-        
-        if not tarjeta:
-            conn.rollback()
-            return jsonify({'error': 'Código de tarjeta inválido'}), 404
-        
-        if tarjeta['usado']:
+        # Reclamar el código y acreditar al usuario en una sola sentencia: solo
+        # una petición puede pasar usado de FALSE a TRUE. Con el motor de saldos
+        # solo se reclama; se acredita en memoria y se confirma con el commit.
+        if motor_saldos:
+            cursor.execute("""
+                UPDATE tarjetas_recarga r
+                JOIN usuarios u ON u.id = %s
+                SET r.usado = TRUE,
+                    r.id_usuario_uso = u.id,
+                    r.fecha_uso = NOW()
+                WHERE r.codigo = %s AND r.usado = FALSE
+            """, (user_id, codigo))
+        else:
+            cursor.execute("""
+                UPDATE tarjetas_recarga r
+                JOIN usuarios u ON u.id = %s
+                SET r.usado = TRUE,
+                    r.id_usuario_uso = u.id,
+                    r.fecha_uso = NOW(),
+                    u.saldo = u.saldo + r.monto
+                WHERE r.codigo = %s AND r.usado = FALSE
+            """, (user_id, codigo))
+        
+        if not cursor.rowcount:
+            # Camino lento: distinguir el motivo del rechazo
             conn.rollback()
+            cursor.execute("SELECT usado FROM tarjetas_recarga WHERE codigo = %s", (codigo,))
+            if not cursor.fetchone():
+                return jsonify({'error': 'Código de tarjeta inválido'}), 404
             return jsonify({'error': 'Esta tarjeta ya fue utilizada'}), 400
         
-        monto = float(tarjeta['monto'])
-        
-        # Marcar tarjeta como usada
+        # Filas ya bloqueadas por el UPDATE: monto y saldo final sin esperar a nadie
         cursor.execute("""
-            UPDATE tarjetas_recarga 
-            SET usado = TRUE, 
-                id_usuario_uso = %s, 
-                fecha_uso = NOW() 
-            WHERE id = %s
-        """, (user_id, tarjeta['id']))
-        
-        # Actualizar saldo usuario
+            SELECT r.monto, u.saldo
+            FROM tarjetas_recarga r
+            JOIN usuarios u ON u.id = r.id_usuario_uso
+            WHERE r.codigo = %s
+        """, (codigo,))
+        canje = cursor.fetchone()
+        monto = float(canje['monto'])
+        nuevo_saldo = float(canje['saldo'])
+        if motor_saldos:
+            movidos.append(motor_saldos.acreditar(user_id, monto, cursor))
+            nuevo_saldo = movidos[0].saldos[0]
+        
         cursor.execute("""
-            UPDATE usuarios 
-            SET saldo = saldo + %s 
-            WHERE id = %s
-        """, (monto, user_id))
+            UPDATE tarjetas_recarga_stock SET disponibles = disponibles - 1 WHERE monto = %s
+        """, (canje['monto'],))
         
         # Registrar transacción
+        fecha = datetime.now()
+        descripcion = f'Recarga con tarjeta {codigo}'
         cursor.execute("""
-            INSERT INTO transacciones (id_tarjetero, id_usuario, monto, tipo, descripcion)
-            VALUES (1, %s, %s, 'recarga', %s)
-        """, (user_id, monto, f'Recarga con tarjeta {codigo}'))
+            INSERT INTO transacciones (id_tarjetero, id_usuario, monto, tipo, descripcion, fecha, secuencia_motor)
+            VALUES (%s, %s, %s, 'recarga', %s, %s, %s)
+        """, (TARJETERO_RECARGAS, user_id, monto, descripcion, fecha, movidos[0].secuencia if movidos else None))
+        id_transaccion = cursor.lastrowid
+        acumular_resumen(cursor, [(fecha, user_id, TARJETERO_RECARGAS, 'recarga', monto)])
         
-        conn.commit()
+        confirmar_movimientos(conn, movidos)
+        cache_recursos.invalidar(('tarjetero', TARJETERO_RECARGAS))
         
-        # Obtener nuevo saldo
-        cursor.execute("SELECT saldo FROM usuarios WHERE id = %s", (user_id,))
-        nuevo_saldo = cursor.fetchone()['saldo']
+        publicar_movimiento(user_id, nuevo_saldo, {
+            'id': id_transaccion,
+            'monto': monto,
+            'tipo': 'recarga',
+            'estado': 'aprobada',
+            'fecha': fecha.isoformat(),
+            'descripcion': descripcion,
+            'tarjetero': None,
+            'categoria': 'transaccion'
+        })
         
         return jsonify({
             'mensaje': 'Tarjeta canjeada exitosamente',
             'monto': monto,
-            'nuevo_saldo': float(nuevo_saldo),
+            'nuevo_saldo': nuevo_saldo,
             'codigo': codigo
         }), 200
         
     except Exception as e:
+        conn.rollback()
+        revertir_movimientos(movidos)
+        return jsonify({'error': str(e)}), 500
+    finally:
+        cursor.close()
+        conn.close()
+
+def contar_tarjetas_disponibles(cursor):
+    # Contador mantenido por la generación y el canje (tarjetas_recarga_stock)
+    cursor.execute("""
+        SELECT monto, disponibles AS cantidad
+        FROM tarjetas_recarga_stock
+        WHERE disponibles > 0
+        ORDER BY monto
+    """)
+    return cursor.fetchall()
+
+# Códigos de recarga: REC<monto>-<aleatorio>, sin caracteres ambiguos (0/O, 1/I/L)
+RECARGA_CONFIG = {
+    'max_por_lote': int(os.environ.get('RECARGA_MAX_POR_LOTE', 100000)),
+    'filas_por_insert': int(os.environ.get('RECARGA_FILAS_POR_INSERT', 1000)),
+    'largo_aleatorio': 12
+}
+ALFABETO_CODIGOS = '23456789ABCDEFGHJKMNPQRSTUVWXYZ'
+
+def generar_codigo_recarga(monto):
+    aleatorio = ''.join(secrets.choice(ALFABETO_CODIGOS) for _ in range(RECARGA_CONFIG['largo_aleatorio']))
+    valor = int(monto) if monto == int(monto) else f'{monto:.2f}'
+    return f'REC{valor}-{aleatorio}'
+
+def insertar_codigos_recarga(cursor, monto, cantidad):
+    # INSERT de filas_por_insert filas cada uno. Si un código choca con uno
+    # existente (improbable con ~59 bits aleatorios) MySQL deshace solo esa
+    # sentencia y se prueba con otra tanda.
+    codigos = []
+    while len(codigos) < cantidad:
+        tanda = {generar_codigo_recarga(monto)
+                 for _ in range(min(RECARGA_CONFIG['filas_por_insert'], cantidad - len(codigos)))}
+        try:
+            cursor.execute(f"""
+                INSERT INTO tarjetas_recarga (codigo, monto)
+                VALUES {', '.join(['(%s, %s)'] * len(tanda))}
+            """, tuple(v for codigo in tanda for v in (codigo, monto)))
+        except IntegrityError:
+            continue
+        codigos.extend(tanda)
+    
+    cursor.execute("""
+        INSERT INTO tarjetas_recarga_stock (monto, disponibles) VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE disponibles = disponibles + VALUES(disponibles)
+    """, (monto, len(codigos)))
+    return codigos
+
+@app.route('/api/admin/tarjetas-recarga', methods=['POST'])
+@auth_required
+@admin_required
+def generar_tarjetas_recarga():
+    data = request.get_json()
+    monto = data.get('monto')
+    cantidad = data.get('cantidad')
+    
+    valido, error = validar_monto(monto)
+    if not valido:
+        return jsonify({'error': error}), 400
+    monto = round(float(monto), 2)
+    if not isinstance(cantidad, int) or not 0 < cantidad <= RECARGA_CONFIG['max_por_lote']:
+        return jsonify({'error': f"cantidad debe estar entre 1 y {RECARGA_CONFIG['max_por_lote']}"}), 400
+    
+    conn = get_db_connection()
+    cursor = conn.cursor(dictionary=True)
+    
+    try:
+        conn.start_transaction()
+        codigos = insertar_codigos_recarga(cursor, monto, cantidad)
+        conn.commit()
+        
+        return jsonify({
+            'monto': monto,
+            'cantidad': len(codigos),
+            'codigos': codigos
+        }), 200
+        
+    except Error as e:
         conn.rollback()
         return jsonify({'error': str(e)}), 500
     finally:
@@ -881,14 +2368,7 @@ def tarjetas_disponibles():
     cursor = conn.cursor(dictionary=True)
     
     try:
-        cursor.execute("""
-            SELECT monto, COUNT(*) as cantidad
-            FROM tarjetas_recarga
-            WHERE usado = FALSE
-            GROUP BY monto
-            ORDER BY monto
-        """)
-        tarjetas = cursor.fetchall()
+        tarjetas = contar_tarjetas_disponibles(cursor)
         
         return jsonify({
             'tarjetas': [{
@@ -932,7 +2412,7 @@ def buscar_usuario():
                 'ci': user['ci'],
                 'nombre': user['nombre'],
                 'email': user['email'],
-                'saldo': float(user['saldo']),
+                'saldo': saldo_vigente(USUARIO, user['id'], user['saldo']),
                 'activo': bool(user['activo'])
             }
         }), 200
@@ -941,6 +2421,72 @@ def buscar_usuario():
         cursor.close()
         conn.close()
 
+@app.route('/metrics', methods=['GET'])
+def metricas_prometheus():
+    if not medidor:
+        return jsonify({'error': 'Instrumentación desactivada'}), 404
+    return Response(medidor.exponer(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/metricas/pool', methods=['GET'])
+def metricas_pool():
+    return jsonify(db_pool.metricas()), 200
+
+@app.route('/api/metricas/motor_saldos', methods=['GET'])
+def metricas_motor_saldos():
+    if not motor_saldos:
+        return jsonify({'activo': False}), 200
+    return jsonify(motor_saldos.metricas()), 200
+
+@app.route('/api/metricas/commit_agrupado', methods=['GET'])
+def metricas_commit_agrupado():
+    if not escritor_cobros:
+        return jsonify({'activo': False}), 200
+    return jsonify(escritor_cobros.metricas()), 200
+
+@app.route('/api/metricas/reintentos', methods=['GET'])
+def metricas_reintentos():
+    return jsonify(reintentador.metricas()), 200
+
+@app.route('/api/metricas/idempotencia', methods=['GET'])
+def metricas_idempotencia():
+    return jsonify(idempotencia.metricas()), 200
+
+@app.route('/api/metricas/extractos', methods=['GET'])
+def metricas_extractos():
+    return jsonify(extractos.metricas()), 200
+
+@app.route('/api/metricas/archivo', methods=['GET'])
+def metricas_archivo():
+    return jsonify(archivador.metricas()), 200
+
+@app.route('/api/metricas/hash', methods=['GET'])
+def metricas_hash():
+    return jsonify(hasher.metricas()), 200
+
+@app.route('/api/metricas/contexto_ia', methods=['GET'])
+def metricas_contexto_ia():
+    return jsonify(cache_contextos.metricas()), 200
+
+@app.route('/api/metricas/ia', methods=['GET'])
+def metricas_ia():
+    return jsonify(cliente_ollama.metricas()), 200
+
+@app.route('/api/metricas/respuestas_ia', methods=['GET'])
+def metricas_respuestas_ia():
+    return jsonify(cache_respuestas.metricas()), 200
+
+@app.route('/api/metricas/eventos', methods=['GET'])
+def metricas_eventos():
+    return jsonify(hub_eventos.metricas()), 200
+
+@app.route('/api/metricas/cache_recursos', methods=['GET'])
+def metricas_cache_recursos():
+    return jsonify(cache_recursos.metricas()), 200
+
+@app.route('/api/metricas/cache_tarjetas', methods=['GET'])
+def metricas_cache_tarjetas():
+    return jsonify(cache_tarjetas.metricas()), 200
+
 @app.errorhandler(404)
 def not_found(error):
     return jsonify({'error': 'Endpoint no encontrado'}), 404
@@ -950,103 +2496,31 @@ def internal_error(error):
     return jsonify({'error': 'Error interno del servidor'}), 500
 
 # ============= ASISTENTE IA CON OLLAMA =============
-@app.route('/api/ai-chat', methods=['POST'])
-@auth_required
-def ai_chat():
-    data = request.get_json()
-    pregunta = data.get('pregunta', '')
-    user_id = request.user_id
+def obtener_contexto_usuario(user_id):
+    contexto = cache_contextos.obtener(user_id)
+    if contexto:
+        return contexto
     
-    if not pregunta:
-        return jsonify({'error': 'Pregunta requerida'}), 400
+    generacion = cache_contextos.generacion(user_id)
+    conn = get_db_connection()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute("SELECT nombre, ci, saldo FROM usuarios WHERE id = %s", (user_id,))
+        usuario = cursor.fetchone()
+        if not usuario:
+            return None
+        usuario['saldo'] = saldo_vigente(USUARIO, user_id, usuario['saldo'])
+        movimientos, _ = consultar_historial(cursor, user_id, CONTEXTO_CONFIG['max_movimientos'])
+    finally:
+        cursor.close()
+        conn.close()
     
-    def generate():
-        try:
-            # Obtener contexto del usuario
-            conn = get_db_connection()
-            cursor = conn.cursor(dictionary=True)
-            
-            # Datos del usuario
-            cursor.execute("""
-                SELECT nombre, ci, saldo 
-                FROM usuarios 
-                WHERE id = %s
-            """, (user_id,))
-            usuario = cursor.fetchone()
-            
-            # Últimas 10 transacciones
-            cursor.execute("""
-                SELECT t.monto, t.tipo, t.fecha, t.descripcion,
-                       tar.nombre as tarjetero
-                FROM transacciones t
-                LEFT JOIN tarjeteros tar ON t.id_tarjetero = tar.id
-                WHERE t.id_usuario = %s
-                ORDER BY t.fecha DESC
-                LIMIT 10
-            """, (user_id,))
-            transacciones = cursor.fetchall()
-            
-            # Transferencias recientes
-            cursor.execute("""
-                SELECT tf.monto, tf.fecha, tf.descripcion,
-                       u.nombre as destinatario
-                FROM transferencias tf
-                INNER JOIN usuarios u ON tf.id_destino = u.id
-                WHERE tf.id_origen = %s
-                ORDER BY tf.fecha DESC
-                LIMIT 5
-            """, (user_id,))
-            transferencias_enviadas = cursor.fetchall()
-            
-            cursor.execute("""
-                SELECT tf.monto, tf.fecha, tf.descripcion,
-                       u.nombre as remitente
-                FROM transferencias tf
-                INNER JOIN usuarios u ON tf.id_origen = u.id
-                WHERE tf.id_destino = %s
-                ORDER BY tf.fecha DESC
-                LIMIT 5
-            """, (user_id,))
-            transferencias_recibidas = cursor.fetchall()
-            
-            cursor.close()
-            conn.close()
-            
-            # Construir contexto detallado
-            contexto_usuario = f"""
-DATOS DEL USUARIO:
-- Nombre: {usuario['nombre']}
-- CI: {usuario['ci']}
-- Saldo actual: ${float(usuario['saldo']):.2f}
-
-TRANSACCIONES RECIENTES:
-"""
-            
-            if transacciones:
-                for t in transacciones:
-                    fecha = t['fecha'].strftime('%Y-%m-%d %H:%M') if t['fecha'] else 'N/A'
-                    contexto_usuario += f"- {fecha}: {t['tipo'].upper()} ${float(t['monto']):.2f} - {t['descripcion'] or t['tarjetero'] or 'Sin descripción'}\n"
-            else:
-                contexto_usuario += "- No hay transacciones recientes\n"
-            
-            contexto_usuario += "\nTRANSFERENCIAS ENVIADAS:\n"
-            if transferencias_enviadas:
-                for tf in transferencias_enviadas:
-                    fecha = tf['fecha'].strftime('%Y-%m-%d %H:%M') if tf['fecha'] else 'N/A'
-                    contexto_usuario += f"- {fecha}: Enviado ${float(tf['monto']):.2f} a {tf['destinatario']} - {tf['descripcion'] or 'Sin descripción'}\n"
-            else:
-                contexto_usuario += "- No hay transferencias enviadas\n"
-            
-            contexto_usuario += "\nTRANSFERENCIAS RECIBIDAS:\n"
-            if transferencias_recibidas:
-                for tf in transferencias_recibidas:
-                    fecha = tf['fecha'].strftime('%Y-%m-%d %H:%M') if tf['fecha'] else 'N/A'
-                    contexto_usuario += f"- {fecha}: Recibido ${float(tf['monto']):.2f} de {tf['remitente']} - {tf['descripcion'] or 'Sin descripción'}\n"
-            else:
-                contexto_usuario += "- No hay transferencias recibidas\n"
-            
-            # Contexto del asistente
-            sistema = """Eres un asistente financiero profesional y experto. Analiza los datos financieros del usuario y proporciona:
+    contexto = construir_contexto(usuario, movimientos, CONTEXTO_CONFIG['presupuesto_tokens'])
+    cache_contextos.guardar(user_id, contexto, generacion)
+    return contexto
+
+# Contexto del asistente
+PROMPT_SISTEMA = """Eres un asistente financiero profesional y experto. Analiza los datos financieros del usuario y proporciona:
 
 1. Análisis objetivo de patrones de gasto
 2. Recomendaciones específicas basadas en sus transacciones reales
@@ -1055,36 +2529,62 @@ TRANSACCIONES RECIENTES:
 5. Estrategias de presupuesto personalizadas
 
 Responde de forma profesional, directa y útil. Usa números y datos concretos cuando sea relevante. Si no hay suficiente información, indícalo claramente."""
+
+def armar_prompt(contexto, pregunta):
+    return f"{PROMPT_SISTEMA}\n\n{contexto.texto}\n\nPREGUNTA: {pregunta}\n\nRESPUESTA PROFESIONAL:"
+
+@app.route('/api/ai-chat', methods=['POST'])
+@auth_required
+def ai_chat():
+    data = request.get_json(silent=True)
+    pregunta = data.get('pregunta', '') if isinstance(data, dict) else ''
+    user_id = request.user_id
+    
+    if not isinstance(pregunta, str):
+        return jsonify({'error': 'La pregunta debe ser texto'}), 400
+    if not pregunta:
+        return jsonify({'error': 'Pregunta requerida'}), 400
+    
+    contexto = obtener_contexto_usuario(user_id)
+    if not contexto:
+        return jsonify({'error': 'Usuario no encontrado'}), 404
+    
+    # Misma pregunta sobre los mismos datos: se repite la respuesta sin pasar por el modelo
+    clave = cache_respuestas.clave(user_id, contexto.huella, pregunta)
+    cacheada = cache_respuestas.obtener(clave)
+    if cacheada:
+        def replay():
+            for texto in cacheada.fragmentos:
+                yield f"data: {json.dumps({'text': texto})}\n\n"
+            yield f"data: {json.dumps({'done': True, 'metricas': {'cache': True}})}\n\n"
+        
+        return Response(replay(), mimetype='text/event-stream')
+    
+    # Si ya hay demasiados esperando se rechaza antes de abrir el stream
+    try:
+        turno = cliente_ollama.encolar()
+    except IASaturada as e:
+        return respuesta_saturado(e)
+    
+    def generate():
+        try:
+            for posicion in cliente_ollama.esperar(turno):
+                yield f"data: {json.dumps({'estado': 'en_cola', 'posicion': posicion})}\n\n"
             
-            prompt_completo = f"{sistema}\n\n{contexto_usuario}\n\nPREGUNTA: {pregunta}\n\nRESPUESTA PROFESIONAL:"
+            prompt_completo = armar_prompt(contexto, pregunta)
             
             # Llamada streaming a Ollama
-            ollama_response = requests.post(
-                'http://localhost:11434/api/generate',
-                json={
-                    'model': 'gemma2',
-                    'prompt': prompt_completo,
-                    'stream': True
-                },
-                stream=True,
-                timeout=60
-            )
-            
-            if ollama_response.status_code == 200:
-                for line in ollama_response.iter_lines():
-                    if line:
-                        try:
-                            chunk = json.loads(line)
-                            if 'response' in chunk:
-                                yield f"data: {json.dumps({'text': chunk['response']})}\n\n"
-                            if chunk.get('done', False):
-                                yield f"data: {json.dumps({'done': True})}\n\n"
-                                break
-                        except json.JSONDecodeError:
-                            continue
-            else:
-                yield f"data: {json.dumps({'error': 'Error al conectar con el modelo IA'})}\n\n"
+            fragmentos = []
+            for texto in cliente_ollama.generar(turno, prompt_completo):
+                fragmentos.append(texto)
+                yield f"data: {json.dumps({'text': texto})}\n\n"
+            cache_respuestas.guardar(clave, fragmentos, turno.metricas['generacion_ms'])
+            yield f"data: {json.dumps({'done': True, 'metricas': turno.metricas})}\n\n"
                 
+        except IASaturada:
+            yield f"data: {json.dumps({'error': 'El asistente está ocupado, intenta nuevamente en unos minutos.'})}\n\n"
+        except ErrorOllama:
+            yield f"data: {json.dumps({'error': 'Error al conectar con el modelo IA'})}\n\n"
         except requests.exceptions.ConnectionError:
             yield f"data: {json.dumps({'error': 'No se pudo conectar con Ollama. Asegúrate de que está corriendo en el puerto 11434.'})}\n\n"
         except requests.exceptions.Timeout:
@@ -1092,8 +2592,13 @@ Responde de forma profesional, directa y útil. Usa números y datos concretos c
         except Exception as e:
             print(f"Error en AI Chat: {str(e)}")
             yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        finally:
+            cliente_ollama.liberar(turno)
     
-    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+    respuesta = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    # Por si el stream se cierra sin llegar a iterarse
+    respuesta.call_on_close(lambda: cliente_ollama.liberar(turno))
+    return respuesta
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8000, debug=True)
\ No newline at end of file
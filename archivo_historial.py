@@ -0,0 +1,110 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+# tabla viva -> (tabla de archivo, columnas copiadas). Los ids se conservan,
+# así los cursores del historial sirven en las dos capas.
+TABLAS_ARCHIVO = {
+    'transacciones': ('transacciones_archivo',
+                      'id, id_tarjetero, id_usuario, monto, tipo, estado, fecha, descripcion, clave, secuencia_motor'),
+    'transferencias': ('transferencias_archivo',
+                       'id, id_origen, id_destino, monto, descripcion, fecha, secuencia_motor'),
+}
+
+
+class ArchivadorHistorial:
+    # Mueve las filas con fecha anterior a `dias` días de las tablas vivas a las
+    # de archivo (ver db.sql), en tandas de `lote` filas con una transacción
+    # cada una: las tablas vivas quedan acotadas y los cobros no esperan por
+    # un DELETE enorme.
+
+    def __init__(self, conectar, dias=180, lote=1000, max_lotes=100):
+        self.conectar = conectar
+        self.dias = dias
+        self.lote = lote
+        self.max_lotes = max_lotes
+        self._lock = threading.Lock()
+        self._movidas = {tabla: 0 for tabla in TABLAS_ARCHIVO}
+        self._ultima_corrida = None
+        self._ultima_duracion_ms = None
+
+    def corte(self):
+        return datetime.now() - timedelta(days=self.dias)
+
+    def _mover_lote(self, tabla, corte):
+        archivo, columnas = TABLAS_ARCHIVO[tabla]
+        conn = self.conectar()
+        cursor = conn.cursor()
+        try:
+            # Por idx_fecha, de las más viejas a las más nuevas
+            cursor.execute(f"""
+                SELECT id FROM {tabla}
+                WHERE fecha < %s
+                ORDER BY fecha, id
+                LIMIT %s
+                FOR UPDATE
+            """, (corte, self.lote))
+            ids = [fila[0] for fila in cursor.fetchall()]
+            if not ids:
+                conn.rollback()
+                return 0
+            marcas = ', '.join(['%s'] * len(ids))
+            cursor.execute(f"""
+                INSERT IGNORE INTO {archivo} ({columnas})
+                SELECT {columnas} FROM {tabla} WHERE id IN ({marcas})
+            """, tuple(ids))
+            cursor.execute(f"DELETE FROM {tabla} WHERE id IN ({marcas})", tuple(ids))
+            conn.commit()
+            return len(ids)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+
+    def archivar(self):
+        # Una corrida mueve como máximo max_lotes * lote filas por tabla; lo
+        # que quede se mueve en la siguiente
+        inicio = time.monotonic()
+        corte = self.corte()
+        movidas = 0
+        for tabla in TABLAS_ARCHIVO:
+            for _ in range(self.max_lotes):
+                n = self._mover_lote(tabla, corte)
+                with self._lock:
+                    self._movidas[tabla] += n
+                movidas += n
+                if n < self.lote:
+                    break
+        with self._lock:
+            self._ultima_corrida = datetime.now().isoformat()
+            self._ultima_duracion_ms = round((time.monotonic() - inicio) * 1000, 1)
+        return movidas
+
+    def metricas(self):
+        with self._lock:
+            return {
+                'dias': self.dias,
+                'corte': self.corte().isoformat(),
+                'movidas': dict(self._movidas),
+                'ultima_corrida': self._ultima_corrida,
+                'ultima_duracion_ms': self._ultima_duracion_ms,
+            }
+
+
+def iniciar_archivado(archivador, intervalo=3600):
+    # Hilo de fondo que llama a archivador.archivar() cada `intervalo` segundos
+    def ciclo():
+        while True:
+            time.sleep(intervalo)
+            try:
+                movidas = archivador.archivar()
+                if movidas:
+                    print(f"Filas movidas al archivo: {movidas}")
+            except Exception as e:
+                print(f"Error archivando historial: {e}")
+
+    hilo = threading.Thread(target=ciclo, name='archivado-historial', daemon=True)
+    hilo.start()
+    return hilo
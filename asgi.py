@@ -0,0 +1,227 @@
+# Modo de servicio asyncio (ASGI). Las rutas de streaming (/api/ai-chat y
+# /api/eventos) se atienden con corrutinas: una conexión SSE abierta o un chat
+# esperando a Ollama no ocupa un hilo. El resto de la app Flask corre sin cambios
+# en un pool de hilos propio, así los cobros no compiten con los streams.
+#
+# Uso (un solo proceso: el hub de eventos y las sesiones en memoria son locales):
+#   uvicorn asgi:aplicacion --host 0.0.0.0 --port 8000
+import asyncio
+import json
+import os
+
+import httpx
+from a2wsgi import WSGIMiddleware
+
+import app as servidor
+from cliente_ollama import ClienteOllamaAsync, IASaturada, ErrorOllama
+from eventos import ColaAsync
+
+ASGI_CONFIG = {
+    # Hilos para las rutas Flask (cobros, login, perfil...)
+    'hilos_wsgi': int(os.environ.get('ASGI_HILOS_WSGI', 32)),
+}
+
+cliente_ollama = ClienteOllamaAsync(**servidor.OLLAMA_CONFIG)
+flask_app = WSGIMiddleware(servidor.app, workers=ASGI_CONFIG['hilos_wsgi'])
+
+CABECERAS_SSE = [
+    (b'content-type', b'text/event-stream'),
+    (b'cache-control', b'no-cache'),
+    (b'x-accel-buffering', b'no'),
+    (b'access-control-allow-origin', b'*'),
+]
+
+
+def sse(datos):
+    return f"data: {json.dumps(datos)}\n\n"
+
+
+async def responder_json(send, estado, datos, cabeceras=()):
+    cuerpo = json.dumps(datos).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': estado,
+        'headers': [(b'content-type', b'application/json'), (b'access-control-allow-origin', b'*'),
+                    *cabeceras],
+    })
+    await send({'type': 'http.response.body', 'body': cuerpo})
+
+
+async def responder_saturado(send, e):
+    await responder_json(send, 503, {'error': 'Servidor ocupado, intenta nuevamente en unos segundos'},
+                         [(b'retry-after', str(e.retry_after).encode('ascii'))])
+
+
+async def leer_cuerpo(receive):
+    cuerpo = b''
+    while True:
+        mensaje = await receive()
+        cuerpo += mensaje.get('body', b'')
+        if not mensaje.get('more_body'):
+            return cuerpo
+
+
+def token_bearer(scope):
+    cabeceras = dict(scope['headers'])
+    auth_header = cabeceras.get(b'authorization', b'').decode('latin-1')
+    if not auth_header.startswith('Bearer '):
+        return None
+    return auth_header.replace('Bearer ', '')
+
+
+async def transmitir(receive, send, eventos):
+    # Envía el generador async `eventos` como SSE y lo cancela si el cliente
+    # se desconecta, para que sus bloques finally liberen cupos y colas
+    await send({'type': 'http.response.start', 'status': 200, 'headers': CABECERAS_SSE})
+
+    async def escribir():
+        try:
+            async for trozo in eventos:
+                await send({'type': 'http.response.body', 'body': trozo.encode('utf-8'), 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            await eventos.aclose()
+
+    async def vigilar_desconexion():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    escritura = asyncio.create_task(escribir())
+    vigia = asyncio.create_task(vigilar_desconexion())
+    await asyncio.wait({escritura, vigia}, return_when=asyncio.FIRST_COMPLETED)
+    vigia.cancel()
+    if not escritura.done():
+        escritura.cancel()
+    try:
+        await escritura
+    except asyncio.CancelledError:
+        pass
+
+
+async def eventos(scope, receive, send, user_id):
+    cola = servidor.hub_eventos.suscribir(user_id, ColaAsync(servidor.hub_eventos, asyncio.get_running_loop()))
+
+    async def generate():
+        try:
+            yield sse({'tipo': 'conectado'})
+            while True:
+                try:
+                    evento = await cola.get(servidor.EVENTOS_CONFIG['heartbeat'])
+                except asyncio.TimeoutError:
+                    # Comentario SSE para mantener viva la conexión
+                    yield ": ping\n\n"
+                    continue
+                yield sse(evento)
+        finally:
+            servidor.hub_eventos.desuscribir(user_id, cola)
+
+    await transmitir(receive, send, generate())
+
+
+async def ai_chat(scope, receive, send, user_id):
+    try:
+        data = json.loads(await leer_cuerpo(receive) or b'{}')
+    except ValueError:
+        return await responder_json(send, 400, {'error': 'JSON inválido'})
+    pregunta = data.get('pregunta', '') if isinstance(data, dict) else ''
+
+    if not isinstance(pregunta, str):
+        return await responder_json(send, 400, {'error': 'La pregunta debe ser texto'})
+    if not pregunta:
+        return await responder_json(send, 400, {'error': 'Pregunta requerida'})
+
+    contexto = await asyncio.to_thread(servidor.obtener_contexto_usuario, user_id)
+    if not contexto:
+        return await responder_json(send, 404, {'error': 'Usuario no encontrado'})
+
+    clave = servidor.cache_respuestas.clave(user_id, contexto.huella, pregunta)
+    cacheada = servidor.cache_respuestas.obtener(clave)
+    if cacheada:
+        async def replay():
+            for texto in cacheada.fragmentos:
+                yield sse({'text': texto})
+            yield sse({'done': True, 'metricas': {'cache': True}})
+
+        return await transmitir(receive, send, replay())
+
+    try:
+        turno = await cliente_ollama.encolar()
+    except IASaturada as e:
+        return await responder_saturado(send, e)
+
+    async def generate():
+        try:
+            async for posicion in cliente_ollama.esperar(turno):
+                yield sse({'estado': 'en_cola', 'posicion': posicion})
+
+            fragmentos = []
+            async for texto in cliente_ollama.generar(turno, servidor.armar_prompt(contexto, pregunta)):
+                fragmentos.append(texto)
+                yield sse({'text': texto})
+            servidor.cache_respuestas.guardar(clave, fragmentos, turno.metricas['generacion_ms'])
+            yield sse({'done': True, 'metricas': turno.metricas})
+
+        except IASaturada:
+            yield sse({'error': 'El asistente está ocupado, intenta nuevamente en unos minutos.'})
+        except ErrorOllama:
+            yield sse({'error': 'Error al conectar con el modelo IA'})
+        except httpx.ConnectError:
+            yield sse({'error': 'No se pudo conectar con Ollama. Asegúrate de que está corriendo en el puerto 11434.'})
+        except httpx.TimeoutException:
+            yield sse({'error': 'El modelo tardó demasiado en responder.'})
+        except Exception as e:
+            print(f"Error en AI Chat: {str(e)}")
+            yield sse({'error': str(e)})
+        finally:
+            await cliente_ollama.liberar(turno)
+
+    try:
+        await transmitir(receive, send, generate())
+    finally:
+        # Por si el stream se cortó antes de empezar a iterarse
+        await cliente_ollama.liberar(turno)
+
+
+async def metricas_ia(scope, receive, send):
+    await responder_json(send, 200, cliente_ollama.metricas())
+
+
+# (método, ruta) -> (handler, requiere token)
+RUTAS_ASYNC = {
+    ('GET', '/api/eventos'): (eventos, True),
+    ('POST', '/api/ai-chat'): (ai_chat, True),
+    ('GET', '/api/metricas/ia'): (metricas_ia, False),
+}
+
+
+async def lifespan(receive, send):
+    while True:
+        mensaje = await receive()
+        if mensaje['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif mensaje['type'] == 'lifespan.shutdown':
+            await cliente_ollama.cerrar()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def aplicacion(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    ruta = RUTAS_ASYNC.get((scope.get('method'), scope.get('path'))) if scope['type'] == 'http' else None
+    if ruta is None:
+        return await flask_app(scope, receive, send)
+
+    handler, requiere_token = ruta
+    if not requiere_token:
+        return await handler(scope, receive, send)
+
+    # Mismo criterio que auth_required; con SESIONES_BACKEND=mysql la consulta va a un hilo
+    token = token_bearer(scope)
+    if not token:
+        return await responder_json(send, 401, {'error': 'Token no proporcionado'})
+    user_id = await asyncio.to_thread(servidor.sesiones.obtener, token)
+    if not user_id:
+        return await responder_json(send, 401, {'error': 'Token inválido o expirado'})
+    await handler(scope, receive, send, user_id)
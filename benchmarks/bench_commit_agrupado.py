@@ -0,0 +1,117 @@
+# Benchmark del group commit: cobros concurrentes a POST /transaccion con un
+# commit por cobro contra COMMIT_AGRUPADO (ver commit_agrupado.py). Reporta
+# cobros/s y latencia p50/p99 por modo y nivel de concurrencia.
+#
+# Requiere una base MySQL/MariaDB cargada con db.sql. Sin --url se usa el
+# cliente de pruebas de Flask en el mismo proceso y se prueban los dos modos;
+# con --url se mide el modo en que esté corriendo el servidor. La diferencia
+# depende del costo del fsync (innodb_flush_log_at_trx_commit=1). Uso:
+#   python benchmarks/bench_commit_agrupado.py --cobros 2000 --hilos 8 32 64
+#   python benchmarks/bench_commit_agrupado.py --url http://localhost:8000 --hilos 32
+import argparse
+import math
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mysql.connector
+import requests
+
+import app
+from bench_lote import PIN, preparar, limpiar
+from commit_agrupado import EscritorAgrupado
+
+
+def percentil(ordenadas, p):
+    return ordenadas[max(0, math.ceil(len(ordenadas) * p / 100) - 1)]
+
+
+def correr(url, id_tarjetero, uids, cobros, hilos):
+    # Cada hilo cobra a sus propios usuarios: mide el commit, no la espera por
+    # el bloqueo de una misma fila
+    latencias = []
+    errores = []
+    lock = threading.Lock()
+
+    def trabajador(n):
+        sesion = requests.Session() if url else None
+        prueba = None if url else app.app.test_client()
+        propias = uids[n::hilos] or uids
+        for i in range(n, cobros, hilos):
+            datos = {'id_tarjetero': id_tarjetero, 'uid_tarjeta': propias[i % len(propias)], 'pin': PIN, 'monto': 1}
+            inicio = time.perf_counter()
+            if sesion:
+                codigo = sesion.post(url + '/transaccion', json=datos).status_code
+            else:
+                codigo = prueba.post('/transaccion', json=datos).status_code
+            duracion = time.perf_counter() - inicio
+            with lock:
+                latencias.append(duracion)
+                if codigo != 200:
+                    errores.append(codigo)
+
+    inicio = time.perf_counter()
+    trabajadores = [threading.Thread(target=trabajador, args=(n,)) for n in range(hilos)]
+    for t in trabajadores:
+        t.start()
+    for t in trabajadores:
+        t.join()
+    total = time.perf_counter() - inicio
+
+    latencias.sort()
+    return {
+        'cobros_s': len(latencias) / total,
+        'p50_ms': percentil(latencias, 50) * 1000,
+        'p99_ms': percentil(latencias, 99) * 1000,
+        'errores': len(errores),
+    }
+
+
+def imprimir(modo, hilos, r, base=None):
+    escala = f"{r['cobros_s'] / base['cobros_s']:>6.2f}x" if base else f"{1:>6.2f}x"
+    print(f"{modo:>12} {hilos:>6} {r['cobros_s']:>10.1f} {escala} {r['p50_ms']:>8.1f} {r['p99_ms']:>8.1f} {r['errores']:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cobros', type=int, default=2000)
+    parser.add_argument('--usuarios', type=int, default=200)
+    parser.add_argument('--hilos', type=int, nargs='+', default=[8, 32, 64])
+    parser.add_argument('--escritores', type=int, default=app.COMMIT_AGRUPADO_CONFIG['hilos'])
+    parser.add_argument('--max-grupo', type=int, default=app.COMMIT_AGRUPADO_CONFIG['max_grupo'])
+    parser.add_argument('--espera-ms', type=float, default=app.COMMIT_AGRUPADO_CONFIG['espera_ms'])
+    parser.add_argument('--url', default=None)
+    args = parser.parse_args()
+
+    # El pool debe alcanzar para los hilos del modo individual
+    app.db_pool.tamano = max(app.db_pool.tamano, max(args.hilos) + args.escritores)
+
+    conn = mysql.connector.connect(**app.DB_CONFIG)
+    id_tarjetero, ids, uids = preparar(conn, args.usuarios)
+    escritor = EscritorAgrupado(app.get_db_connection, app.aplicar_cobros_agrupados, hilos=args.escritores,
+                                max_grupo=args.max_grupo, espera_ms=args.espera_ms)
+    try:
+        print(f"{'modo':>12} {'hilos':>6} {'cobros/s':>10} {'escala':>7} {'p50 ms':>8} {'p99 ms':>8} {'errores':>7}")
+        for hilos in args.hilos:
+            if args.url:
+                imprimir('servidor', hilos, correr(args.url, id_tarjetero, uids, args.cobros, hilos))
+                continue
+            app.escritor_cobros = None
+            base = correr(None, id_tarjetero, uids, args.cobros, hilos)
+            imprimir('individual', hilos, base)
+            app.escritor_cobros = escritor
+            imprimir('agrupado', hilos, correr(None, id_tarjetero, uids, args.cobros, hilos), base)
+        if not args.url:
+            m = escritor.metricas()
+            print(f"Grupos: {m['grupos']}, {m['pedidos_por_grupo']} cobros por grupo (máx. {m['grupo_max']}), "
+                  f"{m['commits_fallidos']} commits fallidos")
+    finally:
+        limpiar(conn, id_tarjetero, ids)
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+# Benchmark de concurrencia: cobros simultáneos al mismo tarjetero con distinta
+# cantidad de franjas de saldo (tarjeteros_saldo).
+#
+# Requiere una base MySQL/MariaDB cargada con db.sql. Uso:
+#   python benchmarks/bench_franjas.py --hilos 16 --segundos 5 --franjas 1 2 4 8 16
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mysql.connector
+
+import app
+
+SALDO_INICIAL = 1_000_000
+
+
+def preparar(conn, hilos):
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO tarjeteros (nombre, ubicacion) VALUES ('Bench', 'benchmark')")
+    id_tarjetero = cursor.lastrowid
+    ids = []
+    for i in range(hilos):
+        cursor.execute(
+            "INSERT INTO usuarios (ci, nombre, saldo) VALUES (%s, %s, %s)",
+            (f'bench-{id_tarjetero}-{i}', f'Bench {i}', SALDO_INICIAL)
+        )
+        ids.append(cursor.lastrowid)
+    conn.commit()
+    cursor.close()
+    return id_tarjetero, ids
+
+
+def limpiar(conn, id_tarjetero, ids):
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM tarjeteros_saldo WHERE id_tarjetero = %s", (id_tarjetero,))
+    cursor.execute("DELETE FROM tarjeteros WHERE id = %s", (id_tarjetero,))
+    cursor.execute(f"DELETE FROM usuarios WHERE id IN ({', '.join(['%s'] * len(ids))})", tuple(ids))
+    conn.commit()
+    cursor.close()
+
+
+def trabajador(id_usuario, id_tarjetero, fin, resultados):
+    conn = mysql.connector.connect(**app.DB_CONFIG)
+    cursor = conn.cursor(dictionary=True)
+    cobros = 0
+    try:
+        while time.monotonic() < fin:
+            cursor.execute("SELECT saldo FROM usuarios WHERE id = %s FOR UPDATE", (id_usuario,))
+            cursor.fetchone()
+            error = app.debitar_y_acreditar(cursor, id_usuario, id_tarjetero, 1)
+            if error:
+                raise RuntimeError(error)
+            conn.commit()
+            cobros += 1
+    finally:
+        cursor.close()
+        conn.close()
+        resultados.append(cobros)
+
+
+def medir(franjas, hilos, segundos):
+    app.TARJETERO_FRANJAS = franjas
+    conn = mysql.connector.connect(**app.DB_CONFIG)
+    id_tarjetero, ids = preparar(conn, hilos)
+    cursor = conn.cursor()
+    app.crear_franjas(cursor, id_tarjetero)
+    conn.commit()
+    cursor.close()
+
+    resultados = []
+    fin = time.monotonic() + segundos
+    threads = [threading.Thread(target=trabajador, args=(i, id_tarjetero, fin, resultados)) for i in ids]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    limpiar(conn, id_tarjetero, ids)
+    conn.close()
+    return sum(resultados) / segundos
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hilos', type=int, default=16)
+    parser.add_argument('--segundos', type=float, default=5)
+    parser.add_argument('--franjas', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    args = parser.parse_args()
+
+    base = None
+    print(f"{'franjas':>8} {'cobros/s':>10} {'escala':>7}")
+    for franjas in args.franjas:
+        tps = medir(franjas, args.hilos, args.segundos)
+        base = base or tps
+        print(f"{franjas:>8} {tps:>10.1f} {tps / base:>6.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+# Benchmark de cobros: N POST /transaccion contra POST /transacciones/lote
+# con distintos tamaños de lote.
+#
+# Requiere una base MySQL/MariaDB cargada con db.sql. Sin --url se usa el
+# cliente de pruebas de Flask en el mismo proceso; con --url se mide contra un
+# servidor corriendo (incluye la red). Uso:
+#   python benchmarks/bench_lote.py --cobros 500 --lotes 10 50 100 500
+#   python benchmarks/bench_lote.py --url http://localhost:8000
+import argparse
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mysql.connector
+import requests
+
+import app
+
+SALDO_INICIAL = 1_000_000
+PIN = '1234'
+CLAVE_FIRMA = 'bench-clave'
+
+
+def preparar(conn, usuarios):
+    cursor = conn.cursor()
+    cursor.execute(
+        "INSERT INTO tarjeteros (nombre, ubicacion, clave_firma) VALUES ('Bench lote', 'benchmark', %s)",
+        (CLAVE_FIRMA,)
+    )
+    id_tarjetero = cursor.lastrowid
+    ids, uids = [], []
+    for i in range(usuarios):
+        cursor.execute(
+            "INSERT INTO usuarios (ci, nombre, saldo) VALUES (%s, %s, %s)",
+            (f'lote-{id_tarjetero}-{i}', f'Bench {i}', SALDO_INICIAL)
+        )
+        ids.append(cursor.lastrowid)
+        uid = f'BL{id_tarjetero}-{i}'
+        cursor.execute("INSERT INTO tarjetas (uid, pin, id_usuario) VALUES (%s, %s, %s)", (uid, PIN, cursor.lastrowid))
+        uids.append(uid)
+    conn.commit()
+    cursor.close()
+    return id_tarjetero, ids, uids
+
+
+def limpiar(conn, id_tarjetero, ids):
+    cursor = conn.cursor()
+    marcas = ', '.join(['%s'] * len(ids))
+    cursor.execute("DELETE FROM transacciones WHERE id_tarjetero = %s", (id_tarjetero,))
+    cursor.execute(f"DELETE FROM tarjetas WHERE id_usuario IN ({marcas})", tuple(ids))
+    cursor.execute("DELETE FROM tarjeteros_saldo WHERE id_tarjetero = %s", (id_tarjetero,))
+    cursor.execute("DELETE FROM resumen_tarjetero_diario WHERE id_tarjetero = %s", (id_tarjetero,))
+    cursor.execute(f"DELETE FROM resumen_usuario_diario WHERE id_usuario IN ({marcas})", tuple(ids))
+    cursor.execute("DELETE FROM tarjeteros WHERE id = %s", (id_tarjetero,))
+    cursor.execute(f"DELETE FROM usuarios WHERE id IN ({marcas})", tuple(ids))
+    conn.commit()
+    cursor.close()
+
+
+class Cliente:
+    # Misma interfaz para el test client de Flask y para un servidor real
+
+    def __init__(self, url):
+        self.url = url
+        self.sesion = requests.Session() if url else None
+        self.prueba = None if url else app.app.test_client()
+
+    def post(self, ruta, datos):
+        if self.sesion:
+            respuesta = self.sesion.post(self.url + ruta, json=datos)
+            return respuesta.status_code, respuesta.json()
+        respuesta = self.prueba.post(ruta, json=datos)
+        return respuesta.status_code, respuesta.get_json()
+
+
+def medir_individual(cliente, id_tarjetero, uids, cobros):
+    inicio = time.perf_counter()
+    for i in range(cobros):
+        codigo, cuerpo = cliente.post('/transaccion', {
+            'id_tarjetero': id_tarjetero,
+            'uid_tarjeta': uids[i % len(uids)],
+            'pin': PIN,
+            'monto': 1
+        })
+        if codigo != 200:
+            raise RuntimeError(cuerpo)
+    return cobros / (time.perf_counter() - inicio)
+
+
+def medir_lotes(cliente, id_tarjetero, uids, cobros, tamano):
+    inicio = time.perf_counter()
+    for desde in range(0, cobros, tamano):
+        items = []
+        for i in range(desde, min(desde + tamano, cobros)):
+            item = {'clave': uuid.uuid4().hex, 'uid_tarjeta': uids[i % len(uids)], 'pin': PIN, 'monto': 1}
+            item['firma'] = app.firma_cobro(CLAVE_FIRMA, id_tarjetero, item)
+            items.append(item)
+        codigo, cuerpo = cliente.post('/transacciones/lote', {'id_tarjetero': id_tarjetero, 'transacciones': items})
+        if codigo != 200 or cuerpo['aprobadas'] != len(items):
+            raise RuntimeError(cuerpo)
+    return cobros / (time.perf_counter() - inicio)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cobros', type=int, default=500)
+    parser.add_argument('--usuarios', type=int, default=20)
+    parser.add_argument('--lotes', type=int, nargs='+', default=[10, 50, 100, 500])
+    parser.add_argument('--url', default=None)
+    args = parser.parse_args()
+
+    conn = mysql.connector.connect(**app.DB_CONFIG)
+    id_tarjetero, ids, uids = preparar(conn, args.usuarios)
+    cliente = Cliente(args.url)
+    try:
+        base = medir_individual(cliente, id_tarjetero, uids, args.cobros)
+        print(f"{'modo':>12} {'cobros/s':>10} {'escala':>7}")
+        print(f"{'individual':>12} {base:>10.1f} {1:>6.2f}x")
+        for tamano in args.lotes:
+            tps = medir_lotes(cliente, id_tarjetero, uids, args.cobros, tamano)
+            print(f"{f'lote {tamano}':>12} {tps:>10.1f} {tps / base:>6.2f}x")
+    finally:
+        limpiar(conn, id_tarjetero, ids)
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+# Prueba de carga contra un servidor corriendo: mezcla de cobros, consultas de
+# saldo, logins, historial, transferencias y chat IA con los datos de
+# benchmarks/sembrar.py. Reporta p50/p95/p99, throughput y rechazos/errores por
+# endpoint, y las esperas por bloqueos de InnoDB durante la corrida.
+#
+# Preparación: sembrar la base, levantar benchmarks/ollama_falso.py y la app con
+# OLLAMA_URL apuntando a él (o usar --ollama-falso si la app ya apunta al puerto).
+# Uso:
+#   python benchmarks/carga.py --url http://localhost:8000 --segundos 60 --hilos 32
+#   python benchmarks/carga.py --guardar benchmarks/base.json
+#   python benchmarks/carga.py --comparar benchmarks/base.json --tolerancia 0.15
+#   python benchmarks/carga.py --aislado     # además, cada endpoint por separado
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mysql.connector
+import requests
+
+import app
+from sembrar import MANIFIESTO, uid_tarjeta
+import ollama_falso
+
+# endpoint -> peso en la mezcla
+MEZCLA = {
+    'transaccion': 45,
+    'consultar_saldo': 20,
+    'historial': 15,
+    'transferir': 10,
+    'login': 8,
+    'ai_chat': 2,
+}
+
+PREGUNTAS = ['¿Cuánto gasté esta semana?', '¿Cómo puedo ahorrar más?', '¿Cuál fue mi mayor gasto?']
+
+# Variables de estado de InnoDB que cuentan esperas por bloqueos
+ESTADO_BLOQUEOS = ('Innodb_row_lock_waits', 'Innodb_row_lock_time', 'Innodb_row_lock_current_waits',
+                   'Innodb_deadlocks')
+
+
+class Operaciones:
+    # Una instancia por hilo: sesión HTTP propia y un token de usuario
+
+    def __init__(self, url, manifiesto, token):
+        self.url = url
+        self.m = manifiesto
+        self.token = token
+        self.sesion = requests.Session()
+
+    def _usuario(self):
+        return random.randrange(self.m['usuarios'])
+
+    def _auth(self):
+        return {'Authorization': f'Bearer {self.token}'}
+
+    def transaccion(self):
+        return self.sesion.post(self.url + '/transaccion', json={
+            'id_tarjetero': self.m['id_tarjetero'],
+            'uid_tarjeta': uid_tarjeta(self.m['prefijo'], self._usuario()),
+            'pin': self.m['pin'],
+            'monto': 1
+        }, headers={'Idempotency-Key': uuid.uuid4().hex})
+
+    def consultar_saldo(self):
+        return self.sesion.post(self.url + '/consultar_saldo', json={
+            'uid_tarjeta': uid_tarjeta(self.m['prefijo'], self._usuario())
+        })
+
+    def login(self):
+        return self.sesion.post(self.url + '/api/login', json={
+            'username': f"{self.m['prefijo']}-{self._usuario()}",
+            'password': self.m['password']
+        })
+
+    def historial(self):
+        respuesta = self.sesion.get(self.url + '/api/historial_transacciones?limite=50', headers=self._auth())
+        # Un tercio de las veces se pide también la página siguiente
+        siguiente = respuesta.ok and respuesta.json().get('next_cursor')
+        if siguiente and random.random() < 0.33:
+            respuesta = self.sesion.get(self.url + f'/api/historial_transacciones?limite=50&cursor={siguiente}',
+                                        headers=self._auth())
+        return respuesta
+
+    def transferir(self):
+        return self.sesion.post(self.url + '/api/transferir', json={
+            'ci_destino': f"{self.m['prefijo']}-{self._usuario()}",
+            'monto': 1,
+            'descripcion': 'carga'
+        }, headers={**self._auth(), 'Idempotency-Key': uuid.uuid4().hex})
+
+    def ai_chat(self):
+        # Se mide hasta el evento final del stream
+        with self.sesion.post(self.url + '/api/ai-chat', json={'pregunta': random.choice(PREGUNTAS)},
+                              headers=self._auth(), stream=True) as respuesta:
+            if respuesta.ok:
+                for linea in respuesta.iter_lines():
+                    if linea.startswith(b'data: ') and (b'"done"' in linea or b'"error"' in linea):
+                        break
+            return respuesta
+
+
+class Registro:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencias = defaultdict(list)
+        self.codigos = defaultdict(lambda: defaultdict(int))
+        self.bloqueos = defaultdict(int)
+
+    def anotar(self, endpoint, segundos, codigo, cuerpo=''):
+        with self._lock:
+            self.latencias[endpoint].append(segundos)
+            self.codigos[endpoint][codigo] += 1
+            if codigo >= 500 and ('Lock wait timeout' in cuerpo or 'Deadlock' in cuerpo):
+                self.bloqueos[endpoint] += 1
+
+
+def percentil(ordenadas, p):
+    if not ordenadas:
+        return 0.0
+    # Rango más cercano
+    return ordenadas[max(0, math.ceil(p / 100 * len(ordenadas)) - 1)]
+
+
+def estado_bloqueos(conn):
+    cursor = conn.cursor()
+    cursor.execute("SHOW GLOBAL STATUS WHERE Variable_name IN (%s)" % ', '.join(['%s'] * len(ESTADO_BLOQUEOS)),
+                   ESTADO_BLOQUEOS)
+    estado = {nombre: int(valor) for nombre, valor in cursor.fetchall()}
+    cursor.close()
+    return estado
+
+
+def obtener_tokens(url, manifiesto, cantidad):
+    sesion = requests.Session()
+    tokens = []
+    for i in random.sample(range(manifiesto['usuarios']), min(cantidad, manifiesto['usuarios'])):
+        respuesta = sesion.post(url + '/api/login', json={
+            'username': f"{manifiesto['prefijo']}-{i}", 'password': manifiesto['password']
+        })
+        if respuesta.status_code != 200:
+            raise RuntimeError(f'Login de preparación falló: {respuesta.status_code} {respuesta.text}')
+        tokens.append(respuesta.json()['access_token'])
+    return tokens
+
+
+def correr(url, manifiesto, tokens, mezcla, hilos, segundos):
+    registro = Registro()
+    endpoints = list(mezcla)
+    pesos = [mezcla[e] for e in endpoints]
+    fin = time.monotonic() + segundos
+
+    def trabajador(n):
+        ops = Operaciones(url, manifiesto, tokens[n % len(tokens)])
+        while time.monotonic() < fin:
+            endpoint = random.choices(endpoints, pesos)[0]
+            inicio = time.perf_counter()
+            try:
+                respuesta = getattr(ops, endpoint)()
+                codigo = respuesta.status_code
+                cuerpo = respuesta.text if codigo >= 500 else ''
+            except requests.RequestException as e:
+                codigo, cuerpo = 599, str(e)
+            registro.anotar(endpoint, time.perf_counter() - inicio, codigo, cuerpo)
+
+    inicio = time.perf_counter()
+    trabajadores = [threading.Thread(target=trabajador, args=(n,)) for n in range(hilos)]
+    for t in trabajadores:
+        t.start()
+    for t in trabajadores:
+        t.join()
+    return registro, time.perf_counter() - inicio
+
+
+def resumir(registro, duracion):
+    resultados = {}
+    for endpoint, latencias in sorted(registro.latencias.items()):
+        ordenadas = sorted(latencias)
+        codigos = registro.codigos[endpoint]
+        resultados[endpoint] = {
+            'peticiones': len(ordenadas),
+            'por_segundo': round(len(ordenadas) / duracion, 1),
+            'p50_ms': round(percentil(ordenadas, 50) * 1000, 1),
+            'p95_ms': round(percentil(ordenadas, 95) * 1000, 1),
+            'p99_ms': round(percentil(ordenadas, 99) * 1000, 1),
+            'max_ms': round(ordenadas[-1] * 1000, 1),
+            'ok': sum(n for c, n in codigos.items() if c < 400),
+            'rechazos': sum(n for c, n in codigos.items() if 400 <= c < 500),
+            'errores': sum(n for c, n in codigos.items() if c >= 500),
+            'bloqueos': registro.bloqueos[endpoint],
+            'codigos': {str(c): n for c, n in sorted(codigos.items())},
+        }
+    return resultados
+
+
+def imprimir(resultados, innodb):
+    print(f"{'endpoint':<16} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'ok':>7} {'4xx':>6} {'5xx':>6} {'lock':>5}")
+    for endpoint, r in resultados.items():
+        print(f"{endpoint:<16} {r['por_segundo']:>8.1f} {r['p50_ms']:>7.1f}ms {r['p95_ms']:>7.1f}ms "
+              f"{r['p99_ms']:>7.1f}ms {r['ok']:>7} {r['rechazos']:>6} {r['errores']:>6} {r['bloqueos']:>5}")
+    print('InnoDB: ' + ', '.join(f'{k}={v}' for k, v in innodb.items()))
+
+
+def medir(conn, url, manifiesto, tokens, mezcla, hilos, segundos):
+    antes = estado_bloqueos(conn)
+    registro, duracion = correr(url, manifiesto, tokens, mezcla, hilos, segundos)
+    despues = estado_bloqueos(conn)
+    innodb = {k: despues[k] - antes.get(k, 0) for k in despues if k != 'Innodb_row_lock_current_waits'}
+    return resumir(registro, duracion), innodb
+
+
+def comparar(actual, base, tolerancia):
+    # Regresión: p95 más alto o throughput más bajo que la base, más allá de la tolerancia
+    regresiones = 0
+    print(f"\n{'endpoint':<16} {'p95 base':>10} {'p95':>10} {'req/s base':>11} {'req/s':>8}")
+    for endpoint, r in actual['endpoints'].items():
+        b = base['endpoints'].get(endpoint)
+        if not b:
+            continue
+        marca = ''
+        if r['p95_ms'] > b['p95_ms'] * (1 + tolerancia) or r['por_segundo'] < b['por_segundo'] * (1 - tolerancia):
+            marca = '  REGRESIÓN'
+            regresiones += 1
+        print(f"{endpoint:<16} {b['p95_ms']:>8.1f}ms {r['p95_ms']:>8.1f}ms {b['por_segundo']:>11.1f} "
+              f"{r['por_segundo']:>8.1f}{marca}")
+    return regresiones
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--manifiesto', default=MANIFIESTO)
+    parser.add_argument('--segundos', type=float, default=60)
+    parser.add_argument('--hilos', type=int, default=32)
+    parser.add_argument('--tokens', type=int, default=200, help='usuarios con sesión para las rutas autenticadas')
+    parser.add_argument('--mezcla', default=None, help='ej. transaccion=50,historial=30,login=20')
+    parser.add_argument('--aislado', action='store_true', help='medir además cada endpoint por separado')
+    parser.add_argument('--ollama-falso', type=int, default=None, metavar='PUERTO',
+                        help='levantar el Ollama falso en este puerto dentro del proceso')
+    parser.add_argument('--guardar', default=None)
+    parser.add_argument('--comparar', default=None)
+    parser.add_argument('--tolerancia', type=float, default=0.15)
+    args = parser.parse_args()
+
+    mezcla = dict(MEZCLA)
+    if args.mezcla:
+        mezcla = {nombre: int(peso) for nombre, peso in (p.split('=') for p in args.mezcla.split(','))}
+    if args.ollama_falso:
+        ollama_falso.iniciar_en_hilo(puerto=args.ollama_falso)
+
+    with open(args.manifiesto) as archivo:
+        manifiesto = json.load(archivo)
+    tokens = obtener_tokens(args.url, manifiesto, args.tokens)
+    conn = mysql.connector.connect(**app.DB_CONFIG, autocommit=True)
+
+    print(f"Mezcla {mezcla}, {args.hilos} hilos, {args.segundos:.0f} s")
+    endpoints, innodb = medir(conn, args.url, manifiesto, tokens, mezcla, args.hilos, args.segundos)
+    imprimir(endpoints, innodb)
+    resultados = {
+        'fecha': datetime.now().isoformat(),
+        'config': {'url': args.url, 'hilos': args.hilos, 'segundos': args.segundos, 'mezcla': mezcla,
+                   'usuarios': manifiesto['usuarios']},
+        'endpoints': endpoints,
+        'innodb': innodb,
+    }
+
+    if args.aislado:
+        # Las esperas de InnoDB de cada fase se atribuyen a un solo endpoint
+        resultados['aislado'] = {}
+        for endpoint in mezcla:
+            print(f"\nSolo {endpoint}")
+            aislado, innodb = medir(conn, args.url, manifiesto, tokens, {endpoint: 1}, args.hilos,
+                                    args.segundos / len(mezcla))
+            imprimir(aislado, innodb)
+            resultados['aislado'][endpoint] = dict(aislado.get(endpoint, {}), innodb=innodb)
+    conn.close()
+
+    if args.guardar:
+        with open(args.guardar, 'w') as archivo:
+            json.dump(resultados, archivo, indent=2)
+        print(f"\nResultados en {args.guardar}")
+
+    if args.comparar:
+        with open(args.comparar) as archivo:
+            regresiones = comparar(resultados, json.load(archivo), args.tolerancia)
+        sys.exit(1 if regresiones else 0)
+
+
+if __name__ == '__main__':
+    main()
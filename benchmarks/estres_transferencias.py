@@ -0,0 +1,190 @@
+# Prueba de estrés de POST /api/transferir: muchos hilos transfiriendo en los
+# dos sentidos entre pocos usuarios (A->B y B->A a la vez), el caso que antes
+# producía deadlocks. Al final verifica que la suma de saldos no cambió, que
+# ningún saldo quedó negativo y que cada transferencia aceptada quedó registrada
+# una sola vez. Reporta transferencias/s, p50/p99, respuestas por código, los
+# reintentos de la app (/api/metricas/reintentos) y los deadlocks de InnoDB.
+#
+# Requiere una base MySQL/MariaDB cargada con db.sql. Sin --url se usa el
+# cliente de pruebas de Flask en el mismo proceso; con --url se prueba contra
+# un servidor corriendo con la misma base. Uso:
+#   python benchmarks/estres_transferencias.py --usuarios 4 --hilos 32 --transferencias 5000
+#   python benchmarks/estres_transferencias.py --url http://localhost:8000 --hilos 64
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mysql.connector
+import requests
+
+import app
+from bench_commit_agrupado import percentil
+
+SALDO_INICIAL = 1000
+PIN = '1234'
+
+
+def preparar(conn, usuarios, etiqueta):
+    cursor = conn.cursor()
+    ids, cis = [], []
+    for i in range(usuarios):
+        ci = f'estres-{etiqueta}-{i}'
+        cursor.execute("INSERT INTO usuarios (ci, nombre, saldo) VALUES (%s, %s, %s)", (ci, f'Estrés {i}', SALDO_INICIAL))
+        ids.append(cursor.lastrowid)
+        cursor.execute("INSERT INTO tarjetas (uid, pin, id_usuario) VALUES (%s, %s, %s)",
+                       (f'ET{etiqueta}-{i}', PIN, cursor.lastrowid))
+        cis.append(ci)
+    conn.commit()
+    cursor.close()
+    return ids, cis
+
+
+def limpiar(conn, ids):
+    cursor = conn.cursor()
+    marcas = ', '.join(['%s'] * len(ids))
+    cursor.execute(f"DELETE FROM transferencias WHERE id_origen IN ({marcas}) OR id_destino IN ({marcas})", tuple(ids) * 2)
+    cursor.execute(f"DELETE FROM tarjetas WHERE id_usuario IN ({marcas})", tuple(ids))
+    cursor.execute(f"DELETE FROM resumen_usuario_diario WHERE id_usuario IN ({marcas})", tuple(ids))
+    cursor.execute(f"DELETE FROM usuarios WHERE id IN ({marcas})", tuple(ids))
+    conn.commit()
+    cursor.close()
+
+
+def deadlocks(conn):
+    cursor = conn.cursor()
+    cursor.execute("SHOW GLOBAL STATUS WHERE Variable_name IN ('Innodb_deadlocks', 'Innodb_row_lock_waits')")
+    estado = {nombre: int(valor) for nombre, valor in cursor.fetchall()}
+    cursor.close()
+    return estado
+
+
+class Cliente:
+    # Misma interfaz para el test client de Flask y para un servidor real
+
+    def __init__(self, url):
+        self.url = url
+        self.sesion = requests.Session() if url else None
+        self.prueba = None if url else app.app.test_client()
+
+    def post(self, ruta, datos, token=None):
+        cabeceras = {'Authorization': f'Bearer {token}'} if token else {}
+        if self.sesion:
+            respuesta = self.sesion.post(self.url + ruta, json=datos, headers=cabeceras)
+            return respuesta.status_code, respuesta.json()
+        respuesta = self.prueba.post(ruta, json=datos, headers=cabeceras)
+        return respuesta.status_code, respuesta.get_json()
+
+    def get(self, ruta):
+        if self.sesion:
+            return self.sesion.get(self.url + ruta).json()
+        return self.prueba.get(ruta).get_json()
+
+
+def correr(url, cis, tokens, transferencias, hilos, monto):
+    latencias = []
+    codigos = Counter()
+    lock = threading.Lock()
+
+    def trabajador(n):
+        cliente = Cliente(url)
+        azar = random.Random(n)
+        for _ in range(n, transferencias, hilos):
+            # Pares al azar en los dos sentidos: con pocos usuarios casi todas
+            # las transferencias se cruzan con otra
+            origen, destino = azar.sample(range(len(cis)), 2)
+            inicio = time.perf_counter()
+            codigo, _ = cliente.post('/api/transferir', {'ci_destino': cis[destino], 'monto': monto}, tokens[origen])
+            duracion = time.perf_counter() - inicio
+            with lock:
+                latencias.append(duracion)
+                codigos[codigo] += 1
+
+    inicio = time.perf_counter()
+    trabajadores = [threading.Thread(target=trabajador, args=(n,)) for n in range(hilos)]
+    for t in trabajadores:
+        t.start()
+    for t in trabajadores:
+        t.join()
+    total = time.perf_counter() - inicio
+
+    latencias.sort()
+    return {
+        'transferencias_s': len(latencias) / total,
+        'p50_ms': percentil(latencias, 50) * 1000,
+        'p99_ms': percentil(latencias, 99) * 1000,
+        'codigos': codigos,
+    }
+
+
+def verificar(conn, ids, aceptadas):
+    cursor = conn.cursor()
+    marcas = ', '.join(['%s'] * len(ids))
+    cursor.execute(f"SELECT SUM(saldo), MIN(saldo) FROM usuarios WHERE id IN ({marcas})", tuple(ids))
+    suma, minimo = cursor.fetchone()
+    cursor.execute(f"SELECT COUNT(*) FROM transferencias WHERE id_origen IN ({marcas})", tuple(ids))
+    registradas = cursor.fetchone()[0]
+    cursor.close()
+    conn.commit()
+
+    esperado = SALDO_INICIAL * len(ids)
+    problemas = []
+    if float(suma) != esperado:
+        problemas.append(f"la suma de saldos es {suma}, se esperaba {esperado}")
+    if float(minimo) < 0:
+        problemas.append(f"hay un saldo negativo ({minimo})")
+    if registradas != aceptadas:
+        problemas.append(f"{registradas} transferencias registradas, {aceptadas} respuestas 200")
+    return problemas
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transferencias', type=int, default=5000)
+    parser.add_argument('--usuarios', type=int, default=4)
+    parser.add_argument('--hilos', type=int, default=32)
+    parser.add_argument('--monto', type=float, default=1)
+    parser.add_argument('--url', default=None)
+    args = parser.parse_args()
+
+    if not args.url:
+        app.db_pool.tamano = max(app.db_pool.tamano, args.hilos + 4)
+
+    conn = mysql.connector.connect(**app.DB_CONFIG)
+    ids, cis = preparar(conn, args.usuarios, int(time.time()))
+    try:
+        cliente = Cliente(args.url)
+        tokens = [cliente.post('/api/login', {'username': ci, 'password': PIN})[1]['access_token'] for ci in cis]
+
+        antes = deadlocks(conn)
+        r = correr(args.url, cis, tokens, args.transferencias, args.hilos, args.monto)
+        despues = deadlocks(conn)
+
+        print(f"{args.transferencias} transferencias, {args.hilos} hilos, {args.usuarios} usuarios")
+        print(f"{r['transferencias_s']:.1f} transferencias/s, p50 {r['p50_ms']:.1f} ms, p99 {r['p99_ms']:.1f} ms")
+        print("Respuestas: " + ', '.join(f"{codigo}: {n}" for codigo, n in sorted(r['codigos'].items())))
+        print(f"InnoDB: {despues['Innodb_deadlocks'] - antes['Innodb_deadlocks']} deadlocks, "
+              f"{despues['Innodb_row_lock_waits'] - antes['Innodb_row_lock_waits']} esperas de bloqueo")
+        reintentos = cliente.get('/api/metricas/reintentos')['operaciones'].get('transferir')
+        if reintentos:
+            print(f"Reintentos: {reintentos['deadlock']} por deadlock, {reintentos['lock_wait_timeout']} por lock wait "
+                  f"timeout, {reintentos['exitos_tras_reintento']} éxitos tras reintento, {reintentos['agotados']} agotados")
+
+        problemas = verificar(conn, ids, r['codigos'][200])
+        for problema in problemas:
+            print(f"ERROR: {problema}")
+        if not problemas:
+            print("Saldos consistentes")
+        sys.exit(1 if problemas or any(codigo >= 500 for codigo in r['codigos']) else 0)
+    finally:
+        limpiar(conn, ids)
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
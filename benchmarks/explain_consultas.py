@@ -0,0 +1,96 @@
+# Regresión de índices: corre EXPLAIN sobre las consultas frecuentes de app.py
+# (las mismas funciones que usan las rutas) y termina con código 1 si alguna
+# recorre una tabla completa (type = ALL).
+#
+# Requiere una base MySQL/MariaDB cargada con db.sql (incluidas las migraciones). Uso:
+#   python benchmarks/explain_consultas.py
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mysql.connector
+
+import app
+
+
+class CursorExplain:
+    # Reemplaza cada consulta por su EXPLAIN y guarda el plan; las lecturas
+    # devuelven vacío para que las funciones de app.py terminen normalmente
+
+    def __init__(self, conn):
+        self._cursor = conn.cursor(dictionary=True)
+        self.planes = []
+
+    def execute(self, sql, params=()):
+        self._cursor.execute('EXPLAIN ' + sql, params)
+        self.planes.append(self._cursor.fetchall())
+
+    def fetchone(self):
+        return None
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        self._cursor.close()
+
+
+def consultas_frecuentes(conn):
+    cursor = conn.cursor(dictionary=True)
+    cursor.execute("SELECT id, ci, email, nombre FROM usuarios ORDER BY id LIMIT 1")
+    usuario = cursor.fetchone()
+    cursor.execute("SELECT id FROM tarjeteros ORDER BY id LIMIT 1")
+    id_tarjetero = cursor.fetchone()['id']
+    cursor.close()
+
+    posicion = (datetime.now(), 2, 1_000_000)
+    hoy = datetime.now().date()
+    hace_un_ano = hoy - timedelta(days=365)
+    return [
+        ('login por CI', lambda c: app.buscar_usuario_login(c, usuario['ci'])),
+        ('login por email', lambda c: app.buscar_usuario_login(c, usuario['email'])),
+        ('login por nombre', lambda c: app.buscar_usuario_login(c, usuario['nombre'])),
+        ('historial primera página', lambda c: app.consultar_historial(c, usuario['id'], 50)),
+        ('historial con cursor', lambda c: app.consultar_historial(c, usuario['id'], 50, posicion)),
+        ('últimas del tarjetero', lambda c: app.ultimas_transacciones_tarjetero(c, id_tarjetero)),
+        ('tarjeta por UID', lambda c: app.cargar_tarjeta(c, 'EXPLAIN-UID')),
+        ('resumen anual del usuario', lambda c: app.consultar_resumen_usuario(c, usuario['id'], hace_un_ano, hoy)),
+        ('resumen anual del tarjetero', lambda c: app.consultar_resumen_tarjetero(c, id_tarjetero, hace_un_ano, hoy)),
+    ]
+
+
+def main():
+    conn = mysql.connector.connect(**app.DB_CONFIG)
+    # Con pocas filas el optimizador prefiere recorrer la tabla aunque exista
+    # un índice; así un type = ALL significa que ningún índice sirve
+    ajuste = conn.cursor()
+    ajuste.execute("SET SESSION max_seeks_for_key = 1")
+    ajuste.close()
+
+    fallas = 0
+    for nombre, consulta in consultas_frecuentes(conn):
+        cursor = CursorExplain(conn)
+        consulta(cursor)
+        cursor.close()
+        for plan in cursor.planes:
+            for fila in plan:
+                tabla = fila['table'] or ''
+                if tabla.startswith('<'):
+                    continue    # resultado de UNION o tabla derivada
+                extra = fila.get('Extra') or ''
+                if fila['type'] == 'ALL':
+                    fallas += 1
+                    print(f"FALLA  {nombre}: recorre {tabla} completa (possible_keys={fila['possible_keys']})")
+                elif 'filesort' in extra:
+                    print(f"AVISO  {nombre}: {tabla} usa {fila['key']} pero ordena con filesort")
+                else:
+                    print(f"ok     {nombre}: {tabla} por {fila['key']} ({fila['type']})")
+
+    conn.close()
+    sys.exit(1 if fallas else 0)
+
+
+if __name__ == '__main__':
+    main()
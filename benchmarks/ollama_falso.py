@@ -0,0 +1,109 @@
+# Servidor falso de Ollama para pruebas de carga: responde POST /api/generate
+# con el mismo stream NDJSON que Ollama (un chunk por token y uno final con
+# eval_count/eval_duration), a un ritmo configurable y sin GPU.
+#
+# Uso (y arrancar la app con OLLAMA_URL=http://localhost:11435):
+#   python benchmarks/ollama_falso.py --puerto 11435 --tokens 80 --tokens-por-segundo 40 --ttft 0.3
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PALABRAS = ['tu', 'saldo', 'actual', 'es', 'suficiente', 'para', 'tus', 'gastos', 'de', 'la',
+            'semana', 'te', 'recomiendo', 'revisar', 'los', 'cobros', 'frecuentes', 'y', 'ahorrar']
+
+
+class ManejadorOllama(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Configurado por crear_servidor()
+    tokens = 80
+    tokens_por_segundo = 40.0
+    ttft = 0.3
+
+    def log_message(self, *args):
+        pass
+
+    def handle(self):
+        # La app cierra conexiones keep-alive sin avisar
+        try:
+            super().handle()
+        except ConnectionResetError:
+            pass
+
+    def _enviar_chunk(self, datos):
+        linea = json.dumps(datos).encode('utf-8') + b'\n'
+        self.wfile.write(f'{len(linea):x}\r\n'.encode('ascii') + linea + b'\r\n')
+        self.wfile.flush()
+
+    def do_GET(self):
+        # /api/tags: chequeo de salud
+        cuerpo = json.dumps({'models': [{'name': 'falso'}]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def do_POST(self):
+        largo = int(self.headers.get('Content-Length', 0))
+        pedido = json.loads(self.rfile.read(largo) or b'{}')
+        if self.path != '/api/generate':
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        inicio = time.monotonic()
+        try:
+            time.sleep(self.ttft)
+            for i in range(self.tokens):
+                self._enviar_chunk({'model': pedido.get('model'), 'response': random.choice(PALABRAS) + ' ',
+                                    'done': False})
+                time.sleep(1 / self.tokens_por_segundo)
+            self._enviar_chunk({'model': pedido.get('model'), 'response': '', 'done': True,
+                                'eval_count': self.tokens,
+                                'eval_duration': int((time.monotonic() - inicio - self.ttft) * 1e9)})
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # La app cortó el stream (cliente desconectado)
+            pass
+
+
+def crear_servidor(puerto=11435, tokens=80, tokens_por_segundo=40.0, ttft=0.3):
+    manejador = type('Manejador', (ManejadorOllama,), {
+        'tokens': tokens, 'tokens_por_segundo': tokens_por_segundo, 'ttft': ttft
+    })
+    servidor = ThreadingHTTPServer(('127.0.0.1', puerto), manejador)
+    servidor.daemon_threads = True
+    return servidor
+
+
+def iniciar_en_hilo(**config):
+    servidor = crear_servidor(**config)
+    threading.Thread(target=servidor.serve_forever, name='ollama-falso', daemon=True).start()
+    return servidor
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--puerto', type=int, default=11435)
+    parser.add_argument('--tokens', type=int, default=80)
+    parser.add_argument('--tokens-por-segundo', type=float, default=40.0)
+    parser.add_argument('--ttft', type=float, default=0.3)
+    args = parser.parse_args()
+
+    servidor = crear_servidor(args.puerto, args.tokens, args.tokens_por_segundo, args.ttft)
+    print(f"Ollama falso en http://127.0.0.1:{args.puerto} ({args.tokens} tokens a {args.tokens_por_segundo}/s)")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+# Carga volúmenes de prueba sobre una base con db.sql (incluidas las
+# migraciones): usuarios con tarjeta, un tarjetero y millones de transacciones y
+# transferencias repartidas en los últimos --dias días. Deja un manifiesto JSON
+# que usa benchmarks/carga.py. Uso:
+#   python benchmarks/sembrar.py --usuarios 10000 --transacciones 2000000 --transferencias 200000
+#   python benchmarks/sembrar.py --limpiar
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bcrypt
+import mysql.connector
+
+import app
+
+MANIFIESTO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'carga_datos.json')
+PASSWORD = '1234'
+PIN = '1234'
+CLAVE_FIRMA = 'carga-clave'
+
+
+def insertar_tandas(conn, sql_base, columnas, filas, tanda):
+    # INSERT múltiples de `tanda` filas, un commit por tanda
+    cursor = conn.cursor()
+    marcas = '(' + ', '.join(['%s'] * columnas) + ')'
+    bloque = []
+    total = 0
+    for fila in filas:
+        bloque.append(fila)
+        if len(bloque) == tanda:
+            cursor.execute(f"{sql_base} VALUES {', '.join([marcas] * len(bloque))}", tuple(v for f in bloque for v in f))
+            conn.commit()
+            total += len(bloque)
+            bloque = []
+    if bloque:
+        cursor.execute(f"{sql_base} VALUES {', '.join([marcas] * len(bloque))}", tuple(v for f in bloque for v in f))
+        conn.commit()
+        total += len(bloque)
+    cursor.close()
+    return total
+
+
+def uid_tarjeta(prefijo, i):
+    # También lo usa carga.py para armar los cobros
+    return f'{prefijo.upper()}{i:08X}'
+
+
+def fecha_al_azar(ahora, dias):
+    return ahora - timedelta(seconds=random.randrange(dias * 86400))
+
+
+def sembrar(conn, args):
+    inicio = time.perf_counter()
+    prefijo = args.prefijo
+    password_hash = bcrypt.hashpw(PASSWORD.encode('utf-8'), bcrypt.gensalt(args.costo_bcrypt)).decode('utf-8')
+
+    cursor = conn.cursor()
+    cursor.execute(
+        "INSERT INTO tarjeteros (nombre, ubicacion, clave_firma) VALUES (%s, 'carga', %s)",
+        (f'Tarjetero {prefijo}', CLAVE_FIRMA)
+    )
+    id_tarjetero = cursor.lastrowid
+    app.crear_franjas(cursor, id_tarjetero)
+    conn.commit()
+
+    insertar_tandas(conn, "INSERT INTO usuarios (ci, nombre, email, saldo, password_hash)", 5, (
+        (f'{prefijo}-{i}', f'Carga {i}', f'{prefijo}{i}@carga.local', args.saldo, password_hash)
+        for i in range(args.usuarios)
+    ), args.tanda)
+    # ids[i] es el usuario con ci prefijo-i (los ids pueden tener huecos)
+    cursor.execute("SELECT id, ci FROM usuarios WHERE ci LIKE %s", (f'{prefijo}-%',))
+    ids = [0] * args.usuarios
+    for id_usuario, ci in cursor.fetchall():
+        ids[int(ci.rsplit('-', 1)[1])] = id_usuario
+    primer_id, ultimo_id = min(ids), max(ids)
+    cursor.close()
+
+    insertar_tandas(conn, "INSERT INTO tarjetas (uid, pin, id_usuario)", 3, (
+        (uid_tarjeta(prefijo, i), PIN, ids[i]) for i in range(args.usuarios)
+    ), args.tanda)
+    print(f"{args.usuarios} usuarios con tarjeta ({time.perf_counter() - inicio:.1f} s)")
+
+    ahora = datetime.now()
+    n = insertar_tandas(conn, "INSERT INTO transacciones (id_tarjetero, id_usuario, monto, tipo, estado, fecha)", 6, (
+        (id_tarjetero, random.choice(ids), random.randint(100, 5000) / 100,
+         'cobro' if random.random() < 0.9 else 'recarga', 'aprobada', fecha_al_azar(ahora, args.dias))
+        for _ in range(args.transacciones)
+    ), args.tanda)
+    print(f"{n} transacciones ({time.perf_counter() - inicio:.1f} s)")
+
+    def transferencia():
+        origen, destino = random.sample(ids, 2)
+        return (origen, destino, random.randint(100, 10000) / 100, fecha_al_azar(ahora, args.dias))
+
+    n = insertar_tandas(conn, "INSERT INTO transferencias (id_origen, id_destino, monto, fecha)", 4, (
+        transferencia() for _ in range(args.transferencias)
+    ), args.tanda)
+    print(f"{n} transferencias ({time.perf_counter() - inicio:.1f} s)")
+
+    reconstruir_resumen(conn, id_tarjetero, primer_id, ultimo_id)
+    print(f"Resúmenes diarios reconstruidos ({time.perf_counter() - inicio:.1f} s)")
+
+    manifiesto = {
+        'prefijo': prefijo,
+        'id_tarjetero': id_tarjetero,
+        'clave_firma': CLAVE_FIRMA,
+        'primer_id': primer_id,
+        'ultimo_id': ultimo_id,
+        'usuarios': args.usuarios,
+        'password': PASSWORD,
+        'pin': PIN,
+    }
+    with open(args.manifiesto, 'w') as archivo:
+        json.dump(manifiesto, archivo, indent=2)
+    print(f"Manifiesto en {args.manifiesto}")
+
+
+def reconstruir_resumen(conn, id_tarjetero, primer_id, ultimo_id):
+    # Mismo cálculo que la migración 3, solo para los datos sembrados
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO resumen_usuario_diario (id_usuario, dia, tipo, id_tarjetero, cantidad, total)
+        SELECT id_usuario, DATE(fecha), tipo, id_tarjetero, COUNT(*), SUM(monto)
+        FROM transacciones
+        WHERE id_usuario BETWEEN %s AND %s AND estado = 'aprobada'
+        GROUP BY id_usuario, DATE(fecha), tipo, id_tarjetero
+        ON DUPLICATE KEY UPDATE cantidad = VALUES(cantidad), total = VALUES(total)
+    """, (primer_id, ultimo_id))
+    for columna, tipo in (('id_origen', 'transferencia_enviada'), ('id_destino', 'transferencia_recibida')):
+        cursor.execute(f"""
+            INSERT INTO resumen_usuario_diario (id_usuario, dia, tipo, id_tarjetero, cantidad, total)
+            SELECT {columna}, DATE(fecha), %s, 0, COUNT(*), SUM(monto)
+            FROM transferencias
+            WHERE {columna} BETWEEN %s AND %s
+            GROUP BY {columna}, DATE(fecha)
+            ON DUPLICATE KEY UPDATE cantidad = VALUES(cantidad), total = VALUES(total)
+        """, (tipo, primer_id, ultimo_id))
+    cursor.execute("""
+        INSERT INTO resumen_tarjetero_diario (id_tarjetero, dia, tipo, franja, cantidad, total)
+        SELECT id_tarjetero, DATE(fecha), tipo, 0, COUNT(*), SUM(monto)
+        FROM transacciones
+        WHERE id_tarjetero = %s AND estado = 'aprobada'
+        GROUP BY id_tarjetero, DATE(fecha), tipo
+        ON DUPLICATE KEY UPDATE cantidad = VALUES(cantidad), total = VALUES(total)
+    """, (id_tarjetero,))
+    conn.commit()
+    cursor.close()
+
+
+def borrar_en_tandas(conn, sql, params, tanda=10000):
+    cursor = conn.cursor()
+    while True:
+        cursor.execute(f"{sql} LIMIT {tanda}", params)
+        conn.commit()
+        if cursor.rowcount < tanda:
+            break
+    cursor.close()
+
+
+def limpiar(conn, manifiesto):
+    rango = (manifiesto['primer_id'], manifiesto['ultimo_id'])
+    borrar_en_tandas(conn, "DELETE FROM transacciones WHERE id_usuario BETWEEN %s AND %s", rango)
+    borrar_en_tandas(conn, "DELETE FROM transacciones WHERE id_tarjetero = %s", (manifiesto['id_tarjetero'],))
+    borrar_en_tandas(conn, "DELETE FROM transferencias WHERE id_origen BETWEEN %s AND %s OR id_destino BETWEEN %s AND %s",
+                     rango + rango)
+    for tabla in ('transacciones_archivo', 'resumen_usuario_diario'):
+        borrar_en_tandas(conn, f"DELETE FROM {tabla} WHERE id_usuario BETWEEN %s AND %s", rango)
+    borrar_en_tandas(conn, "DELETE FROM transferencias_archivo WHERE id_origen BETWEEN %s AND %s OR id_destino BETWEEN %s AND %s",
+                     rango + rango)
+    borrar_en_tandas(conn, "DELETE FROM resumen_tarjetero_diario WHERE id_tarjetero = %s", (manifiesto['id_tarjetero'],))
+    borrar_en_tandas(conn, "DELETE FROM sesiones WHERE id_usuario BETWEEN %s AND %s", rango)
+    borrar_en_tandas(conn, "DELETE FROM tarjetas WHERE id_usuario BETWEEN %s AND %s", rango)
+    borrar_en_tandas(conn, "DELETE FROM usuarios WHERE id BETWEEN %s AND %s AND ci LIKE %s",
+                     rango + (f"{manifiesto['prefijo']}-%",))
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM tarjeteros_saldo WHERE id_tarjetero = %s", (manifiesto['id_tarjetero'],))
+    cursor.execute("DELETE FROM tarjeteros WHERE id = %s", (manifiesto['id_tarjetero'],))
+    conn.commit()
+    cursor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--usuarios', type=int, default=10000)
+    parser.add_argument('--transacciones', type=int, default=1_000_000)
+    parser.add_argument('--transferencias', type=int, default=100_000)
+    parser.add_argument('--dias', type=int, default=365)
+    parser.add_argument('--saldo', type=float, default=1_000_000)
+    parser.add_argument('--tanda', type=int, default=5000)
+    parser.add_argument('--prefijo', default='carga')
+    # Mismo costo que BCRYPT_COSTO en la app, si no el login vuelve a hashear
+    parser.add_argument('--costo-bcrypt', type=int, default=app.HASH_CONFIG['costo'])
+    parser.add_argument('--manifiesto', default=MANIFIESTO)
+    parser.add_argument('--limpiar', action='store_true')
+    args = parser.parse_args()
+
+    conn = mysql.connector.connect(**app.DB_CONFIG)
+    try:
+        if args.limpiar:
+            with open(args.manifiesto) as archivo:
+                limpiar(conn, json.load(archivo))
+            os.remove(args.manifiesto)
+            print("Datos de carga eliminados")
+        else:
+            sembrar(conn, args)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
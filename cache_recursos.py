@@ -0,0 +1,175 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from mysql.connector import Error
+
+
+class CacheRecursos:
+    # Cuerpos JSON ya serializados de recursos de lectura frecuente
+    # (/api/perfil, /tarjetero/<id>) con una versión por recurso. Las
+    # escrituras llaman a invalidar() después del commit: la versión sube y la
+    # entrada deja de servirse. El ETag es un hash del cuerpo, así un ETag
+    # guardado por el cliente sigue valiendo tras un reinicio si nada cambió.
+    #
+    # Las versiones viven en la memoria del proceso: sirve para un solo
+    # worker. Con varios, una escritura atendida por un worker no invalida a
+    # los demás; para eso está CacheRecursosMySQL.
+    #
+    # Las versiones salen de un reloj global: quien lee de MySQL toma la
+    # versión antes de la consulta y guardar() descarta el cuerpo si una
+    # escritura la cambió mientras tanto. Las versiones de recursos sin entrada
+    # se olvidan pasando de `max_versiones`; a partir de ahí valen `_piso`,
+    # mayor que cualquier versión entregada antes, así ninguna lectura en curso
+    # puede guardar un cuerpo viejo.
+
+    def __init__(self, max_bytes=8 * 1024 * 1024, ttl=300, max_versiones=100000):
+        self.max_bytes = max_bytes
+        # Cota para escrituras que no pasan por invalidar() (SQL a mano)
+        self.ttl = ttl
+        self.max_versiones = max_versiones
+        self._entradas = OrderedDict()      # recurso -> (version, cuerpo, etag, expira)
+        self._versiones = {}
+        self._reloj = 0
+        self._piso = 0
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self._aciertos = 0
+        self._fallos = 0
+        self._descartes = 0
+        self._invalidaciones = 0
+        self._no_modificados = 0
+
+    def version(self, recurso):
+        with self._lock:
+            return self._versiones.get(recurso, self._piso)
+
+    def obtener(self, recurso):
+        # Devuelve (cuerpo, etag) o None si hay que ir a MySQL
+        with self._lock:
+            return self._leer(recurso, self._versiones.get(recurso, self._piso))
+
+    def guardar(self, recurso, version, cuerpo):
+        # Devuelve el ETag (sin comillas) aunque el cuerpo no quede guardado
+        etag = hashlib.blake2b(cuerpo, digest_size=16).hexdigest()
+        with self._lock:
+            self._escribir(recurso, version, self._versiones.get(recurso, self._piso), cuerpo, etag)
+        return etag
+
+    def _leer(self, recurso, vigente):
+        entrada = self._entradas.get(recurso)
+        if entrada and entrada[0] == vigente and entrada[3] > time.monotonic():
+            self._entradas.move_to_end(recurso)
+            self._aciertos += 1
+            return entrada[1], entrada[2]
+        if entrada:
+            self._quitar(recurso)
+        self._fallos += 1
+        return None
+
+    def _escribir(self, recurso, version, vigente, cuerpo, etag):
+        if version != vigente or len(cuerpo) > self.max_bytes:
+            self._descartes += 1
+            return
+        self._quitar(recurso)
+        self._entradas[recurso] = (version, cuerpo, etag, time.monotonic() + self.ttl)
+        self._bytes += len(cuerpo)
+        while self._bytes > self.max_bytes:
+            self._quitar(next(iter(self._entradas)))
+
+    def invalidar(self, recurso):
+        with self._lock:
+            self._reloj += 1
+            self._versiones[recurso] = self._reloj
+            self._quitar(recurso)
+            self._invalidaciones += 1
+            if len(self._versiones) > self.max_versiones:
+                self._reloj += 1
+                self._piso = self._reloj
+                self._versiones = {r: self._versiones[r] for r in self._entradas if r in self._versiones}
+
+    def no_modificado(self):
+        # Respuesta 304: el cliente ya tenía el cuerpo vigente
+        with self._lock:
+            self._no_modificados += 1
+
+    def _quitar(self, recurso):
+        entrada = self._entradas.pop(recurso, None)
+        if entrada:
+            self._bytes -= len(entrada[1])
+
+    def metricas(self):
+        with self._lock:
+            return {
+                'entradas': len(self._entradas),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'versiones': len(self._versiones),
+                'aciertos': self._aciertos,
+                'fallos': self._fallos,
+                'descartes': self._descartes,
+                'invalidaciones': self._invalidaciones,
+                'no_modificados': self._no_modificados,
+            }
+
+
+class CacheRecursosMySQL(CacheRecursos):
+    # Para varios workers: los cuerpos siguen en la memoria de cada proceso y
+    # las versiones pasan a la tabla `versiones_recurso` (ver db.sql), así una
+    # escritura atendida por un worker invalida la entrada en todos. Cada
+    # lectura cuesta una consulta por clave primaria en lugar de la del recurso.
+
+    def __init__(self, conectar, **kwargs):
+        super().__init__(**kwargs)
+        self.conectar = conectar
+
+    @staticmethod
+    def _nombre(recurso):
+        return ':'.join(str(parte) for parte in recurso)
+
+    def version(self, recurso):
+        conn = self.conectar()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT version FROM versiones_recurso WHERE recurso = %s", (self._nombre(recurso),))
+            fila = cursor.fetchone()
+            return fila[0] if fila else 0
+        finally:
+            cursor.close()
+            conn.close()
+
+    def obtener(self, recurso):
+        vigente = self.version(recurso)
+        with self._lock:
+            return self._leer(recurso, vigente)
+
+    def guardar(self, recurso, version, cuerpo):
+        # `version` se leyó de MySQL antes de la consulta del recurso: si una
+        # escritura la cambió mientras tanto, la entrada no vuelve a servirse
+        etag = hashlib.blake2b(cuerpo, digest_size=16).hexdigest()
+        with self._lock:
+            self._escribir(recurso, version, version, cuerpo, etag)
+        return etag
+
+    def invalidar(self, recurso):
+        # Se llama después del commit de la escritura: un fallo aquí no la
+        # deshace, los demás workers ven el cambio al vencer el TTL
+        try:
+            conn = self.conectar()
+            cursor = conn.cursor()
+            try:
+                cursor.execute("""
+                    INSERT INTO versiones_recurso (recurso, version) VALUES (%s, 1)
+                    ON DUPLICATE KEY UPDATE version = version + 1
+                """, (self._nombre(recurso),))
+                conn.commit()
+            finally:
+                cursor.close()
+                conn.close()
+        except Error as e:
+            print(f"No se pudo invalidar {self._nombre(recurso)} en MySQL: {e}")
+        with self._lock:
+            self._quitar(recurso)
+            self._invalidaciones += 1
@@ -0,0 +1,63 @@
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, namedtuple
+
+RespuestaCache = namedtuple('RespuestaCache', ['fragmentos', 'generacion_ms'])
+
+
+def normalizar_pregunta(pregunta):
+    # "¿Cuánto gasté esta semana?" y "cuanto gaste esta semana" dan la misma clave
+    texto = unicodedata.normalize('NFKD', pregunta.lower())
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    texto = re.sub(r'[^\w\s]', ' ', texto)
+    return ' '.join(texto.split())
+
+
+class CacheRespuestas:
+    # Respuestas completas del asistente por (usuario, huella del contexto,
+    # pregunta normalizada). Si el saldo o los movimientos cambian, cambia la
+    # huella y la entrada vieja deja de usarse; el LRU/TTL la termina sacando.
+
+    def __init__(self, max_entradas=500, ttl=1800):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self._entradas = OrderedDict()      # clave -> (RespuestaCache, expira)
+        self._lock = threading.Lock()
+        self._aciertos = 0
+        self._fallos = 0
+        self._ms_ahorrados = 0.0
+
+    def clave(self, user_id, huella, pregunta):
+        return (user_id, huella, normalizar_pregunta(pregunta))
+
+    def obtener(self, clave):
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada and entrada[1] > time.monotonic():
+                self._entradas.move_to_end(clave)
+                self._aciertos += 1
+                self._ms_ahorrados += entrada[0].generacion_ms
+                return entrada[0]
+            self._entradas.pop(clave, None)
+            self._fallos += 1
+            return None
+
+    def guardar(self, clave, fragmentos, generacion_ms):
+        # Guardar solo respuestas que terminaron con 'done'
+        with self._lock:
+            self._entradas[clave] = (RespuestaCache(tuple(fragmentos), generacion_ms), time.monotonic() + self.ttl)
+            self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+
+    def metricas(self):
+        with self._lock:
+            return {
+                'entradas': len(self._entradas),
+                'max_entradas': self.max_entradas,
+                'aciertos': self._aciertos,
+                'fallos': self._fallos,
+                'segundos_modelo_ahorrados': round(self._ms_ahorrados / 1000, 1),
+            }
@@ -0,0 +1,91 @@
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+TarjetaCache = namedtuple('TarjetaCache', ['id_usuario', 'activa', 'pin_hash', 'nombre'])
+
+# Marca de UID desconocido en la caché negativa
+NO_REGISTRADA = object()
+
+
+class CacheTarjetas:
+    # Caché LRU por UID de tarjeta. Las entradas positivas viven `ttl` segundos,
+    # las negativas (UID no registrado) solo `ttl_negativo`, así un lector que
+    # repite un UID inválido no golpea MySQL en cada lectura.
+
+    def __init__(self, max_entradas=10000, ttl=300, ttl_negativo=5):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self.ttl_negativo = ttl_negativo
+        self._entradas = OrderedDict()      # uid -> (TarjetaCache | NO_REGISTRADA, expira)
+        self._lock = threading.Lock()
+        self._sal = secrets.token_bytes(16)
+
+        self._aciertos = 0
+        self._aciertos_negativos = 0
+        self._fallos = 0
+
+    @staticmethod
+    def _clave(uid):
+        # tarjetas.uid se compara sin distinguir mayúsculas y sin los espacios
+        # finales (PAD SPACE) en MySQL: la caché igual, si no invalidar() no
+        # alcanza las entradas de otra grafía. Los espacios iniciales cuentan.
+        return uid.rstrip(' ').upper() if isinstance(uid, str) else uid
+
+    def _hash_pin(self, pin):
+        return hashlib.sha256(self._sal + str(pin).encode('utf-8')).digest()
+
+    def pin_valido(self, tarjeta, pin):
+        return hmac.compare_digest(tarjeta.pin_hash, self._hash_pin(pin))
+
+    def _guardar(self, uid, valor, ttl):
+        uid = self._clave(uid)
+        with self._lock:
+            self._entradas[uid] = (valor, time.monotonic() + ttl)
+            self._entradas.move_to_end(uid)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+
+    def obtener(self, uid):
+        # Devuelve TarjetaCache, NO_REGISTRADA o None si no está en caché
+        uid = self._clave(uid)
+        with self._lock:
+            entrada = self._entradas.get(uid)
+            if entrada and entrada[1] > time.monotonic():
+                self._entradas.move_to_end(uid)
+                if entrada[0] is NO_REGISTRADA:
+                    self._aciertos_negativos += 1
+                else:
+                    self._aciertos += 1
+                return entrada[0]
+            if entrada:
+                del self._entradas[uid]
+            self._fallos += 1
+            return None
+
+    def guardar(self, uid, id_usuario, activa, pin, nombre):
+        tarjeta = TarjetaCache(id_usuario, bool(activa), self._hash_pin(pin), nombre)
+        self._guardar(uid, tarjeta, self.ttl)
+        return tarjeta
+
+    def guardar_negativo(self, uid):
+        self._guardar(uid, NO_REGISTRADA, self.ttl_negativo)
+
+    def invalidar(self, uid):
+        # Llamar al registrar una tarjeta, desactivarla o cambiar su PIN
+        uid = self._clave(uid)
+        with self._lock:
+            self._entradas.pop(uid, None)
+
+    def metricas(self):
+        with self._lock:
+            return {
+                'entradas': len(self._entradas),
+                'max_entradas': self.max_entradas,
+                'aciertos': self._aciertos,
+                'aciertos_negativos': self._aciertos_negativos,
+                'fallos': self._fallos,
+            }
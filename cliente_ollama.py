@@ -0,0 +1,325 @@
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class IASaturada(Exception):
+    # La cola de generaciones está llena o la espera superó el máximo
+
+    def __init__(self, retry_after):
+        super().__init__('Asistente IA saturado')
+        self.retry_after = retry_after
+
+
+class ErrorOllama(Exception):
+    pass
+
+
+class Turno:
+    # Lugar de una petición en la admisión: primero espera en la cola,
+    # luego ocupa uno de los `max_en_vuelo` cupos hasta liberar()
+
+    def __init__(self):
+        self.encolado = time.monotonic()
+        self.admitido = False
+        self.liberado = False
+        self.metricas = {}
+
+
+class _BaseOllama:
+    # Configuración y métricas comunes a los clientes síncrono y asyncio.
+    # Los contadores se protegen con un lock de hilos en ambos casos porque
+    # metricas() se consulta desde los hilos de Flask.
+
+    def __init__(self, url='http://localhost:11434', modelo='gemma2', max_en_vuelo=2, max_cola=20,
+                 espera_max=120.0, timeout_conexion=5.0, timeout_lectura=60.0, retry_after=5):
+        self.url = url.rstrip('/')
+        self.modelo = modelo
+        self.max_en_vuelo = max_en_vuelo
+        self.max_cola = max_cola
+        self.espera_max = espera_max
+        self.timeout_conexion = timeout_conexion
+        self.timeout_lectura = timeout_lectura
+        self.retry_after = retry_after
+
+        self._lock = threading.Lock()
+        self._cola = deque()
+        self._en_vuelo = 0
+
+        self._admitidos = 0
+        self._generaciones = 0
+        self._errores = 0
+        self._rechazos = 0
+        self._expirados = 0
+        self._espera_total = 0.0
+        self._ttft_total = 0.0
+        self._ttft_max = 0.0
+        self._tokens_total = 0
+        self._duracion_total = 0.0
+
+    def _cuerpo(self, prompt):
+        return {'model': self.modelo, 'prompt': prompt, 'stream': True}
+
+    def _admitir_cola(self):
+        # Llamar con la condición del cliente tomada
+        while self._cola and self._en_vuelo < self.max_en_vuelo:
+            turno = self._cola.popleft()
+            turno.admitido = True
+            with self._lock:
+                self._en_vuelo += 1
+                self._admitidos += 1
+                self._espera_total += time.monotonic() - turno.encolado
+
+    def _nuevo_turno(self):
+        # Llamar con la condición del cliente tomada
+        if len(self._cola) >= self.max_cola and self._en_vuelo >= self.max_en_vuelo:
+            with self._lock:
+                self._rechazos += 1
+            raise IASaturada(self.retry_after)
+        turno = Turno()
+        self._cola.append(turno)
+        self._admitir_cola()
+        return turno
+
+    def _expirar(self, turno):
+        self._cola.remove(turno)
+        turno.liberado = True
+        with self._lock:
+            self._expirados += 1
+
+    def _soltar(self, turno):
+        # Devuelve False si el turno ya estaba liberado
+        if turno.liberado:
+            return False
+        turno.liberado = True
+        if turno.admitido:
+            with self._lock:
+                self._en_vuelo -= 1
+        else:
+            self._cola.remove(turno)
+        self._admitir_cola()
+        return True
+
+    def _leer_chunk(self, linea):
+        if not linea:
+            return None
+        try:
+            return json.loads(linea)
+        except json.JSONDecodeError:
+            return None
+
+    def _registrar_error(self):
+        with self._lock:
+            self._errores += 1
+
+    def _registrar_generacion(self, turno, inicio, primer_token, fragmentos, final):
+        # Deja en turno.metricas el tiempo hasta el primer token y los tokens por segundo
+        fin = time.monotonic()
+        ttft = (primer_token or fin) - inicio
+        # Ollama informa eval_count/eval_duration (ns) en el último chunk;
+        # si no vienen, se cuentan los fragmentos recibidos
+        tokens = final.get('eval_count') or fragmentos
+        duracion = final.get('eval_duration', 0) / 1e9 or fin - (primer_token or inicio)
+        turno.metricas = {
+            'espera_ms': round((inicio - turno.encolado) * 1000, 1),
+            'ttft_ms': round(ttft * 1000, 1),
+            'generacion_ms': round((fin - inicio) * 1000, 1),
+            'tokens': tokens,
+            'tokens_por_segundo': round(tokens / duracion, 2) if duracion > 0 else 0.0,
+        }
+        with self._lock:
+            self._generaciones += 1
+            self._ttft_total += ttft
+            self._ttft_max = max(self._ttft_max, ttft)
+            self._tokens_total += tokens
+            self._duracion_total += duracion
+
+    def metricas(self):
+        with self._lock:
+            return {
+                'en_vuelo': self._en_vuelo,
+                'max_en_vuelo': self.max_en_vuelo,
+                'en_cola': len(self._cola),
+                'max_cola': self.max_cola,
+                'generaciones': self._generaciones,
+                'errores': self._errores,
+                'rechazos': self._rechazos,
+                'expirados': self._expirados,
+                'espera_promedio_ms': round(self._espera_total / self._admitidos * 1000, 1) if self._admitidos else 0.0,
+                'ttft_promedio_ms': round(self._ttft_total / self._generaciones * 1000, 1) if self._generaciones else 0.0,
+                'ttft_max_ms': round(self._ttft_max * 1000, 1),
+                'tokens_por_segundo': round(self._tokens_total / self._duracion_total, 2) if self._duracion_total else 0.0,
+            }
+
+
+class ClienteOllama(_BaseOllama):
+    # Sesión HTTP keep-alive contra Ollama con control de admisión: como mucho
+    # `max_en_vuelo` generaciones a la vez y `max_cola` peticiones esperando,
+    # atendidas en orden de llegada.
+
+    def __init__(self, **config):
+        super().__init__(**config)
+        self._sesion = requests.Session()
+        adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_en_vuelo)
+        self._sesion.mount('http://', adaptador)
+        self._sesion.mount('https://', adaptador)
+        self._cond = threading.Condition()
+
+    def encolar(self):
+        # Lanza IASaturada si la cola está llena; el resto espera con esperar()
+        with self._cond:
+            turno = self._nuevo_turno()
+            self._cond.notify_all()
+        return turno
+
+    def esperar(self, turno):
+        # Generador: produce la posición en la cola (1 = siguiente) cada vez
+        # que cambia y termina cuando el turno es admitido
+        limite = turno.encolado + self.espera_max
+        ultima = None
+        while True:
+            with self._cond:
+                while not turno.admitido:
+                    posicion = self._cola.index(turno) + 1
+                    if posicion != ultima:
+                        break
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        self._expirar(turno)
+                        self._cond.notify_all()
+                        raise IASaturada(self.retry_after)
+                    self._cond.wait(restante)
+                else:
+                    return
+            ultima = posicion
+            yield posicion
+
+    def liberar(self, turno):
+        # Idempotente: sirve tanto para un turno en cola como para uno admitido
+        with self._cond:
+            if self._soltar(turno):
+                self._cond.notify_all()
+
+    def generar(self, turno, prompt):
+        # Generador de fragmentos de texto; al terminar deja las métricas en turno.metricas
+        inicio = time.monotonic()
+        primer_token = None
+        fragmentos = 0
+        final = {}
+        try:
+            with self._sesion.post(f'{self.url}/api/generate', json=self._cuerpo(prompt), stream=True,
+                                   timeout=(self.timeout_conexion, self.timeout_lectura)) as respuesta:
+                if respuesta.status_code != 200:
+                    raise ErrorOllama(f'Ollama respondió {respuesta.status_code}')
+                for linea in respuesta.iter_lines():
+                    chunk = self._leer_chunk(linea)
+                    if not chunk:
+                        continue
+                    if chunk.get('response'):
+                        if primer_token is None:
+                            primer_token = time.monotonic()
+                        fragmentos += 1
+                        yield chunk['response']
+                    if chunk.get('done', False):
+                        final = chunk
+                        break
+                else:
+                    raise ErrorOllama('Ollama cortó el stream antes de terminar')
+        except Exception:
+            self._registrar_error()
+            raise
+        self._registrar_generacion(turno, inicio, primer_token, fragmentos, final)
+
+
+class ClienteOllamaAsync(_BaseOllama):
+    # Misma admisión y métricas que ClienteOllama para el modo ASGI: la espera
+    # en cola y el stream de Ollama son corrutinas, no hilos bloqueados.
+    # Todos los métodos salvo metricas() deben llamarse desde el mismo loop.
+
+    def __init__(self, **config):
+        super().__init__(**config)
+        self._cliente = None
+        self._cond = asyncio.Condition()
+
+    def _obtener_cliente(self):
+        # httpx.AsyncClient queda ligado al loop donde se usa por primera vez
+        if self._cliente is None:
+            self._cliente = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout_lectura, connect=self.timeout_conexion),
+                limits=httpx.Limits(max_connections=self.max_en_vuelo, max_keepalive_connections=self.max_en_vuelo)
+            )
+        return self._cliente
+
+    async def cerrar(self):
+        if self._cliente is not None:
+            await self._cliente.aclose()
+            self._cliente = None
+
+    async def encolar(self):
+        async with self._cond:
+            turno = self._nuevo_turno()
+            self._cond.notify_all()
+        return turno
+
+    async def esperar(self, turno):
+        limite = turno.encolado + self.espera_max
+        ultima = None
+        while True:
+            async with self._cond:
+                while not turno.admitido:
+                    posicion = self._cola.index(turno) + 1
+                    if posicion != ultima:
+                        break
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        self._expirar(turno)
+                        self._cond.notify_all()
+                        raise IASaturada(self.retry_after)
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), restante)
+                    except asyncio.TimeoutError:
+                        pass
+                else:
+                    return
+            ultima = posicion
+            yield posicion
+
+    async def liberar(self, turno):
+        async with self._cond:
+            if self._soltar(turno):
+                self._cond.notify_all()
+
+    async def generar(self, turno, prompt):
+        inicio = time.monotonic()
+        primer_token = None
+        fragmentos = 0
+        final = {}
+        try:
+            async with self._obtener_cliente().stream('POST', f'{self.url}/api/generate',
+                                                      json=self._cuerpo(prompt)) as respuesta:
+                if respuesta.status_code != 200:
+                    raise ErrorOllama(f'Ollama respondió {respuesta.status_code}')
+                async for linea in respuesta.aiter_lines():
+                    chunk = self._leer_chunk(linea)
+                    if not chunk:
+                        continue
+                    if chunk.get('response'):
+                        if primer_token is None:
+                            primer_token = time.monotonic()
+                        fragmentos += 1
+                        yield chunk['response']
+                    if chunk.get('done', False):
+                        final = chunk
+                        break
+                else:
+                    raise ErrorOllama('Ollama cortó el stream antes de terminar')
+        except Exception:
+            self._registrar_error()
+            raise
+        self._registrar_generacion(turno, inicio, primer_token, fragmentos, final)
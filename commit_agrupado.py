@@ -0,0 +1,176 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from mysql.connector import Error
+
+
+class GrupoSaturado(Exception):
+    # La cola de pedidos está llena: el cliente debe reintentar luego
+
+    def __init__(self, retry_after):
+        super().__init__('Cola de escritura saturada')
+        self.retry_after = retry_after
+
+
+class CommitIncierto(Error):
+    # conn.commit() falló (conexión perdida, 2013/2055...): el grupo pudo
+    # haber quedado confirmado, así que no se vuelve a aplicar
+
+    def __init__(self, error):
+        super().__init__(msg=f'Resultado del commit desconocido: {error.msg}', errno=error.errno)
+
+
+class EscritorAgrupado:
+    # Group commit: los pedidos de los hilos de Flask se encolan y `hilos`
+    # escritores los aplican de a grupos de hasta `max_grupo` en una sola
+    # transacción, así MySQL hace un fsync del redo log por grupo y no por pedido.
+    # Cada pedido se resuelve (Future) cuando el commit compartido termina.
+    #
+    # aplicar(cursor, pedidos) trabaja dentro de la transacción abierta y
+    # devuelve un resultado por pedido, en orden. Si el grupo falla antes del
+    # commit (deadlock, lock wait timeout...) se reintenta cada pedido en su
+    # propia transacción, así un pedido no hace fallar a los demás. Si falla el
+    # commit mismo, los pedidos fallan con CommitIncierto: quien los envió debe
+    # comprobar en MySQL si quedaron registrados (ver cobro_agrupado en app.py).
+
+    def __init__(self, conectar, aplicar, hilos=2, max_grupo=64, espera_ms=0.0, max_cola=1000, retry_after=1):
+        self.conectar = conectar
+        self.aplicar = aplicar
+        self.hilos = hilos
+        self.max_grupo = max_grupo
+        # Cuánto esperar a que se sumen más pedidos antes de escribir (0: solo
+        # se agrupan los que llegaron mientras se escribía el grupo anterior)
+        self.espera = espera_ms / 1000
+        self.retry_after = retry_after
+        self._cola = queue.Queue(maxsize=max_cola)
+        self._lock = threading.Lock()
+        self._iniciado = False
+
+        self._pedidos = 0
+        self._grupos = 0
+        self._grupo_max = 0
+        self._commits_fallidos = 0
+        self._commits_inciertos = 0
+        self._reintentos_individuales = 0
+        self._errores = 0
+        self._rechazos = 0
+        self._tiempo_escritura = 0.0
+
+    def _iniciar(self):
+        # Los hilos se crean en el primer pedido, no al importar app.py
+        with self._lock:
+            if self._iniciado:
+                return
+            self._iniciado = True
+        for i in range(self.hilos):
+            threading.Thread(target=self._escritor, name=f'commit-agrupado-{i}', daemon=True).start()
+
+    def enviar(self, pedido):
+        if not self._iniciado:
+            self._iniciar()
+        futuro = Future()
+        try:
+            self._cola.put_nowait((pedido, futuro))
+        except queue.Full:
+            with self._lock:
+                self._rechazos += 1
+            raise GrupoSaturado(self.retry_after)
+        return futuro
+
+    def _juntar(self, primero):
+        grupo = [primero]
+        limite = time.monotonic() + self.espera
+        while len(grupo) < self.max_grupo:
+            restante = limite - time.monotonic()
+            try:
+                if restante > 0:
+                    grupo.append(self._cola.get(timeout=restante))
+                else:
+                    grupo.append(self._cola.get_nowait())
+            except queue.Empty:
+                break
+        return grupo
+
+    def _escritor(self):
+        while True:
+            grupo = self._juntar(self._cola.get())
+            inicio = time.perf_counter()
+            try:
+                resultados = self._en_transaccion([pedido for pedido, _ in grupo])
+            except CommitIncierto as e:
+                with self._lock:
+                    self._commits_inciertos += 1
+                self._fallar(grupo, e)
+            except Error:
+                with self._lock:
+                    self._commits_fallidos += 1
+                if len(grupo) == 1:
+                    self._resolver_individual(*grupo[0])
+                else:
+                    with self._lock:
+                        self._reintentos_individuales += len(grupo)
+                    for pedido, futuro in grupo:
+                        self._resolver_individual(pedido, futuro)
+            except Exception as e:
+                # Un error de programación no debe dejar hilos esperando
+                self._fallar(grupo, e)
+            else:
+                for (_, futuro), resultado in zip(grupo, resultados):
+                    futuro.set_result(resultado)
+            with self._lock:
+                self._grupos += 1
+                self._pedidos += len(grupo)
+                self._grupo_max = max(self._grupo_max, len(grupo))
+                self._tiempo_escritura += time.perf_counter() - inicio
+
+    def _resolver_individual(self, pedido, futuro):
+        try:
+            futuro.set_result(self._en_transaccion([pedido])[0])
+        except Exception as e:
+            self._fallar([(pedido, futuro)], e)
+
+    def _fallar(self, grupo, error):
+        with self._lock:
+            self._errores += len(grupo)
+        for _, futuro in grupo:
+            futuro.set_exception(error)
+
+    def _en_transaccion(self, pedidos):
+        conn = self.conectar()
+        cursor = conn.cursor(dictionary=True)
+        try:
+            resultados = self.aplicar(cursor, pedidos)
+            try:
+                conn.commit()
+            except Error as e:
+                raise CommitIncierto(e) from e
+            return resultados
+        except Exception:
+            try:
+                conn.rollback()
+            except Error:
+                pass
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+
+    def metricas(self):
+        with self._lock:
+            return {
+                'hilos': self.hilos,
+                'max_grupo': self.max_grupo,
+                'en_cola': self._cola.qsize(),
+                'pedidos': self._pedidos,
+                'grupos': self._grupos,
+                'pedidos_por_grupo': round(self._pedidos / self._grupos, 2) if self._grupos else 0.0,
+                'grupo_max': self._grupo_max,
+                'commits_fallidos': self._commits_fallidos,
+                'commits_inciertos': self._commits_inciertos,
+                'reintentos_individuales': self._reintentos_individuales,
+                'errores': self._errores,
+                'rechazos': self._rechazos,
+                'escritura_promedio_ms': round(self._tiempo_escritura / self._grupos * 1000, 2) if self._grupos else 0.0,
+            }
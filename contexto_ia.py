@@ -0,0 +1,132 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+# huella: resume saldo y movimientos usados; cambia si cambia el contexto
+ContextoUsuario = namedtuple('ContextoUsuario', ['texto', 'saldo', 'huella'])
+
+# Aproximación usada para el presupuesto: ~4 caracteres por token
+CARACTERES_POR_TOKEN = 4
+
+
+def _linea_movimiento(m):
+    fecha = m['fecha'].strftime('%Y-%m-%d %H:%M') if m['fecha'] else 'N/A'
+    monto = float(m['monto'])
+    descripcion = m['descripcion'] or 'Sin descripción'
+    if m['tipo'] == 'transferencia_enviada':
+        return f"- {fecha}: Enviado ${monto:.2f} a {m['contraparte_nombre']} - {descripcion}"
+    if m['tipo'] == 'transferencia_recibida':
+        return f"- {fecha}: Recibido ${monto:.2f} de {m['contraparte_nombre']} - {descripcion}"
+    return f"- {fecha}: {m['tipo'].upper()} ${monto:.2f} - {m['descripcion'] or m['tarjetero_nombre'] or 'Sin descripción'}"
+
+
+def _resumen(movimientos):
+    totales = {}
+    for m in movimientos:
+        totales[m['tipo']] = totales.get(m['tipo'], 0.0) + float(m['monto'])
+    desde = min((m['fecha'] for m in movimientos if m['fecha']), default=None)
+    partes = [f"{tipo.replace('_', ' ')}: ${total:.2f}" for tipo, total in sorted(totales.items())]
+    periodo = f" desde {desde.strftime('%Y-%m-%d')}" if desde else ''
+    return f"- {len(movimientos)} movimientos anteriores{periodo} ({', '.join(partes)})"
+
+
+def huella_contexto(usuario, movimientos):
+    datos = [str(usuario['saldo'])] + [[m['orden'], m['id']] for m in movimientos]
+    return hashlib.sha256(json.dumps(datos).encode('utf-8')).hexdigest()[:16]
+
+
+def construir_contexto(usuario, movimientos, presupuesto_tokens=600):
+    # `movimientos` son filas de consultar_historial(), de la más nueva a la más vieja.
+    # Se detallan mientras entren en el presupuesto; el resto se resume en una línea.
+    cabecera = [
+        '',
+        'DATOS DEL USUARIO:',
+        f"- Nombre: {usuario['nombre']}",
+        f"- CI: {usuario['ci']}",
+        f"- Saldo actual: ${float(usuario['saldo']):.2f}",
+        '',
+        'MOVIMIENTOS RECIENTES:',
+    ]
+    presupuesto = presupuesto_tokens * CARACTERES_POR_TOKEN - sum(len(l) + 1 for l in cabecera)
+
+    detalle = []
+    for i, m in enumerate(movimientos):
+        linea = _linea_movimiento(m)
+        if len(linea) + 1 > presupuesto:
+            detalle.append(_resumen(movimientos[i:]))
+            break
+        detalle.append(linea)
+        presupuesto -= len(linea) + 1
+
+    if not detalle:
+        detalle.append('- No hay movimientos recientes')
+
+    texto = '\n'.join(cabecera + detalle) + '\n'
+    return ContextoUsuario(texto=texto, saldo=float(usuario['saldo']), huella=huella_contexto(usuario, movimientos))
+
+
+class CacheContextos:
+    # Contexto del asistente por usuario. Se invalida con cada escritura sobre
+    # el saldo o historial del usuario; el TTL solo acota la memoria ocupada.
+
+    def __init__(self, max_entradas=1000, ttl=600):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self._entradas = OrderedDict()      # user_id -> (ContextoUsuario, expira)
+        self._lock = threading.Lock()
+        # Generación por usuario, tomada de un reloj global. Pasando de
+        # `max_generaciones` se olvidan y todas valen `_piso`, mayor que
+        # cualquier generación entregada antes
+        self.max_generaciones = max_entradas * 4
+        self._generaciones = {}
+        self._reloj = 0
+        self._piso = 0
+        self._aciertos = 0
+        self._fallos = 0
+
+    def generacion(self, user_id):
+        # Tomar antes de leer de la base: si el usuario tuvo invalidaciones
+        # entre medio, guardar() descarta el contexto para no cachear datos viejos
+        with self._lock:
+            return self._generaciones.get(user_id, self._piso)
+
+    def obtener(self, user_id):
+        with self._lock:
+            entrada = self._entradas.get(user_id)
+            if entrada and entrada[1] > time.monotonic():
+                self._entradas.move_to_end(user_id)
+                self._aciertos += 1
+                return entrada[0]
+            self._entradas.pop(user_id, None)
+            self._fallos += 1
+            return None
+
+    def guardar(self, user_id, contexto, generacion):
+        with self._lock:
+            if generacion != self._generaciones.get(user_id, self._piso):
+                return
+            self._entradas[user_id] = (contexto, time.monotonic() + self.ttl)
+            self._entradas.move_to_end(user_id)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+
+    def invalidar(self, user_id):
+        with self._lock:
+            self._reloj += 1
+            self._generaciones[user_id] = self._reloj
+            self._entradas.pop(user_id, None)
+            if len(self._generaciones) > self.max_generaciones:
+                self._reloj += 1
+                self._piso = self._reloj
+                self._generaciones = {}
+
+    def metricas(self):
+        with self._lock:
+            return {
+                'entradas': len(self._entradas),
+                'max_entradas': self.max_entradas,
+                'aciertos': self._aciertos,
+                'fallos': self._fallos,
+            }
@@ -9,7 +9,9 @@ CREATE TABLE IF NOT EXISTS tarjeteros (
     ubicacion VARCHAR(200),
     saldo DECIMAL(10,2) DEFAULT 0.00,
     fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    activo BOOLEAN DEFAULT TRUE
+    activo BOOLEAN DEFAULT TRUE,
+    -- Secreto HMAC con el que el tarjetero firma los cobros de /transacciones/lote
+    clave_firma VARCHAR(64)
 );
 
 CREATE TABLE IF NOT EXISTS usuarios (
@@ -48,15 +50,32 @@ CREATE TABLE IF NOT EXISTS transacciones (
     estado ENUM('aprobada', 'rechazada', 'pendiente') DEFAULT 'aprobada',
     fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     descripcion TEXT,
+    -- Clave de idempotencia generada por el tarjetero (cobros subidos en lote)
+    clave VARCHAR(64) NULL,
+    -- Secuencia del movimiento en el log del motor de saldos (MOTOR_SALDOS=1)
+    secuencia_motor BIGINT UNSIGNED NULL,
     FOREIGN KEY (id_tarjetero) REFERENCES tarjeteros(id),
     FOREIGN KEY (id_usuario) REFERENCES usuarios(id),
+    UNIQUE KEY uk_tarjetero_clave (id_tarjetero, clave),
+    UNIQUE KEY uk_secuencia_motor (secuencia_motor),
     INDEX idx_fecha (fecha),
     INDEX idx_tarjetero (id_tarjetero),
     INDEX idx_usuario (id_usuario)
 );
 
-INSERT INTO tarjeteros (nombre, ubicacion, saldo) VALUES
-('Tarjetero #1', 'Entrada Principal', 0);
+INSERT INTO tarjeteros (nombre, ubicacion, saldo, clave_firma) VALUES
+('Tarjetero #1', 'Entrada Principal', 0, 'dev-clave-tarjetero-1');
+
+-- Saldo del tarjetero repartido en franjas: cada cobro acredita una franja al azar,
+-- así los cobros concurrentes no esperan por una única fila. El saldo total es
+-- tarjeteros.saldo (consolidado) + SUM(franjas).
+CREATE TABLE IF NOT EXISTS tarjeteros_saldo (
+    id_tarjetero INT NOT NULL,
+    franja TINYINT UNSIGNED NOT NULL,
+    saldo DECIMAL(12,2) NOT NULL DEFAULT 0.00,
+    PRIMARY KEY (id_tarjetero, franja),
+    FOREIGN KEY (id_tarjetero) REFERENCES tarjeteros(id) ON DELETE CASCADE
+);
 
 -- Usuarios de prueba (password: 1234 para todos)
 INSERT INTO usuarios (ci, nombre, email, telefono, saldo, password_hash) VALUES
@@ -120,8 +139,11 @@ CREATE TABLE IF NOT EXISTS transferencias (
     monto DECIMAL(10,2) NOT NULL,
     descripcion TEXT,
     fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    -- Secuencia del movimiento en el log del motor de saldos (MOTOR_SALDOS=1)
+    secuencia_motor BIGINT UNSIGNED NULL,
     FOREIGN KEY (id_origen) REFERENCES usuarios(id),
     FOREIGN KEY (id_destino) REFERENCES usuarios(id),
+    UNIQUE KEY uk_secuencia_motor (secuencia_motor),
     INDEX idx_fecha (fecha),
     INDEX idx_origen (id_origen),
     INDEX idx_destino (id_destino)
@@ -133,4 +155,272 @@ INSERT INTO transacciones (id_tarjetero, id_usuario, monto, tipo, estado, descri
 (1, 3, 5.00, 'cobro', 'aprobada', 'Compra en tienda'),
 (1, 1, 50.00, 'recarga', 'aprobada', 'Recarga efectivo'),
 (1, 4, 25.00, 'cobro', 'aprobada', 'Pago de almuerzo'),
-(1, 2, 100.00, 'recarga', 'aprobada', 'Recarga banco');
\ No newline at end of file
+(1, 2, 100.00, 'recarga', 'aprobada', 'Recarga banco');
+
+-- Sesiones compartidas entre workers (SESIONES_BACKEND=mysql)
+CREATE TABLE IF NOT EXISTS sesiones (
+    token_hash CHAR(64) PRIMARY KEY,
+    id_usuario INT NOT NULL,
+    creada TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expira TIMESTAMP NOT NULL,
+    FOREIGN KEY (id_usuario) REFERENCES usuarios(id) ON DELETE CASCADE,
+    INDEX idx_expira (expira)
+);
+
+-- Respuestas de las rutas con Idempotency-Key (IDEMPOTENCIA_BACKEND=mysql).
+-- codigo/cuerpo en NULL: la petición original todavía se está ejecutando.
+CREATE TABLE IF NOT EXISTS idempotencia (
+    clave_hash CHAR(64) PRIMARY KEY,
+    huella CHAR(64) NOT NULL,
+    codigo SMALLINT NULL,
+    cuerpo MEDIUMBLOB NULL,
+    expira TIMESTAMP NOT NULL,
+    INDEX idx_expira (expira)
+);
+
+-- ============= MIGRACIONES =============
+-- Cambios de esquema versionados. Cada bloque es idempotente (no falla si ya
+-- está aplicado, p. ej. en una base recién creada con este archivo) y queda
+-- registrado en esquema_migraciones. Las migraciones nuevas van al final.
+CREATE TABLE IF NOT EXISTS esquema_migraciones (
+    version INT PRIMARY KEY,
+    descripcion VARCHAR(200) NOT NULL,
+    aplicada TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+DROP PROCEDURE IF EXISTS agregar_columna_si_falta;
+DROP PROCEDURE IF EXISTS crear_indice_si_falta;
+
+DELIMITER //
+CREATE PROCEDURE agregar_columna_si_falta(IN tabla VARCHAR(64), IN columna VARCHAR(64), IN definicion VARCHAR(255))
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = tabla AND column_name = columna
+    ) THEN
+        SET @ddl = CONCAT('ALTER TABLE ', tabla, ' ADD COLUMN ', columna, ' ', definicion);
+        PREPARE sentencia FROM @ddl;
+        EXECUTE sentencia;
+        DEALLOCATE PREPARE sentencia;
+    END IF;
+END //
+
+CREATE PROCEDURE crear_indice_si_falta(IN tabla VARCHAR(64), IN indice VARCHAR(64), IN columnas VARCHAR(255), IN unico BOOLEAN)
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = tabla AND index_name = indice
+    ) THEN
+        SET @ddl = CONCAT('CREATE ', IF(unico, 'UNIQUE ', ''), 'INDEX ', indice, ' ON ', tabla, ' (', columnas, ')');
+        PREPARE sentencia FROM @ddl;
+        EXECUTE sentencia;
+        DEALLOCATE PREPARE sentencia;
+    END IF;
+END //
+DELIMITER ;
+
+-- 1: cobros en lote firmados e idempotentes (/transacciones/lote)
+CALL agregar_columna_si_falta('tarjeteros', 'clave_firma', 'VARCHAR(64)');
+CALL agregar_columna_si_falta('transacciones', 'clave', 'VARCHAR(64) NULL');
+CALL crear_indice_si_falta('transacciones', 'uk_tarjetero_clave', 'id_tarjetero, clave', TRUE);
+INSERT IGNORE INTO esquema_migraciones (version, descripcion) VALUES
+(1, 'Cobros en lote: tarjeteros.clave_firma y transacciones.clave');
+
+-- 2: índices para las consultas frecuentes (ver benchmarks/explain_consultas.py)
+-- login: una búsqueda indexada por identificador
+CALL crear_indice_si_falta('usuarios', 'idx_email', 'email', FALSE);
+CALL crear_indice_si_falta('usuarios', 'idx_nombre', 'nombre', FALSE);
+-- historial: filtro por usuario ya ordenado por (fecha, id), sin filesort
+CALL crear_indice_si_falta('transacciones', 'idx_usuario_fecha', 'id_usuario, fecha, id', FALSE);
+CALL crear_indice_si_falta('transferencias', 'idx_origen_fecha', 'id_origen, fecha, id', FALSE);
+CALL crear_indice_si_falta('transferencias', 'idx_destino_fecha', 'id_destino, fecha, id', FALSE);
+-- /tarjetero/<id>: últimas transacciones resueltas solo con el índice
+CALL crear_indice_si_falta('transacciones', 'idx_tarjetero_fecha', 'id_tarjetero, fecha, id_usuario, monto', FALSE);
+-- /api/tarjetas-disponibles: conteo por monto de las no usadas
+CALL crear_indice_si_falta('tarjetas_recarga', 'idx_usado_monto', 'usado, monto', FALSE);
+INSERT IGNORE INTO esquema_migraciones (version, descripcion) VALUES
+(2, 'Índices compuestos y de cobertura para login, historial y tarjeteros');
+
+-- 3: resúmenes diarios materializados (/api/resumen). Cada escritura de dinero
+-- los actualiza en su misma transacción (ver acumular_resumen en app.py); el
+-- relleno inicial desde transacciones/transferencias corre una sola vez.
+-- id_tarjetero = 0: transferencias entre usuarios.
+CREATE TABLE IF NOT EXISTS resumen_usuario_diario (
+    id_usuario INT NOT NULL,
+    dia DATE NOT NULL,
+    tipo VARCHAR(30) NOT NULL,
+    id_tarjetero INT NOT NULL DEFAULT 0,
+    cantidad INT NOT NULL DEFAULT 0,
+    total DECIMAL(14,2) NOT NULL DEFAULT 0.00,
+    PRIMARY KEY (id_usuario, dia, tipo, id_tarjetero)
+);
+
+-- Repartido en franjas como tarjeteros_saldo: los cobros concurrentes a un
+-- tarjetero no esperan por la fila del día. El total es SUM sobre las franjas.
+CREATE TABLE IF NOT EXISTS resumen_tarjetero_diario (
+    id_tarjetero INT NOT NULL,
+    dia DATE NOT NULL,
+    tipo VARCHAR(30) NOT NULL,
+    franja TINYINT UNSIGNED NOT NULL,
+    cantidad INT NOT NULL DEFAULT 0,
+    total DECIMAL(14,2) NOT NULL DEFAULT 0.00,
+    PRIMARY KEY (id_tarjetero, dia, tipo, franja)
+);
+
+DROP PROCEDURE IF EXISTS migracion_3_resumen;
+
+DELIMITER //
+CREATE PROCEDURE migracion_3_resumen()
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM esquema_migraciones WHERE version = 3) THEN
+        INSERT INTO resumen_usuario_diario (id_usuario, dia, tipo, id_tarjetero, cantidad, total)
+        SELECT id_usuario, DATE(fecha), tipo, id_tarjetero, COUNT(*), SUM(monto)
+        FROM transacciones
+        WHERE estado = 'aprobada'
+        GROUP BY id_usuario, DATE(fecha), tipo, id_tarjetero;
+
+        INSERT INTO resumen_usuario_diario (id_usuario, dia, tipo, id_tarjetero, cantidad, total)
+        SELECT id_origen, DATE(fecha), 'transferencia_enviada', 0, COUNT(*), SUM(monto)
+        FROM transferencias
+        GROUP BY id_origen, DATE(fecha);
+
+        INSERT INTO resumen_usuario_diario (id_usuario, dia, tipo, id_tarjetero, cantidad, total)
+        SELECT id_destino, DATE(fecha), 'transferencia_recibida', 0, COUNT(*), SUM(monto)
+        FROM transferencias
+        GROUP BY id_destino, DATE(fecha);
+
+        INSERT INTO resumen_tarjetero_diario (id_tarjetero, dia, tipo, franja, cantidad, total)
+        SELECT id_tarjetero, DATE(fecha), tipo, 0, COUNT(*), SUM(monto)
+        FROM transacciones
+        WHERE estado = 'aprobada'
+        GROUP BY id_tarjetero, DATE(fecha), tipo;
+
+        INSERT INTO esquema_migraciones (version, descripcion) VALUES
+        (3, 'Resúmenes diarios por usuario y por tarjetero');
+    END IF;
+END //
+DELIMITER ;
+
+CALL migracion_3_resumen();
+DROP PROCEDURE migracion_3_resumen;
+
+-- 4: capa fría del historial (ver archivo_historial.py). Las filas más viejas que
+-- ARCHIVO_DIAS se mueven aquí conservando su id; tablas comprimidas y sin
+-- claves foráneas, con solo los índices que usa el historial.
+CREATE TABLE IF NOT EXISTS transacciones_archivo (
+    id INT PRIMARY KEY,
+    id_tarjetero INT NOT NULL,
+    id_usuario INT NOT NULL,
+    monto DECIMAL(10,2) NOT NULL,
+    tipo ENUM('cobro', 'recarga') DEFAULT 'cobro',
+    estado ENUM('aprobada', 'rechazada', 'pendiente') DEFAULT 'aprobada',
+    fecha TIMESTAMP NOT NULL,
+    descripcion TEXT,
+    clave VARCHAR(64) NULL,
+    secuencia_motor BIGINT UNSIGNED NULL,
+    UNIQUE KEY uk_secuencia_motor (secuencia_motor),
+    INDEX idx_usuario_fecha (id_usuario, fecha, id),
+    INDEX idx_tarjetero_fecha (id_tarjetero, fecha)
+) ROW_FORMAT=COMPRESSED;
+
+CREATE TABLE IF NOT EXISTS transferencias_archivo (
+    id INT PRIMARY KEY,
+    id_origen INT NOT NULL,
+    id_destino INT NOT NULL,
+    monto DECIMAL(10,2) NOT NULL,
+    descripcion TEXT,
+    fecha TIMESTAMP NOT NULL,
+    secuencia_motor BIGINT UNSIGNED NULL,
+    UNIQUE KEY uk_secuencia_motor (secuencia_motor),
+    INDEX idx_origen_fecha (id_origen, fecha, id),
+    INDEX idx_destino_fecha (id_destino, fecha, id)
+) ROW_FORMAT=COMPRESSED;
+
+INSERT IGNORE INTO esquema_migraciones (version, descripcion) VALUES
+(4, 'Tablas de archivo para transacciones y transferencias');
+
+-- 5: códigos de recarga generados en lote (/api/admin/tarjetas-recarga) y
+-- contador de disponibles por monto, mantenido en la misma transacción que la
+-- generación y el canje
+ALTER TABLE tarjetas_recarga MODIFY codigo VARCHAR(32) NOT NULL;
+
+CREATE TABLE IF NOT EXISTS tarjetas_recarga_stock (
+    monto DECIMAL(10,2) PRIMARY KEY,
+    disponibles INT NOT NULL DEFAULT 0
+);
+
+DROP PROCEDURE IF EXISTS migracion_5_stock_recarga;
+
+DELIMITER //
+CREATE PROCEDURE migracion_5_stock_recarga()
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM esquema_migraciones WHERE version = 5) THEN
+        INSERT INTO tarjetas_recarga_stock (monto, disponibles)
+        SELECT monto, COUNT(*)
+        FROM tarjetas_recarga
+        WHERE usado = FALSE
+        GROUP BY monto
+        ON DUPLICATE KEY UPDATE disponibles = VALUES(disponibles);
+
+        INSERT INTO esquema_migraciones (version, descripcion) VALUES
+        (5, 'Códigos de recarga en lote y contador de disponibles');
+    END IF;
+END //
+DELIMITER ;
+
+CALL migracion_5_stock_recarga();
+DROP PROCEDURE migracion_5_stock_recarga;
+
+-- 6: motor de saldos en memoria (motor_saldos.py, MOTOR_SALDOS=1): última
+-- secuencia del log local ya aplicada a usuarios.saldo y tarjeteros_saldo
+CREATE TABLE IF NOT EXISTS motor_saldos_estado (
+    id TINYINT PRIMARY KEY,
+    secuencia BIGINT UNSIGNED NOT NULL DEFAULT 0
+);
+
+INSERT IGNORE INTO motor_saldos_estado (id, secuencia) VALUES (1, 0);
+
+INSERT IGNORE INTO esquema_migraciones (version, descripcion) VALUES
+(6, 'Estado de replicación del motor de saldos');
+
+-- 7: cada movimiento del motor de saldos guarda su secuencia en la fila de
+-- historial que lo registra; al arrancar solo se reaplican los movimientos del
+-- log con fila. Replicar todo el log (motor_saldos_estado) antes de actualizar.
+CALL agregar_columna_si_falta('transacciones', 'secuencia_motor', 'BIGINT UNSIGNED NULL');
+CALL agregar_columna_si_falta('transferencias', 'secuencia_motor', 'BIGINT UNSIGNED NULL');
+CALL crear_indice_si_falta('transacciones', 'uk_secuencia_motor', 'secuencia_motor', TRUE);
+CALL crear_indice_si_falta('transferencias', 'uk_secuencia_motor', 'secuencia_motor', TRUE);
+
+INSERT IGNORE INTO esquema_migraciones (version, descripcion) VALUES
+(7, 'Secuencia del motor de saldos en el historial');
+
+-- 8: versiones de la caché de /api/perfil y /tarjetero/<id> compartidas entre
+-- workers (CACHE_RECURSOS_BACKEND=mysql, ver cache_recursos.py)
+CREATE TABLE IF NOT EXISTS versiones_recurso (
+    recurso VARCHAR(64) PRIMARY KEY,
+    version BIGINT UNSIGNED NOT NULL DEFAULT 0
+);
+
+INSERT IGNORE INTO esquema_migraciones (version, descripcion) VALUES
+(8, 'Versiones compartidas de la caché de recursos');
+
+-- 9: el archivo conserva secuencia_motor, así los movimientos del motor de
+-- saldos archivados se siguen encontrando al reconciliar el log
+CALL agregar_columna_si_falta('transacciones_archivo', 'secuencia_motor', 'BIGINT UNSIGNED NULL');
+CALL agregar_columna_si_falta('transferencias_archivo', 'secuencia_motor', 'BIGINT UNSIGNED NULL');
+CALL crear_indice_si_falta('transacciones_archivo', 'uk_secuencia_motor', 'secuencia_motor', TRUE);
+CALL crear_indice_si_falta('transferencias_archivo', 'uk_secuencia_motor', 'secuencia_motor', TRUE);
+
+INSERT IGNORE INTO esquema_migraciones (version, descripcion) VALUES
+(9, 'secuencia_motor en las tablas de archivo');
+
+-- 10: franjas de saldo (tarjeteros_saldo) de los tarjeteros existentes. Los
+-- tarjeteros nuevos las crean en su primer cobro (crear_franjas en app.py).
+INSERT IGNORE INTO tarjeteros_saldo (id_tarjetero, franja)
+SELECT t.id, f.n
+FROM tarjeteros t
+CROSS JOIN (SELECT 0 AS n UNION ALL SELECT 1 UNION ALL SELECT 2 UNION ALL SELECT 3
+            UNION ALL SELECT 4 UNION ALL SELECT 5 UNION ALL SELECT 6 UNION ALL SELECT 7) f;
+
+INSERT IGNORE INTO esquema_migraciones (version, descripcion) VALUES
+(10, 'Franjas de saldo de los tarjeteros existentes');
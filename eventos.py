@@ -0,0 +1,88 @@
+import asyncio
+import queue
+import threading
+
+
+class HubEventos:
+    # Publicación/suscripción en el proceso: cada conexión SSE abierta tiene
+    # una cola acotada; si el cliente no consume, se descartan los eventos
+    # más viejos en lugar de bloquear a quien publica.
+
+    def __init__(self, max_cola=100):
+        self.max_cola = max_cola
+        self._suscriptores = {}     # user_id -> set(queue.Queue)
+        self._lock = threading.Lock()
+        self._publicados = 0
+        self._descartados = 0
+
+    def suscribir(self, user_id, cola=None):
+        # `cola` permite suscriptores que no son hilos (ver ColaAsync)
+        if cola is None:
+            cola = queue.Queue(maxsize=self.max_cola)
+        with self._lock:
+            self._suscriptores.setdefault(user_id, set()).add(cola)
+        return cola
+
+    def desuscribir(self, user_id, cola):
+        with self._lock:
+            colas = self._suscriptores.get(user_id)
+            if colas:
+                colas.discard(cola)
+                if not colas:
+                    del self._suscriptores[user_id]
+
+    def publicar(self, user_id, evento):
+        with self._lock:
+            colas = list(self._suscriptores.get(user_id, ()))
+            self._publicados += 1
+        for cola in colas:
+            while True:
+                try:
+                    cola.put_nowait(evento)
+                    break
+                except queue.Full:
+                    try:
+                        cola.get_nowait()
+                        self._descartado()
+                    except queue.Empty:
+                        pass
+
+    def _descartado(self):
+        with self._lock:
+            self._descartados += 1
+
+    def metricas(self):
+        with self._lock:
+            return {
+                'usuarios_conectados': len(self._suscriptores),
+                'conexiones': sum(len(c) for c in self._suscriptores.values()),
+                'publicados': self._publicados,
+                'descartados': self._descartados,
+            }
+
+
+class ColaAsync:
+    # Cola de un suscriptor asyncio (modo ASGI). publicar() corre en hilos de
+    # Flask, así que la entrega se agenda en el loop dueño de la cola; si está
+    # llena se descarta el evento más viejo, igual que con queue.Queue.
+
+    def __init__(self, hub, loop):
+        self._hub = hub
+        self._loop = loop
+        self._cola = asyncio.Queue(maxsize=hub.max_cola)
+
+    def put_nowait(self, evento):
+        try:
+            self._loop.call_soon_threadsafe(self._entregar, evento)
+        except RuntimeError:
+            pass    # loop cerrado: el suscriptor ya no existe
+
+    def _entregar(self, evento):
+        if self._cola.full():
+            self._cola.get_nowait()
+            self._hub._descartado()
+        self._cola.put_nowait(evento)
+
+    async def get(self, timeout):
+        # Lanza asyncio.TimeoutError si no llega nada en `timeout` segundos
+        return await asyncio.wait_for(self._cola.get(), timeout)
@@ -0,0 +1,181 @@
+import csv
+import io
+import json
+import threading
+from datetime import timedelta
+
+import mysql.connector
+from mysql.connector import Error
+
+COLUMNAS = ['id_usuario', 'fecha', 'id', 'tipo', 'estado', 'monto', 'descripcion', 'contraparte']
+
+# Cobros y transferencias enviadas restan, recargas y transferencias recibidas suman
+RAMAS = [
+    """
+        SELECT t.id_usuario, t.fecha, t.id, t.tipo, t.estado,
+               IF(t.tipo = 'cobro', -t.monto, t.monto) AS monto,
+               t.descripcion, tar.nombre AS contraparte
+        FROM {transacciones} t
+        LEFT JOIN tarjeteros tar ON tar.id = t.id_tarjetero
+        WHERE t.id_usuario BETWEEN %s AND %s AND t.fecha >= %s AND t.fecha < %s""",
+    """
+        SELECT tf.id_origen, tf.fecha, tf.id, 'transferencia_enviada', 'completada', -tf.monto,
+               tf.descripcion, u.nombre
+        FROM {transferencias} tf
+        JOIN usuarios u ON u.id = tf.id_destino
+        WHERE tf.id_origen BETWEEN %s AND %s AND tf.fecha >= %s AND tf.fecha < %s""",
+    """
+        SELECT tf.id_destino, tf.fecha, tf.id, 'transferencia_recibida', 'completada', tf.monto,
+               tf.descripcion, u.nombre
+        FROM {transferencias} tf
+        JOIN usuarios u ON u.id = tf.id_origen
+        WHERE tf.id_destino BETWEEN %s AND %s AND tf.fecha >= %s AND tf.fecha < %s""",
+]
+
+# Capa viva y de archivo (ver archivo_historial.py)
+CAPAS = [
+    {'transacciones': 'transacciones', 'transferencias': 'transferencias'},
+    {'transacciones': 'transacciones_archivo', 'transferencias': 'transferencias_archivo'},
+]
+
+CONSULTA = '\n        UNION ALL'.join(rama.format(**capa) for capa in CAPAS for rama in RAMAS) + """
+        ORDER BY id_usuario, fecha, id"""
+
+
+class Exportacion:
+    # Cupo tomado por una exportación en curso
+
+    def __init__(self):
+        self.completa = False
+        self.liberada = False
+
+
+class ExtractoSaturado(Exception):
+    # Ya hay max_simultaneos exportaciones corriendo
+
+    def __init__(self, retry_after):
+        super().__init__('Demasiadas exportaciones en curso')
+        self.retry_after = retry_after
+
+
+def _valor_json(valor):
+    return valor.isoformat() if hasattr(valor, 'isoformat') else str(valor)
+
+
+def formatear_csv(filas, columnas):
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    if filas is None:
+        escritor.writerow(columnas)
+    else:
+        for fila in filas:
+            escritor.writerow(fila[c] for c in columnas)
+    return buffer.getvalue()
+
+
+def formatear_jsonl(filas, columnas):
+    if filas is None:
+        return ''
+    return ''.join(json.dumps({c: fila[c] for c in columnas}, default=_valor_json) + '\n' for fila in filas)
+
+
+FORMATOS = {
+    'csv': ('text/csv; charset=utf-8', formatear_csv),
+    'jsonl': ('application/x-ndjson', formatear_jsonl),
+}
+
+
+class ExportadorExtractos:
+    # Extractos de cuenta en streaming: cada exportación usa su propia conexión
+    # (fuera del pool de las rutas, puede durar minutos) y un cursor sin buffer,
+    # y entrega las filas en tandas de `tanda`. La memoria no depende del rango.
+
+    def __init__(self, db_config, max_simultaneos=2, tanda=500, usuarios_por_tramo=500, retry_after=5):
+        self.db_config = db_config
+        self.max_simultaneos = max_simultaneos
+        self.tanda = tanda
+        self.usuarios_por_tramo = usuarios_por_tramo
+        self.retry_after = retry_after
+        self._cupos = threading.BoundedSemaphore(max_simultaneos)
+        self._lock = threading.Lock()
+        self._en_curso = 0
+        self._completadas = 0
+        self._cortadas = 0
+        self._rechazadas = 0
+        self._filas = 0
+
+    def _tramos(self, conn, desde_usuario, hasta_usuario):
+        if hasta_usuario is not None:
+            yield desde_usuario, hasta_usuario
+            return
+        cursor = conn.cursor()
+        cursor.execute("SELECT MAX(id) FROM usuarios")
+        maximo = cursor.fetchone()[0] or 0
+        cursor.close()
+        for inicio in range(desde_usuario, maximo + 1, self.usuarios_por_tramo):
+            yield inicio, min(inicio + self.usuarios_por_tramo - 1, maximo)
+
+    def reservar(self):
+        # Toma un cupo; quien reserva debe llamar a liberar() (idempotente)
+        if not self._cupos.acquire(blocking=False):
+            with self._lock:
+                self._rechazadas += 1
+            raise ExtractoSaturado(self.retry_after)
+        with self._lock:
+            self._en_curso += 1
+        return Exportacion()
+
+    def liberar(self, exportacion):
+        with self._lock:
+            if exportacion.liberada:
+                return
+            exportacion.liberada = True
+            self._en_curso -= 1
+            if exportacion.completa:
+                self._completadas += 1
+            else:
+                self._cortadas += 1
+        self._cupos.release()
+
+    def generar(self, exportacion, formato, columnas, desde, hasta, desde_usuario=1, hasta_usuario=None):
+        # Trozos de texto del extracto entre las fechas desde y hasta (inclusive).
+        # Sin hasta_usuario exporta todos los usuarios, un tramo de ids por consulta.
+        formatear = FORMATOS[formato][1]
+        hasta = hasta + timedelta(days=1)
+        conn = None
+        try:
+            conn = mysql.connector.connect(**self.db_config, autocommit=True)
+            cabecera = formatear(None, columnas)
+            if cabecera:
+                yield cabecera
+            for primero, ultimo in self._tramos(conn, desde_usuario, hasta_usuario):
+                cursor = conn.cursor(dictionary=True, buffered=False)
+                cursor.execute(CONSULTA, (primero, ultimo, desde, hasta) * len(RAMAS) * len(CAPAS))
+                while True:
+                    filas = cursor.fetchmany(self.tanda)
+                    if not filas:
+                        break
+                    with self._lock:
+                        self._filas += len(filas)
+                    yield formatear(filas, columnas)
+                cursor.close()
+            exportacion.completa = True
+        finally:
+            # Cliente desconectado a mitad: se cierra la conexión sin leer el resto
+            if conn is not None:
+                try:
+                    conn.close()
+                except Error:
+                    pass
+            self.liberar(exportacion)
+
+    def metricas(self):
+        with self._lock:
+            return {
+                'en_curso': self._en_curso,
+                'max_simultaneos': self.max_simultaneos,
+                'completadas': self._completadas,
+                'cortadas': self._cortadas,
+                'rechazadas': self._rechazadas,
+                'filas': self._filas,
+            }
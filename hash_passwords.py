@@ -0,0 +1,127 @@
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+import bcrypt
+
+
+class HashSaturado(Exception):
+    # La cola de hashing está llena: el cliente debe reintentar luego
+
+    def __init__(self, retry_after):
+        super().__init__('Servicio de autenticación saturado')
+        self.retry_after = retry_after
+
+
+# Funciones ejecutadas en los procesos hijos (deben ser de nivel de módulo)
+def _checkpw(password, hash_guardado):
+    inicio = time.perf_counter()
+    valida = bcrypt.checkpw(password, hash_guardado)
+    return valida, time.perf_counter() - inicio
+
+
+def _hashpw(password, costo):
+    inicio = time.perf_counter()
+    nuevo_hash = bcrypt.hashpw(password, bcrypt.gensalt(costo))
+    return nuevo_hash, time.perf_counter() - inicio
+
+
+def costo_de_hash(hash_guardado):
+    # '$2b$12$...' -> 12
+    try:
+        return int(hash_guardado.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class PoolHash:
+    # bcrypt fuera de los hilos de Flask: un pool de procesos con un número
+    # acotado de trabajos en vuelo (en cola + ejecutándose).
+
+    def __init__(self, procesos=2, max_cola=16, costo=12, timeout=10.0, retry_after=1):
+        self.procesos = procesos
+        self.max_cola = max_cola
+        self.costo = costo
+        self.timeout = timeout
+        self.retry_after = retry_after
+
+        self._ejecutor = None
+        self._cupos = threading.BoundedSemaphore(max_cola)
+        self._lock = threading.Lock()
+
+        self._en_vuelo = 0
+        self._hashes = 0
+        self._tiempo_total = 0.0
+        self._tiempo_max = 0.0
+        self._espera_total = 0.0
+        self._rechazos = 0
+
+    def _obtener_ejecutor(self):
+        # Los procesos se crean en el primer uso, no al importar app.py. Con
+        # spawn y no fork: un fork del servidor con hilos copia los locks que
+        # otro hilo tenga tomados en ese momento y el hijo puede quedar colgado
+        with self._lock:
+            if self._ejecutor is None:
+                self._ejecutor = ProcessPoolExecutor(max_workers=self.procesos,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            return self._ejecutor
+
+    def _terminado(self, futuro, enviado):
+        with self._lock:
+            self._en_vuelo -= 1
+            if not futuro.cancelled() and futuro.exception() is None:
+                _, duracion = futuro.result()
+                self._hashes += 1
+                self._tiempo_total += duracion
+                self._espera_total += max(0.0, time.monotonic() - enviado - duracion)
+                if duracion > self._tiempo_max:
+                    self._tiempo_max = duracion
+        self._cupos.release()
+
+    def _ejecutar(self, funcion, *args):
+        if not self._cupos.acquire(blocking=False):
+            with self._lock:
+                self._rechazos += 1
+            raise HashSaturado(self.retry_after)
+
+        enviado = time.monotonic()
+        with self._lock:
+            self._en_vuelo += 1
+        try:
+            futuro = self._obtener_ejecutor().submit(funcion, *args)
+        except Exception:
+            with self._lock:
+                self._en_vuelo -= 1
+            self._cupos.release()
+            raise
+        futuro.add_done_callback(lambda f: self._terminado(f, enviado))
+
+        try:
+            resultado, _ = futuro.result(timeout=self.timeout)
+        except TimeoutError:
+            raise HashSaturado(self.retry_after)
+        return resultado
+
+    def verificar(self, password, hash_guardado):
+        return self._ejecutar(_checkpw, password.encode('utf-8'), hash_guardado.encode('utf-8'))
+
+    def generar_hash(self, password):
+        return self._ejecutar(_hashpw, password.encode('utf-8'), self.costo).decode('utf-8')
+
+    def necesita_rehash(self, hash_guardado):
+        return costo_de_hash(hash_guardado) != self.costo
+
+    def metricas(self):
+        with self._lock:
+            return {
+                'procesos': self.procesos,
+                'costo': self.costo,
+                'en_cola': self._en_vuelo,
+                'max_cola': self.max_cola,
+                'hashes': self._hashes,
+                'hash_promedio_ms': round(self._tiempo_total / self._hashes * 1000, 3) if self._hashes else 0.0,
+                'hash_max_ms': round(self._tiempo_max * 1000, 3),
+                'espera_promedio_ms': round(self._espera_total / self._hashes * 1000, 3) if self._hashes else 0.0,
+                'rechazos': self._rechazos,
+            }
@@ -0,0 +1,184 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from mysql.connector import IntegrityError
+
+RespuestaGuardada = namedtuple('RespuestaGuardada', ['codigo', 'cuerpo'])
+
+
+class ClaveEnCurso(Exception):
+    # Otra petición con la misma clave sigue ejecutándose
+
+    def __init__(self, retry_after):
+        super().__init__('Petición con la misma Idempotency-Key en curso')
+        self.retry_after = retry_after
+
+
+class ClaveReutilizada(Exception):
+    # La clave ya se usó con un cuerpo distinto
+    pass
+
+
+def hash_clave(ambito, clave):
+    return hashlib.sha256(f'{ambito}\0{clave}'.encode('utf-8')).hexdigest()
+
+
+# Marca de clave reservada cuya petición aún no terminó
+EN_CURSO = object()
+
+
+class IdempotenciaMemoria:
+    # Claves recientes en el proceso: LRU acotada con TTL. Una clave en curso
+    # hace esperar (hasta `espera` segundos) a los duplicados concurrentes, que
+    # después reciben la respuesta guardada. Sirve para un solo worker.
+
+    def __init__(self, ttl=86400, max_claves=100000, espera=10.0, ttl_en_curso=60, retry_after=1):
+        self.ttl = ttl
+        self.max_claves = max_claves
+        self.espera = espera
+        self.ttl_en_curso = ttl_en_curso
+        self.retry_after = retry_after
+        self._claves = OrderedDict()    # hash -> (EN_CURSO | RespuestaGuardada, huella, expira)
+        self._cond = threading.Condition()
+        self._reservas = 0
+        self._repeticiones = 0
+        self._esperas = 0
+
+    def reservar(self, ambito, clave, huella):
+        # None: la petición debe ejecutarse y luego llamar a guardar() o liberar().
+        # RespuestaGuardada: repetir esa respuesta sin ejecutar nada.
+        h = hash_clave(ambito, clave)
+        limite = time.monotonic() + self.espera
+        with self._cond:
+            while True:
+                ahora = time.monotonic()
+                entrada = self._claves.get(h)
+                if entrada and entrada[2] <= ahora:
+                    del self._claves[h]
+                    entrada = None
+                if not entrada:
+                    self._claves[h] = (EN_CURSO, huella, ahora + self.ttl_en_curso)
+                    self._recortar()
+                    self._reservas += 1
+                    return None
+                if entrada[1] != huella:
+                    raise ClaveReutilizada()
+                if entrada[0] is not EN_CURSO:
+                    self._claves.move_to_end(h)
+                    self._repeticiones += 1
+                    return entrada[0]
+                restante = limite - ahora
+                if restante <= 0:
+                    raise ClaveEnCurso(self.retry_after)
+                self._esperas += 1
+                self._cond.wait(restante)
+
+    def guardar(self, ambito, clave, huella, codigo, cuerpo):
+        h = hash_clave(ambito, clave)
+        with self._cond:
+            self._claves[h] = (RespuestaGuardada(codigo, cuerpo), huella, time.monotonic() + self.ttl)
+            self._claves.move_to_end(h)
+            self._recortar()
+            self._cond.notify_all()
+
+    def liberar(self, ambito, clave):
+        # La petición falló sin respuesta definitiva: se permite reintentar
+        with self._cond:
+            self._claves.pop(hash_clave(ambito, clave), None)
+            self._cond.notify_all()
+
+    def _recortar(self):
+        while len(self._claves) > self.max_claves:
+            self._claves.popitem(last=False)
+
+    def purgar_expiradas(self):
+        ahora = time.monotonic()
+        with self._cond:
+            expiradas = [h for h, entrada in self._claves.items() if entrada[2] <= ahora]
+            for h in expiradas:
+                del self._claves[h]
+        return len(expiradas)
+
+    def metricas(self):
+        with self._cond:
+            return {
+                'claves': len(self._claves),
+                'max_claves': self.max_claves,
+                'reservas': self._reservas,
+                'repeticiones': self._repeticiones,
+                'esperas': self._esperas,
+            }
+
+
+class IdempotenciaMySQL:
+    # Claves en la tabla `idempotencia` (ver db.sql), compartidas entre workers.
+    # La PRIMARY KEY resuelve la carrera entre duplicados: solo un INSERT gana;
+    # los demás consultan la fila hasta que tenga respuesta.
+
+    INTERVALO_CONSULTA = 0.05
+
+    def __init__(self, conectar, ttl=86400, espera=10.0, ttl_en_curso=60, retry_after=1):
+        self.conectar = conectar
+        self.ttl = ttl
+        self.espera = espera
+        self.ttl_en_curso = ttl_en_curso
+        self.retry_after = retry_after
+
+    def _ejecutar(self, sql, params, leer=False):
+        conn = self.conectar()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(sql, params)
+            if leer:
+                return cursor.fetchone()
+            conn.commit()
+            return cursor.rowcount
+        finally:
+            cursor.close()
+            conn.close()
+
+    def reservar(self, ambito, clave, huella):
+        h = hash_clave(ambito, clave)
+        limite = time.monotonic() + self.espera
+        while True:
+            # Una reserva vencida (worker caído) deja de bloquear la clave
+            self._ejecutar("DELETE FROM idempotencia WHERE clave_hash = %s AND expira <= NOW()", (h,))
+            try:
+                self._ejecutar("""
+                    INSERT INTO idempotencia (clave_hash, huella, expira)
+                    VALUES (%s, %s, NOW() + INTERVAL %s SECOND)
+                """, (h, huella, self.ttl_en_curso))
+                return None
+            except IntegrityError:
+                pass
+
+            fila = self._ejecutar(
+                "SELECT huella, codigo, cuerpo FROM idempotencia WHERE clave_hash = %s", (h,), leer=True
+            )
+            if fila:
+                if fila[0] != huella:
+                    raise ClaveReutilizada()
+                if fila[1] is not None:
+                    return RespuestaGuardada(fila[1], bytes(fila[2]))
+            if time.monotonic() >= limite:
+                raise ClaveEnCurso(self.retry_after)
+            time.sleep(self.INTERVALO_CONSULTA)
+
+    def guardar(self, ambito, clave, huella, codigo, cuerpo):
+        self._ejecutar("""
+            UPDATE idempotencia SET codigo = %s, cuerpo = %s, expira = NOW() + INTERVAL %s SECOND
+            WHERE clave_hash = %s
+        """, (codigo, cuerpo, self.ttl, hash_clave(ambito, clave)))
+
+    def liberar(self, ambito, clave):
+        self._ejecutar("DELETE FROM idempotencia WHERE clave_hash = %s AND codigo IS NULL",
+                       (hash_clave(ambito, clave),))
+
+    def purgar_expiradas(self):
+        return self._ejecutar("DELETE FROM idempotencia WHERE expira <= NOW() LIMIT 5000", ())
+
+    def metricas(self):
+        fila = self._ejecutar("SELECT COUNT(*) FROM idempotencia", (), leer=True)
+        return {'claves': fila[0]}
@@ -0,0 +1,268 @@
+import re
+import threading
+import time
+from bisect import bisect_left
+from functools import lru_cache
+
+from mysql.connector import Error
+
+# Límites de los histogramas en segundos (mismos que usa el cliente oficial de Prometheus)
+LIMITES = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Errores de MySQL que indican espera por bloqueos
+ERRORES_BLOQUEO = {1205: 'lock_wait_timeout', 1213: 'deadlock'}
+
+_PATRON_SENTENCIA = re.compile(
+    r'^\s*(?:\(\s*)?(SELECT|INSERT|UPDATE|DELETE|REPLACE|SHOW|EXPLAIN|CALL)\b'
+    r'(?:.*?\b(?:FROM|INTO|UPDATE|JOIN)\s+`?(\w+))?',
+    re.IGNORECASE | re.DOTALL
+)
+
+
+@lru_cache(maxsize=512)
+def etiqueta_sql(sql):
+    # "UPDATE usuarios", "SELECT transacciones FOR UPDATE"... Acotada para que
+    # los INSERT de varias filas o IN (...) de largo variable compartan etiqueta
+    encontrado = _PATRON_SENTENCIA.match(sql[:400])
+    if not encontrado:
+        return 'otra'
+    verbo = encontrado.group(1).upper()
+    if verbo == 'UPDATE':
+        tabla = re.match(r'\s*UPDATE\s+`?(\w+)', sql, re.IGNORECASE).group(1)
+    else:
+        tabla = encontrado.group(2) or ''
+    etiqueta = f'{verbo} {tabla}'.strip()
+    if verbo == 'SELECT' and re.search(r'\bFOR\s+UPDATE\b|\bLOCK\s+IN\s+SHARE\s+MODE\b', sql, re.IGNORECASE):
+        etiqueta += ' FOR UPDATE'
+    return etiqueta
+
+
+class Histograma:
+    # Conteos acumulables por etiqueta; un lock por familia de métricas
+
+    def __init__(self, nombre, ayuda, etiquetas):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self._series = {}       # valores de etiquetas -> [conteos por límite, suma, total]
+        self._lock = threading.Lock()
+
+    def observar(self, valores, segundos):
+        i = bisect_left(LIMITES, segundos)
+        with self._lock:
+            serie = self._series.get(valores)
+            if serie is None:
+                serie = self._series[valores] = [[0] * len(LIMITES), 0.0, 0]
+            if i < len(LIMITES):
+                serie[0][i] += 1
+            serie[1] += segundos
+            serie[2] += 1
+
+    def exponer(self):
+        lineas = [f'# HELP {self.nombre} {self.ayuda}', f'# TYPE {self.nombre} histogram']
+        with self._lock:
+            series = [(valores, list(s[0]), s[1], s[2]) for valores, s in self._series.items()]
+        for valores, conteos, suma, total in sorted(series):
+            base = ','.join(f'{e}="{_escapar(v)}"' for e, v in zip(self.etiquetas, valores))
+            separador = ',' if base else ''
+            acumulado = 0
+            for limite, conteo in zip(LIMITES, conteos):
+                acumulado += conteo
+                lineas.append(f'{self.nombre}_bucket{{{base}{separador}le="{limite}"}} {acumulado}')
+            lineas.append(f'{self.nombre}_bucket{{{base}{separador}le="+Inf"}} {total}')
+            lineas.append(f'{self.nombre}_sum{_llaves(base)} {suma:.6f}')
+            lineas.append(f'{self.nombre}_count{_llaves(base)} {total}')
+        return lineas
+
+
+class Contador:
+
+    def __init__(self, nombre, ayuda, etiquetas):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = etiquetas
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def sumar(self, valores, n=1):
+        with self._lock:
+            self._series[valores] = self._series.get(valores, 0) + n
+
+    def exponer(self):
+        lineas = [f'# HELP {self.nombre} {self.ayuda}', f'# TYPE {self.nombre} counter']
+        with self._lock:
+            series = sorted(self._series.items())
+        for valores, total in series:
+            base = ','.join(f'{e}="{_escapar(v)}"' for e, v in zip(self.etiquetas, valores))
+            lineas.append(f'{self.nombre}{_llaves(base)} {total}')
+        return lineas
+
+
+def _llaves(base):
+    return f'{{{base}}}' if base else ''
+
+
+def _escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class CursorMedido:
+    # Envoltorio del cursor de mysql.connector: mide cada execute() y anota la
+    # etiqueta de la sentencia, las filas y los errores por bloqueo. Los
+    # cursores del pool no usan buffer: tras un SELECT rowcount vale -1, así
+    # que las filas se cuentan a medida que se leen y se anotan al pasar a la
+    # siguiente sentencia o al cerrar el cursor.
+
+    def __init__(self, cursor, medidor):
+        self._cursor = cursor
+        self._medidor = medidor
+        self._lectura = None        # (sql, segundos) del resultado que se está leyendo
+        self._filas = 0
+
+    def __getattr__(self, nombre):
+        return getattr(self._cursor, nombre)
+
+    def __iter__(self):
+        for fila in self._cursor:
+            self._filas += 1
+            yield fila
+
+    def execute(self, sql, params=(), *args, **kwargs):
+        self._terminar_lectura()
+        inicio = time.perf_counter()
+        try:
+            resultado = self._cursor.execute(sql, params, *args, **kwargs)
+        except Error as e:
+            self._medidor.registrar_error_sql(sql, time.perf_counter() - inicio, e)
+            raise
+        segundos = time.perf_counter() - inicio
+        self._medidor.registrar_sql(sql, segundos)
+        if self._cursor.with_rows:
+            self._lectura = (sql, segundos)
+            self._filas = 0
+        else:
+            self._medidor.registrar_filas(sql, segundos, self._cursor.rowcount)
+        return resultado
+
+    def fetchone(self):
+        fila = self._cursor.fetchone()
+        if fila is not None:
+            self._filas += 1
+        return fila
+
+    def fetchmany(self, *args, **kwargs):
+        filas = self._cursor.fetchmany(*args, **kwargs)
+        self._filas += len(filas)
+        return filas
+
+    def fetchall(self):
+        filas = self._cursor.fetchall()
+        self._filas += len(filas)
+        return filas
+
+    def close(self):
+        self._terminar_lectura()
+        return self._cursor.close()
+
+    def _terminar_lectura(self):
+        if self._lectura:
+            sql, segundos = self._lectura
+            self._lectura = None
+            self._medidor.registrar_filas(sql, segundos, self._filas)
+
+
+class Medidor:
+    # Métricas por ruta y por sentencia SQL en formato Prometheus (ver /metrics).
+    # El tiempo de base de datos de la petición en curso se acumula en un
+    # threading.local; las sentencias más lentas que `lenta_ms` se registran.
+
+    def __init__(self, prefijo='bancamovil', lenta_ms=200):
+        self.prefijo = prefijo
+        self.lenta = lenta_ms / 1000
+        self._local = threading.local()
+        self.peticiones = Histograma(f'{prefijo}_peticion_segundos',
+                                     'Duración de las peticiones por ruta', ('ruta', 'metodo'))
+        self.peticiones_db = Histograma(f'{prefijo}_peticion_db_segundos',
+                                        'Tiempo de base de datos por petición (conexión, consultas y commit)',
+                                        ('ruta', 'metodo'))
+        self.respuestas = Contador(f'{prefijo}_peticiones_total', 'Peticiones por ruta y código',
+                                   ('ruta', 'metodo', 'codigo'))
+        self.sql = Histograma(f'{prefijo}_sql_segundos', 'Duración de las sentencias SQL', ('sentencia',))
+        self.sql_filas = Contador(f'{prefijo}_sql_filas_total', 'Filas devueltas o afectadas por sentencia',
+                                  ('sentencia',))
+        self.sql_errores = Contador(f'{prefijo}_sql_errores_total', 'Errores de MySQL por sentencia y tipo',
+                                    ('sentencia', 'tipo'))
+        self.conexion = Histograma(f'{prefijo}_db_conexion_segundos',
+                                   'Espera para obtener una conexión del pool', ())
+        self.commit = Histograma(f'{prefijo}_db_commit_segundos', 'Duración de los commit', ())
+        self.lentas = Contador(f'{prefijo}_sql_lentas_total', 'Sentencias sobre el umbral de consulta lenta',
+                               ('sentencia',))
+
+    # --- petición en curso ---
+    def iniciar_peticion(self):
+        self._local.inicio = time.perf_counter()
+        self._local.db = 0.0
+        self._local.ruta = None
+
+    def terminar_peticion(self, ruta, metodo, codigo):
+        # Devuelve (total, db) en segundos, o None si la petición no se inició aquí
+        inicio = getattr(self._local, 'inicio', None)
+        if inicio is None:
+            return None
+        total = time.perf_counter() - inicio
+        db = self._local.db
+        self._local.inicio = None
+        self.peticiones.observar((ruta, metodo), total)
+        self.peticiones_db.observar((ruta, metodo), db)
+        self.respuestas.sumar((ruta, metodo, str(codigo)))
+        return total, db
+
+    def fijar_ruta(self, ruta):
+        # Para el registro de consultas lentas
+        self._local.ruta = ruta
+
+    def _sumar_db(self, segundos):
+        if getattr(self._local, 'inicio', None) is not None:
+            self._local.db += segundos
+
+    # --- base de datos ---
+    def envolver_cursor(self, cursor):
+        return CursorMedido(cursor, self)
+
+    def registrar_conexion(self, segundos):
+        self.conexion.observar((), segundos)
+        self._sumar_db(segundos)
+
+    def registrar_commit(self, segundos):
+        self.commit.observar((), segundos)
+        self._sumar_db(segundos)
+
+    def registrar_sql(self, sql, segundos):
+        etiqueta = etiqueta_sql(sql)
+        self.sql.observar((etiqueta,), segundos)
+        self._sumar_db(segundos)
+        if segundos >= self.lenta:
+            self.lentas.sumar((etiqueta,))
+
+    def registrar_filas(self, sql, segundos, filas):
+        # Filas afectadas, o devueltas una vez leído el resultado
+        etiqueta = etiqueta_sql(sql)
+        if filas > 0:
+            self.sql_filas.sumar((etiqueta,), filas)
+        if segundos >= self.lenta:
+            ruta = getattr(self._local, 'ruta', None) or '-'
+            print(f"Consulta lenta ({segundos * 1000:.1f} ms, {filas} filas, {ruta}): {' '.join(sql.split())[:300]}")
+
+    def registrar_error_sql(self, sql, segundos, error):
+        # Un lock wait timeout puede tardar innodb_lock_wait_timeout segundos
+        etiqueta = etiqueta_sql(sql)
+        self.sql.observar((etiqueta,), segundos)
+        self._sumar_db(segundos)
+        self.sql_errores.sumar((etiqueta, ERRORES_BLOQUEO.get(getattr(error, 'errno', None), 'otro')))
+
+    def exponer(self):
+        lineas = []
+        for familia in (self.peticiones, self.peticiones_db, self.respuestas, self.sql, self.sql_filas,
+                        self.sql_errores, self.lentas, self.conexion, self.commit):
+            lineas.extend(familia.exponer())
+        return '\n'.join(lineas) + '\n'
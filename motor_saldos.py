@@ -0,0 +1,644 @@
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+from collections import deque
+from datetime import datetime
+from decimal import Decimal
+
+from mysql.connector import Error
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+USUARIO = 1
+TARJETERO = 2
+
+# Registro del log: secuencia, fecha, dos patas (tipo de cuenta, id, delta en
+# centavos; tipo 0 = pata vacía) y crc32 de todo lo anterior
+_REGISTRO = struct.Struct('<QdBqqBqq')
+_CRC = struct.Struct('<I')
+TAMANO_REGISTRO = _REGISTRO.size + _CRC.size
+
+# Cada movimiento queda registrado por una fila de historial que guarda su
+# secuencia (secuencia_motor en transacciones, transferencias o sus tablas de
+# archivo). Un movimiento sin esa fila no ocurrió: la transacción que lo
+# registraba no llegó a MySQL. Con LOCK IN SHARE MODE la consulta espera a una
+# transacción que ya insertó la fila y todavía no terminó, así ve su
+# resultado final.
+_TABLAS_HISTORIAL = ('transacciones', 'transferencias', 'transacciones_archivo', 'transferencias_archivo')
+_CONSULTA_REGISTRADOS = '\nUNION ALL\n'.join(
+    f"(SELECT secuencia_motor FROM {tabla} WHERE secuencia_motor {{filtro}} {{bloqueo}})"
+    for tabla in _TABLAS_HISTORIAL
+)
+
+# Estado de un movimiento hasta que se replica
+EN_CURSO = 'en_curso'           # la transacción que lo registra no terminó
+EN_COMMIT = 'en_commit'         # quien lo pidió está haciendo el commit
+CONFIRMADO = 'confirmado'       # su fila de historial está en MySQL
+ANULADO = 'anulado'             # no se registró: ya se deshizo en memoria
+EN_DUDA = 'en_duda'             # se comprueba contra MySQL antes de deshacerlo
+
+_CONSULTAS_SALDO = {
+    USUARIO: "SELECT saldo FROM usuarios WHERE id = %s",
+    TARJETERO: """
+        SELECT tar.saldo + COALESCE((SELECT SUM(f.saldo) FROM tarjeteros_saldo f
+                                     WHERE f.id_tarjetero = tar.id), 0) AS saldo
+        FROM tarjeteros tar WHERE tar.id = %s
+    """,
+}
+
+
+class SaldoInsuficiente(Exception):
+
+    def __init__(self, saldo):
+        super().__init__('Saldo insuficiente')
+        self.saldo = saldo
+
+
+class CuentaNoEncontrada(Exception):
+
+    def __init__(self, tipo, id_cuenta):
+        super().__init__(f"{'Usuario' if tipo == USUARIO else 'Tarjetero'} no encontrado")
+        self.tipo = tipo
+        self.id_cuenta = id_cuenta
+
+
+class MotorAveriado(Exception):
+    # No se pudo escribir el log: el motor deja de aceptar movimientos
+    pass
+
+
+class MovimientoVencido(MotorAveriado):
+    # El movimiento pasó max_en_curso sin commit y el motor ya lo está
+    # comprobando o lo deshizo: la transacción que lo registra debe deshacerse
+
+    def __init__(self, secuencia):
+        super().__init__(f'Movimiento {secuencia} vencido antes del commit')
+        self.secuencia = secuencia
+
+
+class Movimiento:
+    # Resultado de un movimiento ya durable en el log. Quien lo pidió guarda
+    # `secuencia` en la fila de historial, llama a preparar() justo antes del
+    # commit y al terminar a confirmar(), revertir() o resolver() del motor.
+
+    __slots__ = ('secuencia', 'patas', 'saldos', 'entrada')
+
+    def __init__(self, entrada, saldos):
+        self.secuencia = entrada[0]
+        self.patas = entrada[1]     # [(tipo, id, delta en centavos)]
+        self.saldos = saldos        # saldo final de cada pata
+        self.entrada = entrada      # [secuencia, patas, estado, creado] en _pendientes
+
+
+def centavos(monto):
+    return int(round(float(monto) * 100))
+
+
+class MotorSaldos:
+    # Saldos autoritativos en memoria. Cada cuenta (usuario o tarjetero) ocupa
+    # una posición de un array de enteros en centavos; los movimientos toman
+    # los locks de sus cuentas (repartidos en `bloqueos` franjas), validan y
+    # aplican en memoria, y se agregan a un log local que se escribe con un
+    # fsync por grupo: quien llega primero escribe lo acumulado por todos.
+    # Un hilo replica los movimientos durables y confirmados a usuarios.saldo
+    # y tarjeteros_saldo (franja 0) junto con la última secuencia replicada
+    # (motor_saldos_estado), así al arrancar solo se aplica la cola del log, y
+    # de ella solo los movimientos con fila de historial en MySQL.
+    #
+    # Las cuentas se cargan de MySQL en el primer uso: mientras una cuenta no
+    # está en memoria no tiene movimientos pendientes y MySQL está al día.
+    # Solo un proceso puede usar el log (se toma un flock); el motor arranca
+    # en el primer uso, no al importar app.py (ej. proceso padre del reloader).
+
+    def __init__(self, conectar, ruta='saldos.wal', fsync=True, bloqueos=1024, intervalo_replicacion=0.2,
+                 tanda_replicacion=5000, max_log_mb=64, max_en_curso=300):
+        self.conectar = conectar
+        self.ruta = ruta
+        self.fsync = fsync
+        self.intervalo_replicacion = intervalo_replicacion
+        self.tanda_replicacion = tanda_replicacion
+        self.max_log_bytes = max_log_mb * 1024 * 1024
+        # Un movimiento sin resolver pasado este tiempo (quien lo pidió no
+        # llamó a confirmar ni revertir) pasa a en duda y se comprueba contra MySQL
+        self.max_en_curso = max_en_curso
+        self._iniciado = False
+        self._lock_inicio = threading.Lock()
+
+        self._indices = {}              # (tipo, id) -> posición en _saldos
+        self._saldos = array('q')
+        self._lock_cuentas = threading.Lock()
+        self._bloqueos = [threading.Lock() for _ in range(bloqueos)]
+
+        self._fd = None
+        self._lock_log = threading.Lock()
+        self._escrito = threading.Condition(self._lock_log)
+        self._buffer = []
+        self._secuencia = 0             # última asignada
+        self._durable = 0               # última escrita en el log
+        self._escribiendo = False
+        self._averia = None
+        self._bytes_log = 0
+        self._pendientes = deque()      # [secuencia, patas, estado, creado] sin replicar
+        self._dudas = []
+        self._tardios = []              # patas confirmadas después de anularse
+        self._replicada = 0
+
+        self._movimientos = 0
+        self._rechazos = 0
+        self._reversiones = 0
+        self._reaplicados = 0
+        self._descartados_al_reproducir = 0
+        self._escrituras = 0
+        self._tiempo_escritura = 0.0
+        self._replicaciones = 0
+        self._errores_replicacion = 0
+        self._compactaciones = 0
+
+    # --- arranque ---
+    def _asegurar_iniciado(self):
+        if self._iniciado:
+            return
+        with self._lock_inicio:
+            if not self._iniciado:
+                self.iniciar()
+
+    def iniciar(self):
+        self._fd = os.open(self.ruta, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+        if fcntl:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(self._fd)
+                raise RuntimeError(f'El log de saldos {self.ruta} está en uso por otro proceso')
+
+        try:
+            conn = self.conectar()
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SELECT secuencia FROM motor_saldos_estado WHERE id = 1")
+                fila = cursor.fetchone()
+                replicada = fila[0] if fila else 0
+                aplicados = self._reproducir(cursor, replicada)
+            finally:
+                cursor.close()
+                conn.close()
+        except Exception:
+            # Sin MySQL no se puede reconstruir: se suelta el log y se descarta
+            # lo aplicado a medias, el próximo uso vuelve a intentar
+            os.close(self._fd)
+            self._fd = None
+            self._indices.clear()
+            del self._saldos[:]
+            self._pendientes.clear()
+            self._descartados_al_reproducir = 0
+            raise
+
+        if aplicados:
+            print(f"Motor de saldos: {aplicados} movimientos del log reaplicados")
+        if self._descartados_al_reproducir:
+            print(f"Motor de saldos: {self._descartados_al_reproducir} movimientos del log sin registro en MySQL descartados")
+        hilo = threading.Thread(target=self._ciclo_replicacion, name='replicacion-saldos', daemon=True)
+        hilo.start()
+        self._iniciado = True
+        return hilo
+
+    def _reproducir(self, cursor, replicada):
+        # Aplica sobre los saldos de MySQL los registros posteriores a la última
+        # secuencia replicada que tienen su fila de historial. Los que no la
+        # tienen se descartan: la caída llegó antes del commit que los
+        # registraba, o el commit falló. Un registro cortado o corrupto al
+        # final (caída a mitad de una escritura) se descarta junto con lo que sigue.
+        with open(self.ruta, 'rb') as archivo:
+            datos = archivo.read()
+        cursor.execute(_CONSULTA_REGISTRADOS.format(filtro='> %s', bloqueo=''), (replicada,) * len(_TABLAS_HISTORIAL))
+        registrados = {fila[0] for fila in cursor.fetchall()}
+        ultima = replicada
+        aplicados = 0
+        valido = 0
+        for inicio in range(0, len(datos) - TAMANO_REGISTRO + 1, TAMANO_REGISTRO):
+            registro = datos[inicio:inicio + _REGISTRO.size]
+            crc, = _CRC.unpack_from(datos, inicio + _REGISTRO.size)
+            if zlib.crc32(registro) != crc:
+                break
+            secuencia, _, tipo1, id1, delta1, tipo2, id2, delta2 = _REGISTRO.unpack(registro)
+            valido = inicio + TAMANO_REGISTRO
+            if secuencia <= replicada:
+                continue
+            # Las secuencias nuevas siguen a la última del log, registrada o no
+            ultima = max(ultima, secuencia)
+            if secuencia not in registrados:
+                self._descartados_al_reproducir += 1
+                continue
+            patas = [(t, i, d) for t, i, d in ((tipo1, id1, delta1), (tipo2, id2, delta2)) if t]
+            for tipo, id_cuenta, delta in patas:
+                posicion = self._posicion(tipo, id_cuenta, cursor)
+                if posicion is None:
+                    print(f"Motor de saldos: cuenta {tipo}/{id_cuenta} del registro {secuencia} ya no existe")
+                    continue
+                self._saldos[posicion] += delta
+            self._pendientes.append([secuencia, patas, CONFIRMADO, 0])
+            aplicados += 1
+        if valido < len(datos):
+            print(f"Motor de saldos: {len(datos) - valido} bytes incompletos al final del log descartados")
+            os.ftruncate(self._fd, valido)
+        self._bytes_log = valido
+        self._secuencia = self._durable = ultima
+        self._replicada = replicada
+        return aplicados
+
+    # --- cuentas ---
+    def _posicion(self, tipo, id_cuenta, cursor=None):
+        clave = (tipo, id_cuenta)
+        posicion = self._indices.get(clave)
+        if posicion is not None:
+            return posicion
+        saldo = self._cargar(tipo, id_cuenta, cursor)
+        if saldo is None:
+            return None
+        with self._lock_cuentas:
+            # Si otro hilo la cargó mientras tanto, vale la suya (puede tener movimientos)
+            posicion = self._indices.get(clave)
+            if posicion is None:
+                self._saldos.append(saldo)
+                posicion = self._indices[clave] = len(self._saldos) - 1
+        return posicion
+
+    def _cargar(self, tipo, id_cuenta, cursor=None):
+        conn = None
+        if cursor is None:
+            conn = self.conectar()
+            cursor = conn.cursor()
+        try:
+            cursor.execute(_CONSULTAS_SALDO[tipo], (id_cuenta,))
+            fila = cursor.fetchone()
+        finally:
+            if conn is not None:
+                cursor.close()
+                conn.close()
+        if not fila:
+            return None
+        saldo = fila['saldo'] if isinstance(fila, dict) else fila[0]
+        return centavos(saldo or 0)
+
+    def saldo_en_memoria(self, tipo, id_cuenta):
+        # None si la cuenta no se cargó todavía (MySQL está al día)
+        self._asegurar_iniciado()
+        posicion = self._indices.get((tipo, id_cuenta))
+        if posicion is None:
+            return None
+        return self._saldos[posicion] / 100
+
+    def saldo(self, tipo, id_cuenta, cursor=None):
+        self._asegurar_iniciado()
+        posicion = self._posicion(tipo, id_cuenta, cursor)
+        return None if posicion is None else self._saldos[posicion] / 100
+
+    # --- movimientos ---
+    # Con durable=False el movimiento queda aplicado pero quien llama debe
+    # esperar_durable(secuencia) antes de confirmarlo (ej. todos los de un lote)
+    def cobrar(self, id_usuario, id_tarjetero, monto, cursor=None, durable=True):
+        monto = centavos(monto)
+        return self._mover([(USUARIO, id_usuario, -monto), (TARJETERO, id_tarjetero, monto)], cursor,
+                           durable=durable)
+
+    def transferir(self, id_origen, id_destino, monto, cursor=None):
+        monto = centavos(monto)
+        return self._mover([(USUARIO, id_origen, -monto), (USUARIO, id_destino, monto)], cursor)
+
+    def acreditar(self, id_usuario, monto, cursor=None):
+        return self._mover([(USUARIO, id_usuario, centavos(monto))], cursor)
+
+    def preparar(self, movidos):
+        # Justo antes del commit que registra los movimientos. Un movimiento
+        # vencido (en duda o ya deshecho) no puede confirmarse: quien lo pidió
+        # debe deshacer su transacción.
+        with self._lock_log:
+            for movimiento in movidos:
+                if movimiento.entrada[2] != EN_CURSO:
+                    raise MovimientoVencido(movimiento.secuencia)
+            for movimiento in movidos:
+                movimiento.entrada[2] = EN_COMMIT
+
+    def confirmar(self, movimiento):
+        # La transacción con la fila de historial del movimiento hizo commit
+        with self._lock_log:
+            if movimiento.entrada[2] != ANULADO:
+                movimiento.entrada[2] = CONFIRMADO
+                return
+        self._reaplicar(movimiento.entrada)
+
+    def revertir(self, movimiento):
+        # La transacción se deshizo antes del commit: el registro no quedó en
+        # MySQL y los saldos vuelven atrás. El registro del log no se toca: sin
+        # fila de historial no se replica ni se reaplica al arrancar.
+        self._deshacer(movimiento.entrada)
+
+    def resolver(self, movimiento):
+        # Falló el commit y no se sabe si llegó a MySQL: el hilo de replicación
+        # busca la fila de historial y confirma o deshace. Mientras tanto el
+        # dinero sigue descontado.
+        with self._lock_log:
+            self._poner_en_duda(movimiento.entrada)
+
+    def _poner_en_duda(self, entrada):
+        # Con self._lock_log tomado
+        if entrada[2] in (EN_CURSO, EN_COMMIT):
+            entrada[2] = EN_DUDA
+            self._dudas.append(entrada)
+
+    def _reaplicar(self, entrada):
+        # Confirmado después de deshacerse: no debería pasar (preparar() y la
+        # consulta con bloqueo lo evitan), pero si pasa MySQL tiene la fila y
+        # el movimiento vuelve a aplicarse, sin validar saldo. El registro ya
+        # no se replica: sus patas van a la próxima tanda de replicar().
+        print(f"Motor de saldos: movimiento {entrada[0]} confirmado después de anularse, se reaplica")
+        posiciones = [self._indices[(tipo, id_cuenta)] for tipo, id_cuenta, _ in entrada[1]]
+        bloqueos = [self._bloqueos[i] for i in sorted({p % len(self._bloqueos) for p in posiciones})]
+        for bloqueo in bloqueos:
+            bloqueo.acquire()
+        try:
+            for posicion, (_, _, delta) in zip(posiciones, entrada[1]):
+                self._saldos[posicion] += delta
+            with self._lock_log:
+                self._tardios.extend(entrada[1])
+                self._reaplicados += 1
+        finally:
+            for bloqueo in bloqueos:
+                bloqueo.release()
+
+    def _deshacer(self, entrada):
+        posiciones = [self._indices[(tipo, id_cuenta)] for tipo, id_cuenta, _ in entrada[1]]
+        bloqueos = [self._bloqueos[i] for i in sorted({p % len(self._bloqueos) for p in posiciones})]
+        for bloqueo in bloqueos:
+            bloqueo.acquire()
+        try:
+            with self._lock_log:
+                if entrada[2] not in (EN_CURSO, EN_COMMIT, EN_DUDA):
+                    return
+                entrada[2] = ANULADO
+                self._reversiones += 1
+            for posicion, (_, _, delta) in zip(posiciones, entrada[1]):
+                self._saldos[posicion] -= delta
+        finally:
+            for bloqueo in bloqueos:
+                bloqueo.release()
+
+    def _mover(self, patas, cursor=None, validar=True, durable=True):
+        self._asegurar_iniciado()
+        if self._averia:
+            raise MotorAveriado(self._averia)
+        posiciones = []
+        for tipo, id_cuenta, _ in patas:
+            posicion = self._posicion(tipo, id_cuenta, cursor)
+            if posicion is None:
+                raise CuentaNoEncontrada(tipo, id_cuenta)
+            posiciones.append(posicion)
+
+        # Locks en orden de franja: dos movimientos cruzados no se bloquean
+        bloqueos = [self._bloqueos[i] for i in sorted({p % len(self._bloqueos) for p in posiciones})]
+        for bloqueo in bloqueos:
+            bloqueo.acquire()
+        try:
+            if validar:
+                for posicion, (_, _, delta) in zip(posiciones, patas):
+                    if delta < 0 and self._saldos[posicion] + delta < 0:
+                        with self._lock_log:
+                            self._rechazos += 1
+                        raise SaldoInsuficiente(self._saldos[posicion] / 100)
+            for posicion, (_, _, delta) in zip(posiciones, patas):
+                self._saldos[posicion] += delta
+            saldos = [self._saldos[posicion] / 100 for posicion in posiciones]
+            # La secuencia se toma con las cuentas bloqueadas: el orden del log
+            # es el orden en que se aplicaron los movimientos de cada cuenta
+            entrada = self._agregar(patas)
+        finally:
+            for bloqueo in bloqueos:
+                bloqueo.release()
+        movimiento = Movimiento(entrada, saldos)
+        if durable:
+            try:
+                self.esperar_durable(movimiento.secuencia)
+            except MotorAveriado:
+                self.revertir(movimiento)
+                raise
+        return movimiento
+
+    def _agregar(self, patas):
+        (tipo1, id1, delta1), (tipo2, id2, delta2) = (list(patas) + [(0, 0, 0)])[:2]
+        with self._lock_log:
+            self._secuencia += 1
+            registro = _REGISTRO.pack(self._secuencia, datetime.now().timestamp(),
+                                      tipo1, id1, delta1, tipo2, id2, delta2)
+            self._buffer.append(registro + _CRC.pack(zlib.crc32(registro)))
+            entrada = [self._secuencia, patas, EN_CURSO, time.monotonic()]
+            self._pendientes.append(entrada)
+            self._movimientos += 1
+            return entrada
+
+    def esperar_durable(self, secuencia):
+        with self._escrito:
+            while self._durable < secuencia:
+                if self._averia:
+                    raise MotorAveriado(self._averia)
+                if self._escribiendo:
+                    self._escrito.wait()
+                    continue
+                # Este hilo escribe lo acumulado por todos los que esperan
+                self._escribiendo = True
+                datos = b''.join(self._buffer)
+                self._buffer = []
+                hasta = self._secuencia
+                self._lock_log.release()
+                inicio = time.perf_counter()
+                try:
+                    escritos = 0
+                    while escritos < len(datos):
+                        escritos += os.write(self._fd, datos[escritos:])
+                    if self.fsync:
+                        os.fsync(self._fd)
+                except OSError as e:
+                    self._averia = f'Error escribiendo el log de saldos: {e}'
+                    print(self._averia)
+                finally:
+                    self._lock_log.acquire()
+                    self._escribiendo = False
+                    self._escrito.notify_all()
+                if self._averia:
+                    raise MotorAveriado(self._averia)
+                self._durable = hasta
+                self._bytes_log += len(datos)
+                self._escrituras += 1
+                self._tiempo_escritura += time.perf_counter() - inicio
+
+    # --- replicación a MySQL ---
+    def _ciclo_replicacion(self):
+        while True:
+            time.sleep(self.intervalo_replicacion)
+            try:
+                self._comprobar_dudas()
+                while self.replicar():
+                    pass
+                self._compactar()
+            except Exception as e:
+                with self._lock_log:
+                    self._errores_replicacion += 1
+                print(f"Error replicando saldos: {e}")
+
+    def _comprobar_dudas(self):
+        # Movimientos cuyo commit falló, o sin resolver hace más de
+        # max_en_curso (pasan a en duda: preparar() ya no los deja confirmar):
+        # se confirman si su fila de historial existe y si no se deshacen. La
+        # consulta bloquea, así una transacción que insertó la fila y sigue
+        # abierta se espera en lugar de darla por perdida. La cola está en
+        # orden de creación: se corta en el primer movimiento reciente.
+        limite = time.monotonic() - self.max_en_curso
+        with self._lock_log:
+            for entrada in self._pendientes:
+                if entrada[2] not in (EN_CURSO, EN_COMMIT):
+                    continue
+                if entrada[3] > limite:
+                    break
+                print(f"Motor de saldos: movimiento {entrada[0]} sin resolver hace más de {self.max_en_curso} s")
+                self._poner_en_duda(entrada)
+            revisar = [e for e in self._dudas if e[2] == EN_DUDA]
+        if not revisar:
+            return
+
+        conn = self.conectar()
+        cursor = conn.cursor()
+        try:
+            marcas = ', '.join(['%s'] * len(revisar))
+            secuencias = tuple(e[0] for e in revisar)
+            cursor.execute(_CONSULTA_REGISTRADOS.format(filtro=f'IN ({marcas})', bloqueo='LOCK IN SHARE MODE'),
+                           secuencias * len(_TABLAS_HISTORIAL))
+            registrados = {fila[0] for fila in cursor.fetchall()}
+            conn.commit()
+        finally:
+            cursor.close()
+            conn.close()
+
+        for entrada in revisar:
+            if entrada[0] in registrados:
+                with self._lock_log:
+                    if entrada[2] == EN_DUDA:
+                        entrada[2] = CONFIRMADO
+            else:
+                self._deshacer(entrada)
+        with self._lock_log:
+            self._dudas = [e for e in self._dudas if e[2] == EN_DUDA]
+
+    def replicar(self):
+        # Una tanda de movimientos durables y ya resueltos (confirmados o
+        # anulados), más los reaplicados, en una transacción; devuelve cuántos
+        with self._lock_log:
+            tanda = []
+            while (self._pendientes and self._pendientes[0][0] <= self._durable
+                   and self._pendientes[0][2] in (CONFIRMADO, ANULADO)
+                   and len(tanda) < self.tanda_replicacion):
+                tanda.append(self._pendientes.popleft())
+            tardios, self._tardios = self._tardios, []
+        if not tanda and not tardios:
+            return 0
+
+        conn = self.conectar()
+        cursor = conn.cursor()
+        try:
+            # Si un commit anterior llegó a MySQL pero se perdió la respuesta,
+            # esos movimientos ya están aplicados
+            cursor.execute("SELECT secuencia FROM motor_saldos_estado WHERE id = 1 FOR UPDATE")
+            fila = cursor.fetchone()
+            aplicada = fila[0] if fila else 0
+            deltas = {}
+            for secuencia, patas, estado, _ in tanda:
+                if secuencia <= aplicada or estado == ANULADO:
+                    continue
+                for tipo, id_cuenta, delta in patas:
+                    deltas[(tipo, id_cuenta)] = deltas.get((tipo, id_cuenta), 0) + delta
+            for tipo, id_cuenta, delta in tardios:
+                deltas[(tipo, id_cuenta)] = deltas.get((tipo, id_cuenta), 0) + delta
+
+            usuarios = sorted(i for t, i in deltas if t == USUARIO)
+            if usuarios:
+                params = []
+                for id_usuario in usuarios:
+                    params.extend((id_usuario, Decimal(deltas[(USUARIO, id_usuario)]) / 100))
+                marcas = ', '.join(['%s'] * len(usuarios))
+                cursor.execute(f"""
+                    UPDATE usuarios SET saldo = saldo + CASE id {' '.join(['WHEN %s THEN %s'] * len(usuarios))} END
+                    WHERE id IN ({marcas})
+                """, (*params, *usuarios))
+            tarjeteros = sorted(i for t, i in deltas if t == TARJETERO)
+            if tarjeteros:
+                params = []
+                for id_tarjetero in tarjeteros:
+                    params.extend((id_tarjetero, Decimal(deltas[(TARJETERO, id_tarjetero)]) / 100))
+                cursor.execute(f"""
+                    INSERT INTO tarjeteros_saldo (id_tarjetero, franja, saldo)
+                    VALUES {', '.join(['(%s, 0, %s)'] * len(tarjeteros))}
+                    ON DUPLICATE KEY UPDATE saldo = saldo + VALUES(saldo)
+                """, tuple(params))
+            if tanda:
+                cursor.execute("""
+                    INSERT INTO motor_saldos_estado (id, secuencia) VALUES (1, %s)
+                    ON DUPLICATE KEY UPDATE secuencia = GREATEST(secuencia, VALUES(secuencia))
+                """, (tanda[-1][0],))
+            conn.commit()
+        except Exception:
+            try:
+                conn.rollback()
+            except Error:
+                pass
+            with self._lock_log:
+                self._pendientes.extendleft(reversed(tanda))
+                self._tardios[:0] = tardios
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+
+        with self._lock_log:
+            if tanda:
+                self._replicada = tanda[-1][0]
+            self._replicaciones += 1
+        return len(tanda) + len(tardios)
+
+    def _compactar(self):
+        # Con todo replicado el log ya no hace falta para reconstruir: se vacía
+        with self._lock_log:
+            if (self._bytes_log < self.max_log_bytes or self._escribiendo or self._buffer
+                    or self._pendientes or self._replicada < self._secuencia):
+                return
+            os.ftruncate(self._fd, 0)
+            self._bytes_log = 0
+            self._compactaciones += 1
+
+    def metricas(self):
+        with self._lock_log:
+            return {
+                'iniciado': self._iniciado,
+                'cuentas': len(self._indices),
+                'secuencia': self._secuencia,
+                'durable': self._durable,
+                'replicada': self._replicada,
+                'pendientes_replicacion': len(self._pendientes),
+                'movimientos': self._movimientos,
+                'rechazos_saldo': self._rechazos,
+                'reversiones': self._reversiones,
+                'reaplicados': self._reaplicados,
+                'en_duda': len(self._dudas),
+                'descartados_al_reproducir': self._descartados_al_reproducir,
+                'escrituras_log': self._escrituras,
+                'movimientos_por_escritura': round(self._movimientos / self._escrituras, 2) if self._escrituras else 0.0,
+                'escritura_promedio_ms': round(self._tiempo_escritura / self._escrituras * 1000, 3) if self._escrituras else 0.0,
+                'bytes_log': self._bytes_log,
+                'compactaciones': self._compactaciones,
+                'replicaciones': self._replicaciones,
+                'errores_replicacion': self._errores_replicacion,
+                'averia': self._averia,
+            }
@@ -0,0 +1,207 @@
+import threading
+import time
+from collections import deque
+
+import mysql.connector
+from mysql.connector import Error
+from mysql.connector.errors import PoolError
+
+
+class ConexionPool:
+    # Envoltorio de una conexión prestada: close() la devuelve al pool
+    # en lugar de cerrarla, así las rutas no cambian su forma de uso.
+
+    def __init__(self, pool, raw, creada_en):
+        self._pool = pool
+        self._raw = raw
+        self._creada_en = creada_en
+
+    def _activa(self):
+        # Tras close() la conexión física ya puede estar prestada a otra
+        # petición: cualquier uso posterior es un error, no un reenvío.
+        raw = self.__dict__.get('_raw')
+        if raw is None:
+            raise Error('Conexión ya devuelta al pool')
+        return raw
+
+    def __getattr__(self, nombre):
+        return getattr(self._activa(), nombre)
+
+    def cursor(self, *args, **kwargs):
+        cursor = self._activa().cursor(*args, **kwargs)
+        medidor = self._pool.medidor
+        return medidor.envolver_cursor(cursor) if medidor else cursor
+
+    def commit(self):
+        raw = self._activa()
+        medidor = self._pool.medidor
+        if not medidor:
+            return raw.commit()
+        inicio = time.perf_counter()
+        try:
+            return raw.commit()
+        finally:
+            medidor.registrar_commit(time.perf_counter() - inicio)
+
+    def close(self):
+        raw = self._raw
+        if raw is None:
+            return
+        self._raw = None
+        self._pool._devolver(self, raw)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PoolConexiones:
+
+    def __init__(self, config, tamano=10, timeout=5.0, max_edad=1800, ping_tras_inactividad=5.0, medidor=None):
+        self.config = config
+        # Opcional (instrumentacion.Medidor): mide cursores, commits y esperas
+        self.medidor = medidor
+        self.tamano = tamano
+        self.timeout = timeout
+        self.max_edad = max_edad
+        self.ping_tras_inactividad = ping_tras_inactividad
+
+        self._cond = threading.Condition()
+        self._libres = deque()          # (raw, creada_en, ultimo_uso)
+        self._abiertas = 0
+        self._prestadas = {}            # id(ConexionPool) -> (hilo, desde)
+
+        self._esperando = 0
+        self._agotamientos = 0
+        self._checkouts = 0
+        self._checkout_total = 0.0
+        self._checkout_max = 0.0
+        self._recicladas = 0
+        self._descartadas = 0
+
+    def _conectar(self):
+        return mysql.connector.connect(**self.config)
+
+    def _cerrar_raw(self, raw):
+        try:
+            raw.close()
+        except Error:
+            pass
+
+    def _sana(self, raw, creada_en, ultimo_uso, ahora):
+        # Se llama fuera del lock (el ping va a la red); los contadores sí van dentro
+        if self.max_edad and ahora - creada_en > self.max_edad:
+            with self._cond:
+                self._recicladas += 1
+            return False
+        if ahora - ultimo_uso >= self.ping_tras_inactividad:
+            try:
+                raw.ping(reconnect=False)
+            except Error:
+                with self._cond:
+                    self._descartadas += 1
+                return False
+        return True
+
+    def obtener(self):
+        inicio = time.monotonic()
+        limite = inicio + self.timeout
+        raw = None
+        creada_en = None
+        crear = False
+
+        with self._cond:
+            agotado = False
+            while True:
+                if self._libres:
+                    raw, creada_en, ultimo_uso = self._libres.pop()
+                    break
+                if self._abiertas < self.tamano:
+                    self._abiertas += 1
+                    crear = True
+                    break
+                if not agotado:
+                    agotado = True
+                    self._agotamientos += 1
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    raise PoolError('Pool de conexiones agotado (%d en uso)' % self.tamano)
+                self._esperando += 1
+                try:
+                    self._cond.wait(restante)
+                finally:
+                    self._esperando -= 1
+
+        # Chequeo de salud y conexión fuera del lock
+        try:
+            if not crear and not self._sana(raw, creada_en, ultimo_uso, time.monotonic()):
+                self._cerrar_raw(raw)
+                crear = True
+            if crear:
+                raw = self._conectar()
+                creada_en = time.monotonic()
+        except Exception:
+            with self._cond:
+                self._abiertas -= 1
+                self._cond.notify()
+            raise
+
+        conexion = ConexionPool(self, raw, creada_en)
+        espera = time.monotonic() - inicio
+        with self._cond:
+            self._prestadas[id(conexion)] = (threading.current_thread().name, time.time())
+            self._checkouts += 1
+            self._checkout_total += espera
+            if espera > self._checkout_max:
+                self._checkout_max = espera
+        if self.medidor:
+            self.medidor.registrar_conexion(espera)
+        return conexion
+
+    def _devolver(self, conexion, raw):
+        reutilizable = True
+        try:
+            if raw.in_transaction:
+                raw.rollback()
+        except Error:
+            reutilizable = False
+
+        with self._cond:
+            self._prestadas.pop(id(conexion), None)
+            if reutilizable:
+                self._libres.append((raw, conexion._creada_en, time.monotonic()))
+            else:
+                self._abiertas -= 1
+                self._descartadas += 1
+            self._cond.notify()
+
+        if not reutilizable:
+            self._cerrar_raw(raw)
+
+    def cerrar_todas(self):
+        with self._cond:
+            libres = list(self._libres)
+            self._libres.clear()
+            self._abiertas -= len(libres)
+        for raw, _, _ in libres:
+            self._cerrar_raw(raw)
+
+    def metricas(self):
+        ahora = time.time()
+        with self._cond:
+            return {
+                'tamano': self.tamano,
+                'abiertas': self._abiertas,
+                'libres': len(self._libres),
+                'prestadas': len(self._prestadas),
+                'prestamo_mas_largo_s': round(max((ahora - d for _, d in self._prestadas.values()), default=0.0), 3),
+                'esperando': self._esperando,
+                'agotamientos': self._agotamientos,
+                'checkouts': self._checkouts,
+                'checkout_promedio_ms': round(self._checkout_total / self._checkouts * 1000, 3) if self._checkouts else 0.0,
+                'checkout_max_ms': round(self._checkout_max * 1000, 3),
+                'recicladas': self._recicladas,
+                'descartadas': self._descartadas,
+            }
@@ -0,0 +1,70 @@
+import random
+import threading
+import time
+
+from mysql.connector import Error
+
+# Errores de InnoDB tras los que conviene repetir la transacción completa
+ERRORES_REINTENTABLES = {1213: 'deadlock', 1205: 'lock_wait_timeout'}
+
+
+class BloqueoAgotado(Exception):
+    # La transacción siguió chocando con otras después de todos los intentos
+
+    def __init__(self, retry_after):
+        super().__init__('Conflicto de bloqueos, reintentos agotados')
+        self.retry_after = retry_after
+
+
+class ReintentadorBloqueos:
+    # Repite una transacción abortada por deadlock o lock wait timeout con
+    # espera exponencial y jitter completo (uniforme entre 0 y el tope), así
+    # las transacciones que chocaron no vuelven a chocar al mismo tiempo.
+    # La función debe hacer rollback antes de relanzar el error: con
+    # innodb_rollback_on_timeout=OFF un 1205 solo deshace la última sentencia.
+
+    def __init__(self, intentos=4, espera_base_ms=5, espera_max_ms=200, retry_after=1):
+        self.intentos = intentos
+        self.espera_base = espera_base_ms / 1000
+        self.espera_max = espera_max_ms / 1000
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._contadores = {}
+
+    def _anotar(self, nombre, evento):
+        with self._lock:
+            contadores = self._contadores.setdefault(nombre, {
+                'ejecuciones': 0, 'deadlock': 0, 'lock_wait_timeout': 0,
+                'exitos_tras_reintento': 0, 'agotados': 0, 'espera_ms': 0.0
+            })
+            contadores[evento] += 1
+
+    def ejecutar(self, nombre, funcion):
+        self._anotar(nombre, 'ejecuciones')
+        for intento in range(self.intentos):
+            try:
+                resultado = funcion()
+            except Error as e:
+                tipo = ERRORES_REINTENTABLES.get(e.errno)
+                if tipo is None:
+                    raise
+                self._anotar(nombre, tipo)
+                if intento + 1 == self.intentos:
+                    self._anotar(nombre, 'agotados')
+                    raise BloqueoAgotado(self.retry_after) from e
+                espera = random.uniform(0, min(self.espera_max, self.espera_base * 2 ** intento))
+                with self._lock:
+                    self._contadores[nombre]['espera_ms'] += espera * 1000
+                time.sleep(espera)
+                continue
+            if intento:
+                self._anotar(nombre, 'exitos_tras_reintento')
+            return resultado
+
+    def metricas(self):
+        with self._lock:
+            return {
+                'intentos': self.intentos,
+                'operaciones': {nombre: dict(c, espera_ms=round(c['espera_ms'], 1))
+                                for nombre, c in self._contadores.items()},
+            }
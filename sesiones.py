@@ -0,0 +1,108 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class SesionesMemoria:
+    # Sesiones en el proceso: LRU acotada con expiración por TTL.
+    # Sirve para un solo worker; con varios usar SesionesMySQL.
+
+    def __init__(self, ttl=28800, max_sesiones=100000):
+        self.ttl = ttl
+        self.max_sesiones = max_sesiones
+        self._sesiones = OrderedDict()      # token -> (user_id, expira)
+        self._lock = threading.Lock()
+
+    def crear(self, token, user_id):
+        with self._lock:
+            self._sesiones[token] = (user_id, time.monotonic() + self.ttl)
+            self._sesiones.move_to_end(token)
+            while len(self._sesiones) > self.max_sesiones:
+                self._sesiones.popitem(last=False)
+
+    def obtener(self, token):
+        with self._lock:
+            sesion = self._sesiones.get(token)
+            if not sesion:
+                return None
+            user_id, expira = sesion
+            if expira <= time.monotonic():
+                del self._sesiones[token]
+                return None
+            self._sesiones.move_to_end(token)
+            return user_id
+
+    def eliminar(self, token):
+        with self._lock:
+            self._sesiones.pop(token, None)
+
+    def purgar_expiradas(self):
+        ahora = time.monotonic()
+        with self._lock:
+            expiradas = [t for t, (_, expira) in self._sesiones.items() if expira <= ahora]
+            for token in expiradas:
+                del self._sesiones[token]
+        return len(expiradas)
+
+
+class SesionesMySQL:
+    # Sesiones en la tabla `sesiones` (ver db.sql), compartidas entre workers.
+    # Solo se guarda el SHA-256 del token.
+
+    def __init__(self, conectar, ttl=28800):
+        self.conectar = conectar
+        self.ttl = ttl
+
+    @staticmethod
+    def _hash(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def _ejecutar(self, sql, params, leer=False):
+        conn = self.conectar()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(sql, params)
+            if leer:
+                return cursor.fetchone()
+            conn.commit()
+            return cursor.rowcount
+        finally:
+            cursor.close()
+            conn.close()
+
+    def crear(self, token, user_id):
+        self._ejecutar("""
+            INSERT INTO sesiones (token_hash, id_usuario, expira)
+            VALUES (%s, %s, NOW() + INTERVAL %s SECOND)
+        """, (self._hash(token), user_id, self.ttl))
+
+    def obtener(self, token):
+        fila = self._ejecutar("""
+            SELECT id_usuario FROM sesiones
+            WHERE token_hash = %s AND expira > NOW()
+        """, (self._hash(token),), leer=True)
+        return fila[0] if fila else None
+
+    def eliminar(self, token):
+        self._ejecutar("DELETE FROM sesiones WHERE token_hash = %s", (self._hash(token),))
+
+    def purgar_expiradas(self):
+        return self._ejecutar("DELETE FROM sesiones WHERE expira <= NOW() LIMIT 5000", ())
+
+
+def iniciar_limpieza(almacen, intervalo=300, nombre='sesiones'):
+    # Hilo de fondo que llama a almacen.purgar_expiradas() cada `intervalo` segundos
+    def ciclo():
+        while True:
+            time.sleep(intervalo)
+            try:
+                eliminadas = almacen.purgar_expiradas()
+                if eliminadas:
+                    print(f"{nombre.capitalize()} expiradas eliminadas: {eliminadas}")
+            except Exception as e:
+                print(f"Error limpiando {nombre}: {e}")
+
+    hilo = threading.Thread(target=ciclo, name=f'limpieza-{nombre}', daemon=True)
+    hilo.start()
+    return hilo
@@ -1,5 +1,6 @@
 const API_BASE = '';
 let currentUser = null;
+let transaccionesRecientes = [];
 
 // Verificar autenticación al cargar
 window.addEventListener('DOMContentLoaded', async () => {
@@ -22,6 +23,9 @@ window.addEventListener('DOMContentLoaded', async () => {
     cargarDatosUsuario();
     actualizarFecha();
     
+    // Saldo y movimientos nuevos llegan por SSE, sin volver a consultar
+    conectarEventos();
+    
     // Inicializar menu responsive
     inicializarMenuResponsive();
 });
@@ -177,18 +181,16 @@ document.getElementById('formTransferir').addEventListener('submit', async (e) =
     }
     
     try {
-        const response = await fetchAPI('/api/transferir', {
-            method: 'POST',
-            body: JSON.stringify({ ci_destino: ciDestino, monto, descripcion })
+        const response = await postIdempotente('formTransferir', '/api/transferir', {
+            ci_destino: ciDestino, monto, descripcion
         });
         
         const data = await response.json();
         
-        if (response.ok) {
+        if (response.ok && data.estado !== 'incierto') {
             mostrarAlerta('alertTransferir', `Transferencia exitosa a ${data.destinatario}. Nuevo saldo: $${data.nuevo_saldo.toFixed(2)}`, 'success');
             document.getElementById('formTransferir').reset();
             setTimeout(() => {
-                cargarDatosUsuario();
                 cambiarVista('resumen');
             }, 2000);
         } else {
@@ -257,19 +259,15 @@ document.getElementById('formCanjearTarjeta').addEventListener('submit', async (
     }
     
     try {
-        const response = await fetchAPI('/api/canjear-tarjeta', {
-            method: 'POST',
-            body: JSON.stringify({ codigo })
-        });
+        const response = await postIdempotente('formCanjearTarjeta', '/api/canjear-tarjeta', { codigo });
         
         const data = await response.json();
         
-        if (response.ok) {
+        if (response.ok && data.estado !== 'incierto') {
             mostrarAlerta('alertCanjear', `¡Tarjeta canjeada! +$${data.monto.toFixed(2)}. Nuevo saldo: $${data.nuevo_saldo.toFixed(2)}`, 'success');
             document.getElementById('formCanjearTarjeta').reset();
             cargarTarjetasDisponibles();
             setTimeout(() => {
-                cargarDatosUsuario();
                 cambiarVista('resumen');
             }, 2000);
         } else {
@@ -287,7 +285,8 @@ async function cargarTransaccionesRecientes() {
         const data = await response.json();
         
         if (response.ok) {
-            mostrarTransaccionesRecientes(data.transacciones);
+            transaccionesRecientes = data.transacciones;
+            mostrarTransaccionesRecientes(transaccionesRecientes);
         }
     } catch (error) {
         console.error('Error cargando transacciones:', error);
@@ -340,6 +339,63 @@ function mostrarTransaccionesRecientes(transacciones) {
     });
 }
 
+// ========== EVENTOS EN TIEMPO REAL ==========
+async function conectarEventos(espera = 1000) {
+    const token = localStorage.getItem('access_token');
+    if (!token) return;
+    
+    try {
+        const response = await fetch(API_BASE + '/api/eventos', {
+            headers: { 'Authorization': `Bearer ${token}` }
+        });
+        
+        if (response.status === 401) return;
+        if (!response.ok) throw new Error('Error en el canal de eventos');
+        
+        espera = 1000;
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            
+            buffer += decoder.decode(value, { stream: true });
+            const lines = buffer.split('\n');
+            buffer = lines.pop();
+            
+            for (const line of lines) {
+                if (line.startsWith('data: ')) {
+                    try {
+                        aplicarEvento(JSON.parse(line.slice(6)));
+                    } catch (e) {
+                        console.error('Error parsing evento:', e);
+                    }
+                }
+            }
+        }
+    } catch (error) {
+        console.error('Canal de eventos desconectado:', error);
+    }
+    
+    // Reconectar con espera creciente (máximo 30 s)
+    setTimeout(() => conectarEventos(Math.min(espera * 2, 30000)), espera);
+}
+
+function aplicarEvento(evento) {
+    if (evento.tipo !== 'movimiento') return;
+    
+    document.getElementById('saldoTotal').textContent = evento.saldo.toFixed(2);
+    if (currentUser) {
+        currentUser.saldo = evento.saldo;
+        localStorage.setItem('user', JSON.stringify(currentUser));
+    }
+    
+    transaccionesRecientes = [evento.movimiento, ...transaccionesRecientes].slice(0, 5);
+    mostrarTransaccionesRecientes(transaccionesRecientes);
+}
+
 // Eliminado: btnRefreshHistory ya no existe en el HTML
 // document.getElementById('btnRefreshHistory').addEventListener('click', cargarHistorialCompleto);
 
@@ -461,14 +517,71 @@ document.getElementById('formCambiarPassword').addEventListener('submit', async
 async function fetchAPI(endpoint, options = {}) {
     const token = localStorage.getItem('access_token');
     
-    const defaultOptions = {
-        headers: {
-            'Content-Type': 'application/json',
-            'Authorization': `Bearer ${token}`
-        }
+    const headers = {
+        'Content-Type': 'application/json',
+        'Authorization': `Bearer ${token}`,
+        ...options.headers
     };
     
-    return fetch(API_BASE + endpoint, { ...defaultOptions, ...options });
+    // Una clave por envío: si la petición se repite, el servidor no mueve dinero dos veces
+    if (options.method === 'POST' && !headers['Idempotency-Key']) {
+        headers['Idempotency-Key'] = generarUUID();
+    }
+    
+    return fetch(API_BASE + endpoint, { ...options, headers });
+}
+
+function generarUUID() {
+    if (crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    // crypto.randomUUID solo existe en contextos seguros (HTTPS o localhost);
+    // servido por HTTP en la LAN se arma un UUID v4 con getRandomValues
+    const b = crypto.getRandomValues(new Uint8Array(16));
+    b[6] = (b[6] & 0x0f) | 0x40;
+    b[8] = (b[8] & 0x3f) | 0x80;
+    const h = Array.from(b, x => x.toString(16).padStart(2, '0')).join('');
+    return `${h.slice(0, 8)}-${h.slice(8, 12)}-${h.slice(12, 16)}-${h.slice(16, 20)}-${h.slice(20)}`;
+}
+
+// Clave pendiente por formulario: se conserva hasta que el servidor da una
+// respuesta definitiva, así volver a enviar el mismo formulario después de un
+// error de conexión reutiliza la clave y no repite el movimiento
+const clavesPendientes = {};
+const ESPERAS_REINTENTO_MS = [500, 1500];
+
+function esperar(ms) {
+    return new Promise(resolve => setTimeout(resolve, ms));
+}
+
+async function postIdempotente(formulario, endpoint, datos) {
+    const body = JSON.stringify(datos);
+    let pendiente = clavesPendientes[formulario];
+    if (!pendiente || pendiente.body !== body) {
+        pendiente = { clave: generarUUID(), body };
+        clavesPendientes[formulario] = pendiente;
+    }
+    const options = { method: 'POST', body, headers: { 'Idempotency-Key': pendiente.clave } };
+    
+    // Sin respuesta (red) o 409 (el intento anterior sigue en curso): se
+    // reintenta con la misma clave
+    for (let intento = 0; ; intento++) {
+        let response = null;
+        try {
+            response = await fetchAPI(endpoint, options);
+        } catch (error) {
+            if (intento >= ESPERAS_REINTENTO_MS.length) throw error;
+        }
+        if (response && (response.status !== 409 || intento >= ESPERAS_REINTENTO_MS.length)) {
+            // Los 5xx liberan la clave en el servidor y un 409 sigue en curso:
+            // en esos casos el próximo envío reusa la clave
+            if (response.status < 500 && response.status !== 409 && clavesPendientes[formulario] === pendiente) {
+                delete clavesPendientes[formulario];
+            }
+            return response;
+        }
+        await esperar(ESPERAS_REINTENTO_MS[intento]);
+    }
 }
 
 function mostrarAlerta(elementId, mensaje, tipo) {
@@ -510,6 +623,11 @@ document.getElementById('formAIChat').addEventListener('submit', async (e) => {
             body: JSON.stringify({ pregunta })
         });
         
+        if (response.status === 503) {
+            actualizarMensajeIA(mensajeId, 'El asistente está ocupado. Intenta nuevamente en unos segundos.');
+            return;
+        }
+        
         if (!response.ok) {
             throw new Error('Error en la respuesta del servidor');
         }
@@ -537,6 +655,11 @@ document.getElementById('formAIChat').addEventListener('submit', async (e) => {
                             break;
                         }
                         
+                        if (data.estado === 'en_cola') {
+                            mostrarColaIA(mensajeId, data.posicion);
+                            continue;
+                        }
+                        
                         if (data.text) {
                             agregarTextoAMensajeIA(mensajeId, data.text);
                         }
@@ -663,6 +786,17 @@ function agregarTextoAMensajeIA(mensajeId, texto) {
     chatMessages.scrollTop = chatMessages.scrollHeight;
 }
 
+function mostrarColaIA(mensajeId, posicion) {
+    const mensaje = document.getElementById(mensajeId);
+    if (!mensaje) return;
+    
+    const textElement = mensaje.querySelector('.message-text');
+    if (!textElement) return;
+    
+    // Se muestra dentro del indicador para que el primer texto lo reemplace
+    textElement.innerHTML = `<span class="typing-indicator">En cola, posición ${posicion}... ▊</span>`;
+}
+
 function actualizarMensajeIA(mensajeId, texto) {
     const mensaje = document.getElementById(mensajeId);
     if (!mensaje) return;